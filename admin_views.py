@@ -0,0 +1,143 @@
+"""Flask-Admin views for Warbler.
+
+The stock ModelView runs an exact COUNT(*), OFFSET paging and unindexed
+ILIKE '%term%' search on every list page, lazy-loads relationships per row
+and selects every column (including password hashes). These views are
+built to stay fast on tables with millions of rows:
+
+- counts come from the planner's estimate once a table is big
+- the default listing is keyset-paged on id (newest first)
+- only the listed columns are loaded; relationships are eager-loaded
+- search uses an index (username/email prefix, message full-text)
+"""
+
+from flask import request
+from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import func, literal_column, or_, text
+from sqlalchemy.orm import joinedload, load_only
+
+from models import Message
+
+# Below this many (estimated) rows an exact count is cheap enough
+EXACT_COUNT_LIMIT = 100000
+
+
+def estimated_count(session, model):
+    """Row count for `model`'s table, estimated by the planner when large."""
+
+    estimate = session.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:t AS regclass)"),
+        {"t": model.__tablename__},
+    ).scalar()
+    if estimate is None or estimate < EXACT_COUNT_LIMIT:
+        return session.query(func.count("*")).select_from(model).scalar()
+    return estimate
+
+
+class ScalableModelView(ModelView):
+    """ModelView with estimated counts and keyset paging on `id`.
+
+    Subclasses set `column_load_only` (the only columns loaded for the list)
+    and may override `search_clause(term)`, which by default is a prefix
+    match on `column_searchable_list`.
+    """
+
+    list_template = "admin/keyset_list.html"
+    simple_list_pager = True
+    can_set_page_size = False
+    page_size = 50
+    column_default_sort = ("id", True)
+    column_display_pk = True
+
+    column_load_only = ("id",)
+
+    def keyset_after(self):
+        """The `after` id cursor, if this is a default-sorted keyset page."""
+
+        if request.args.get("sort") is not None:
+            return None
+        return request.args.get("after", type=int)
+
+    def get_query(self):
+        query = self.session.query(self.model).options(
+            load_only(*self.column_load_only)
+        )
+        after = self.keyset_after()
+        if after is not None:
+            query = query.filter(self.model.id < after)
+        return query
+
+    def search_clause(self, term):
+        """A case-insensitive prefix match on any searchable column.
+
+        Only fast with a lower(column) text_pattern_ops index on each of
+        them (see models.py); override it for anything else.
+        """
+
+        prefix = term.lower().replace("%", r"\%").replace("_", r"\_") + "%"
+        return or_(
+            *(
+                func.lower(getattr(self.model, name)).like(prefix)
+                for name in self.column_searchable_list
+            )
+        )
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        for term in search.split():
+            query = query.filter(self.search_clause(term))
+        return query, count_query, joins, count_joins
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        if self.keyset_after() is not None:
+            page = 0
+        return super().get_list(
+            page, sort_column, sort_desc, search, filters, execute, page_size
+        )
+
+    def render(self, template, **kwargs):
+        if template == self.list_template:
+            kwargs["estimated_count"] = estimated_count(self.session, self.model)
+            kwargs["keyset_paging"] = kwargs.get("sort_column") is None
+        return super().render(template, **kwargs)
+
+
+class UserAdmin(ScalableModelView):
+    """Users, without password hashes or images."""
+
+    can_create = False
+    column_list = ("id", "username", "email", "location")
+    column_load_only = column_list
+    # the default prefix search, backed by the lower(...) text_pattern_ops
+    # indexes in models.py
+    column_searchable_list = ("username", "email")
+    form_excluded_columns = (
+        "password",
+        "messages",
+        "followers",
+        "following",
+        "likes",
+    )
+
+
+class MessageAdmin(ScalableModelView):
+    """Messages, with their author loaded in the same query."""
+
+    column_list = ("id", "user", "text", "timestamp")
+    column_load_only = ("id", "user_id", "text", "timestamp")
+    column_searchable_list = ("text",)
+    column_formatters = {"user": lambda view, context, model, name: model.user.username}
+    form_ajax_refs = {"user": {"fields": ["username"], "page_size": 10}}
+
+    def get_query(self):
+        return (
+            super()
+            .get_query()
+            .options(joinedload(Message.user).load_only("id", "username"))
+        )
+
+    def search_clause(self, term):
+        # backed by the ix_messages_text_fts GIN index in models.py
+        return func.to_tsvector(literal_column("'english'"), Message.text).op("@@")(
+            func.plainto_tsquery(literal_column("'english'"), term)
+        )
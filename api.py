@@ -0,0 +1,58 @@
+"""Token-authenticated JSON API for integration partners.
+
+Partners send `Authorization: Bearer <token>`, with a token issued by
+`flask issue-api-token <username> <name>` (stored hashed, see ApiToken).
+There's no session cookie involved, so these routes need no CSRF token.
+"""
+
+import click
+from flask import request
+from werkzeug.datastructures import MultiDict
+
+from forms import MessageForm
+from models import db, ApiToken, User
+
+
+def bearer_token():
+    """The bearer token sent with the request, or None."""
+
+    kind, _, token = request.headers.get("Authorization", "").partition(" ")
+    if kind.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def token_user():
+    """The active user the request's bearer token belongs to, or None."""
+
+    token = bearer_token()
+    return ApiToken.user_for(token) if token else None
+
+
+def validate_message(item):
+    """(text, None) if `item` passes MessageForm, else (None, errors)."""
+
+    if not isinstance(item, dict) or not isinstance(item.get("text"), str):
+        return None, {"text": ["Expected an object with a string 'text'."]}
+
+    form = MessageForm(formdata=MultiDict({"text": item["text"]}), meta={"csrf": False})
+    if not form.validate():
+        return None, form.errors
+    return form.text.data, None
+
+
+def init_app(app):
+    app.config.setdefault("API_MESSAGE_BATCH_MAX", 100)
+
+    @app.cli.command("issue-api-token")
+    @click.argument("username")
+    @click.argument("name")
+    def issue_api_token_command(username, name):
+        """Issue an API token acting as USERNAME, labelled NAME."""
+
+        user = User.active().filter_by(username=username).first()
+        if user is None:
+            raise click.ClickException(f"no active user {username!r}")
+        token = ApiToken.issue(user.id, name)
+        db.session.commit()
+        click.echo(token)
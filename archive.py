@@ -0,0 +1,161 @@
+"""Hot/cold tiering for messages and direct messages.
+
+Rows older than ARCHIVE_AFTER_DAYS are moved, in chunks, from `messages`,
+`likes` and `direct_messages` to their `*_archive` twins (see models.py), so
+the hot tables and their indexes only cover recent history. Reads that run
+out of hot rows fall back to the archive (`archive_fallback`).
+
+Run it with `flask archive-messages`, or enqueue an "archive_messages" job.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import text
+
+import metrics
+import snowflake
+from jobs import handler
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Message ids are snowflakes, so "older than" is a range on the primary key
+# (plus a timestamp check for rows that predate snowflake ids, which all sort
+# below the cutoff). Rows are copied before they are deleted, all in the
+# batch's transaction.
+MESSAGE_BATCH = [
+    """
+    INSERT INTO messages_archive (id, text, timestamp, user_id)
+    SELECT id, text, timestamp, user_id FROM messages WHERE id = ANY(:ids)
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    WITH moved AS (
+        DELETE FROM likes WHERE message_id = ANY(:ids)
+        RETURNING id, user_id, message_id
+    )
+    INSERT INTO likes_archive (id, user_id, message_id)
+    SELECT id, user_id, message_id FROM moved
+    ON CONFLICT DO NOTHING
+    """,
+    "DELETE FROM messages WHERE id = ANY(:ids)",
+]
+
+DIRECT_MESSAGE_BATCH = [
+    """
+    WITH moved AS (
+        DELETE FROM direct_messages WHERE id = ANY(:ids)
+        RETURNING id, text, timestamp, direct_message_thread, sender_id, sent_id
+    )
+    INSERT INTO direct_messages_archive
+        (id, text, timestamp, direct_message_thread, sender_id, sent_id)
+    SELECT id, text, timestamp, direct_message_thread, sender_id, sent_id
+    FROM moved
+    ON CONFLICT DO NOTHING
+    """,
+]
+
+
+def _move_in_batches(label, select_sql, batch_sql, params, batch_size):
+    """Move rows chosen by `select_sql` in batches; return how many moved.
+
+    Each batch locks its rows (SKIP LOCKED, so concurrent archivers split
+    the work) and commits on its own, so an interrupted run loses nothing
+    and the next run simply continues.
+    """
+
+    moved = 0
+    while True:
+        ids = [
+            row_id
+            for (row_id,) in db.session.execute(
+                text(select_sql), dict(params, batch=batch_size)
+            )
+        ]
+        if not ids:
+            break
+
+        for sql in batch_sql:
+            db.session.execute(text(sql), {"ids": ids})
+        db.session.commit()
+
+        moved += len(ids)
+        metrics.incr(f"archive.moved.{label}", len(ids))
+        if len(ids) < batch_size:
+            break
+
+    return moved
+
+
+def archive_old_rows(after_days, batch_size):
+    """Move messages and DMs older than `after_days` to the archive tables."""
+
+    cutoff = datetime.utcnow() - timedelta(days=after_days)
+
+    messages = _move_in_batches(
+        "messages",
+        "SELECT id FROM messages WHERE id < :cutoff_id AND timestamp < :cutoff "
+        "ORDER BY id LIMIT :batch FOR UPDATE SKIP LOCKED",
+        MESSAGE_BATCH,
+        {"cutoff_id": snowflake.id_at(cutoff), "cutoff": cutoff},
+        batch_size,
+    )
+    direct_messages = _move_in_batches(
+        "direct_messages",
+        "SELECT id FROM direct_messages WHERE timestamp < :cutoff "
+        "ORDER BY timestamp LIMIT :batch FOR UPDATE SKIP LOCKED",
+        DIRECT_MESSAGE_BATCH,
+        {"cutoff": cutoff},
+        batch_size,
+    )
+
+    logger.info(
+        "archived %d messages and %d direct messages older than %s",
+        messages,
+        direct_messages,
+        cutoff,
+    )
+    return messages, direct_messages
+
+
+def archive_fallback(hot_rows, limit, archive_query, key=lambda row: row.id):
+    """Top up a newest-first page of hot rows from the archive.
+
+    `archive_query(before_id, count)` returns up to `count` archived rows
+    older than `before_id` (None if the hot tier had no rows at all); `key`
+    gives a row's message id. Hot rows are always newer than archived ones,
+    so this is a plain append.
+    """
+
+    if len(hot_rows) >= limit:
+        return hot_rows
+
+    before_id = key(hot_rows[-1]) if hot_rows else None
+    return hot_rows + archive_query(before_id, limit - len(hot_rows))
+
+
+@handler("archive_messages")
+def archive_messages_job(payload):
+    archive_old_rows(
+        current_app.config["ARCHIVE_AFTER_DAYS"],
+        current_app.config["ARCHIVE_BATCH_SIZE"],
+    )
+
+
+def init_app(app):
+    app.config.setdefault("ARCHIVE_AFTER_DAYS", 365)
+    app.config.setdefault("ARCHIVE_BATCH_SIZE", 1000)
+
+    @app.cli.command("archive-messages")
+    @click.option("--after-days", type=int, default=None)
+    def archive_messages_command(after_days):
+        """Move old messages and DMs to the archive tables."""
+
+        messages, direct_messages = archive_old_rows(
+            after_days or app.config["ARCHIVE_AFTER_DAYS"],
+            app.config["ARCHIVE_BATCH_SIZE"],
+        )
+        click.echo(f"archived {messages} messages, {direct_messages} DMs")
@@ -0,0 +1,51 @@
+"""ASGI entry point for Warbler.
+
+Run with, e.g.:
+
+    uvicorn asgi:application --workers 2
+
+Flask 1.x has no async views, so each request still runs the normal sync
+view, but in a thread pool inside the event loop instead of tying up a whole
+worker process. A process blocked on a database round trip keeps serving
+other requests, so we get many more requests in flight for the same memory
+than the sync gunicorn workers give us.
+
+asgiref's WsgiToAsgi runs every request on its one thread-sensitive thread,
+so requests are run with sync_to_async(thread_sensitive=False) instead, in
+an executor of our own. ASGI_THREADS sets the size of that pool; keep it at
+or below DB_POOL_SIZE + DB_MAX_OVERFLOW or threads will just queue on the
+pool.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import create_app
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASGI_THREADS", 16)), thread_name_prefix="asgi"
+)
+
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    """One request, run in any thread of `executor`."""
+
+    # the plain method under asgiref's thread-sensitive wrapper
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+        thread_sensitive=False,
+        executor=executor,
+    )
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that runs requests concurrently, ASGI_THREADS at a time."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+application = ThreadPoolWsgiToAsgi(create_app())
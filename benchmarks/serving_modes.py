@@ -0,0 +1,173 @@
+"""Compare sync (gunicorn) and ASGI (uvicorn) serving under concurrent load.
+
+Both servers are started against the same database and sized to roughly the
+same resident memory, then hit with the same mix of the hot read routes.
+
+    python benchmarks/serving_modes.py --user-id 1 --message-id 1
+
+The database must already be seeded (see seed.py). Requires gunicorn and
+uvicorn on PATH.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    "sync": ["gunicorn", "app:create_app()", "--workers", "{workers}", "--bind", "{bind}"],
+    "asgi": [
+        "uvicorn",
+        "asgi:application",
+        "--workers",
+        "{workers}",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        "{port}",
+        "--log-level",
+        "warning",
+    ],
+}
+
+
+def process_tree_rss(pid):
+    """Sum resident memory (bytes) of `pid` and its children."""
+
+    pids = [pid]
+    out = subprocess.run(
+        ["pgrep", "-P", str(pid)], capture_output=True, text=True
+    ).stdout
+    pids += [int(child) for child in out.split()]
+
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/statm") as statm:
+                total += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/", timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+def run_load(base_url, paths, concurrency, duration):
+    """Hammer `paths` round-robin from `concurrency` threads; return latencies."""
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(offset):
+        i = offset
+        while time.time() < stop_at:
+            url = base_url + paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(url, timeout=30).read()
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [
+        threading.Thread(target=client, args=(n,)) for n in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0]
+
+
+def bench_mode(mode, args, port):
+    bind = f"127.0.0.1:{port}"
+    cmd = [
+        part.format(workers=args.workers[mode], bind=bind, port=port)
+        for part in MODES[mode]
+    ]
+    server = subprocess.Popen(cmd, cwd=ROOT, env=dict(os.environ))
+    base_url = f"http://{bind}"
+    try:
+        wait_until_up(base_url)
+        paths = [
+            "/",
+            f"/users/{args.user_id}",
+            f"/messages/{args.message_id}",
+        ]
+        run_load(base_url, paths, args.concurrency, 2)  # warm up
+        rss = process_tree_rss(server.pid)
+        latencies, errors = run_load(base_url, paths, args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "workers": args.workers[mode],
+        "rss_mb": rss / 2 ** 20,
+        "req_per_s": len(latencies) / args.duration,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--message-id", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=int, default=20)
+    parser.add_argument(
+        "--sync-workers",
+        type=int,
+        default=8,
+        help="gunicorn sync workers (one request in flight each)",
+    )
+    parser.add_argument(
+        "--asgi-workers",
+        type=int,
+        default=2,
+        help="uvicorn workers; pick so RSS matches the sync run",
+    )
+    args = parser.parse_args()
+    args.workers = {"sync": args.sync_workers, "asgi": args.asgi_workers}
+
+    results = [bench_mode("sync", args, 8101), bench_mode("asgi", args, 8102)]
+
+    print(
+        f"{'mode':<6}{'workers':>8}{'rss MB':>9}{'req/s':>9}"
+        f"{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['mode']:<6}{r['workers']:>8}{r['rss_mb']:>9.0f}{r['req_per_s']:>9.1f}"
+            f"{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Measure worker startup: import time, app creation and first request.
+
+Each configuration runs in fresh interpreters, since imports are cached
+after the first time:
+
+    python benchmarks/startup.py --runs 10
+
+The first request is an anonymous GET / (no database queries), so this
+measures the app's own cold-start cost. Configurations differ only in the
+optional extensions create_app() sets up.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIGS = {
+    "default": {},
+    "no-warmup": {"TEMPLATE_WARMUP": "0"},
+    "admin": {"ADMIN_ENABLED": "1"},
+    "admin+toolbar": {"ADMIN_ENABLED": "1", "DEBUG_TOOLBAR": "1"},
+}
+
+# Runs in the child interpreter; prints one JSON line of timings in seconds.
+PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get("/")
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "first_request": served - created,
+}))
+"""
+
+
+def probe(env):
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=ROOT,
+        env=dict(os.environ, **env),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'config':<15}{'import ms':>11}{'create ms':>11}{'1st req ms':>12}")
+    for name, env in CONFIGS.items():
+        runs = [probe(env) for _ in range(args.runs)]
+        medians = {
+            key: statistics.median(run[key] for run in runs) * 1000
+            for key in ("import", "create_app", "first_request")
+        }
+        print(
+            f"{name:<15}{medians['import']:>11.1f}{medians['create_app']:>11.1f}"
+            f"{medians['first_request']:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
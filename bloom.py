@@ -0,0 +1,208 @@
+"""Bloom filter of taken usernames and emails.
+
+Signup and profile edits used to find out a username or email was taken
+only from the IntegrityError at commit, after paying for a bcrypt hash.
+`taken()` checks this process's filter first: a miss means the name is
+free and costs no query at all; a hit is confirmed with one query on the
+unique indexes, since the filter has false positives
+(NAMES_FILTER_ERROR_RATE).
+
+The filter is built in a background thread the first time it's needed,
+streaming `users` in FETCH_SIZE rows, and rebuilt every
+NAMES_FILTER_REBUILD seconds (10 minutes by default). Until the first
+build finishes every check goes to the database. Users inserted or renamed through the ORM in this
+process are added as they're flushed. Bloom filters can't forget, so names
+freed by a purge or a rename stay "maybe taken" (one extra query) until the
+next rebuild.
+
+Each process has its own filter, so a name taken through another worker
+since the last rebuild can slip through; the unique constraints still
+reject it at commit, which is why callers keep their IntegrityError
+handling.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, or_, text
+
+import metrics
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 10000
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings."""
+
+    def __init__(self, capacity, error_rate):
+        # the optimal size and hash count for `capacity` items
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+def _keys(username=None, email=None):
+    # one filter holds both, so prefix them apart
+    keys = {}
+    if username:
+        keys["username"] = f"u:{username}"
+    if email:
+        keys["email"] = f"e:{email}"
+    return keys
+
+
+class TakenNames:
+    """This process's filter, with its background (re)builder."""
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.filter = None
+        # keys added while a rebuild is streaming, replayed into the new filter
+        self.added_during_build = None
+        self.builder_pid = None
+
+    def add(self, username, email):
+        keys = _keys(username, email).values()
+        with self.lock:
+            if self.filter is not None:
+                for key in keys:
+                    self.filter.add(key)
+            if self.added_during_build is not None:
+                self.added_during_build.extend(keys)
+
+    def might_exist(self, key):
+        """False only if `key` is certainly not taken."""
+
+        self._start_builder()
+        with self.lock:
+            return self.filter is None or key in self.filter
+
+    def build(self):
+        """Replace the filter with one built from `users`. Needs an app context."""
+
+        started = time.time()
+        with self.lock:
+            self.added_during_build = []
+
+        try:
+            with db.engine.connect() as connection:
+                count = connection.execute(text("SELECT COUNT(*) FROM users")).scalar()
+                capacity = max(
+                    self.app.config["NAMES_FILTER_MIN_CAPACITY"],
+                    # two keys a user, and room to grow until the next rebuild
+                    4 * count,
+                )
+                new = BloomFilter(capacity, self.app.config["NAMES_FILTER_ERROR_RATE"])
+                result = connection.execution_options(stream_results=True).execute(
+                    text("SELECT username, email FROM users")
+                )
+                while True:
+                    rows = result.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    for username, email in rows:
+                        for key in _keys(username, email).values():
+                            new.add(key)
+        finally:
+            with self.lock:
+                added, self.added_during_build = self.added_during_build, None
+
+        with self.lock:
+            for key in added:
+                new.add(key)
+            self.filter = new
+
+        metrics.set_gauge("names_filter.bytes", len(new.bits))
+        metrics.observe("names_filter.build_seconds", time.time() - started)
+        return count
+
+    def _start_builder(self):
+        # threads don't survive a fork, so start one per process
+        if self.builder_pid == os.getpid():
+            return
+        with self.lock:
+            if self.builder_pid == os.getpid():
+                return
+            self.builder_pid = os.getpid()
+            # a filter inherited from the parent misses its later adds
+            self.filter = None
+        threading.Thread(target=self._run, name="names-filter", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.build()
+            except Exception:
+                logger.exception("could not build the names filter")
+            time.sleep(self.app.config["NAMES_FILTER_REBUILD"])
+
+
+def taken(username=None, email=None):
+    """Which of `username` and `email` already belong to an account.
+
+    Returns "username", "email" or None. Accounts that are deleted but not
+    yet purged still hold their names.
+    """
+
+    names = current_app.extensions["names"]
+    keys = _keys(username, email)
+    maybe = [field for field, key in keys.items() if names.might_exist(key)]
+    if not maybe:
+        metrics.incr("names_filter.negative")
+        return None
+
+    conditions = {"username": User.username == username, "email": User.email == email}
+    row = (
+        db.session.query(User.username, User.email)
+        .filter(or_(*(conditions[field] for field in maybe)))
+        .first()
+    )
+    if row is None:
+        metrics.incr("names_filter.false_positive")
+        return None
+    return "username" if "username" in maybe and row.username == username else "email"
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def record_names(mapper, connection, user):
+    """Add a user's names to the filter as the row is written."""
+
+    names = current_app.extensions.get("names") if has_app_context() else None
+    if names is not None:
+        names.add(user.username, user.email)
+
+
+def init_app(app):
+    app.config.setdefault("NAMES_FILTER_ERROR_RATE", 0.01)
+    app.config.setdefault("NAMES_FILTER_MIN_CAPACITY", 100000)
+    app.config.setdefault("NAMES_FILTER_REBUILD", 600)
+
+    app.extensions["names"] = TakenNames(app)
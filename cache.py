@@ -0,0 +1,309 @@
+"""Read-through cache for hot read-only pages.
+
+`cached(key, compute)` returns the cached value for `key`, or calls
+`compute()`, stores the result and returns it. Entries expire after
+CACHE_TTL seconds and the least recently used ones are evicted beyond
+CACHE_MAX_ENTRIES. Routes that change cached data call `invalidate()`.
+
+When a popular key is cold, only one caller computes it: callers in the
+same process wait on a per-key lock, and callers in other processes (with
+the SQLite backend) wait for the holder's lease, then read its result.
+
+Values are stored as JSON (see `dumps`), so cache plain data: dicts,
+lists, strings, numbers, datetimes and `as_namespace()` copies of model
+rows, never ORM instances bound to a session.
+
+Entries live in a small SQLite file in RUNTIME_DIR by default (see
+runtime.py), so every gunicorn worker on the host shares them. "memory://"
+keeps them in-process instead.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from types import SimpleNamespace
+
+from flask import current_app
+
+import metrics
+from runtime import check_private_file, runtime_path
+
+MISS = object()
+
+# a hit refreshes an entry's LRU position at most this often, so reads of
+# a hot key aren't all writes
+TOUCH_INTERVAL = 10
+
+
+def _encode(value):
+    if isinstance(value, SimpleNamespace):
+        return {"__namespace__": vars(value)}
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"can't cache a {type(value).__name__}")
+
+
+def _decode(obj):
+    if "__namespace__" in obj:
+        return SimpleNamespace(**obj["__namespace__"])
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def dumps(value):
+    return json.dumps(value, default=_encode)
+
+
+def loads(data):
+    return json.loads(data, object_hook=_decode)
+
+
+class MemoryBackend:
+    """An LRU dict of (expires, value); entries are per process."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISS
+            expires, value = entry
+            if expires < time.time():
+                del self.entries[key]
+                return MISS
+            self.entries.move_to_end(key)
+            return loads(value)
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, dumps(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def acquire(self, key, timeout):
+        # the per-key lock in Cache already serialises this process
+        return True
+
+    def release(self, key):
+        pass
+
+
+class SQLiteBackend:
+    """Entries in a SQLite file shared by every process on the host."""
+
+    def __init__(self, path, max_entries):
+        self.path = check_private_file(path)
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+
+    def _connection(self):
+        # connections can't cross a fork, so key them by pid as well
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                "value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL)"
+            )
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires, used FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < now:
+            return MISS
+        value, _, used = row
+        if now - used > TOUCH_INTERVAL:
+            conn.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        try:
+            return loads(value)
+        except ValueError:
+            # written in an older format; the next set replaces it
+            return MISS
+
+    def set(self, key, value, ttl):
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires, used) "
+            "VALUES (?, ?, ?, ?)",
+            (key, dumps(value), now + ttl, now),
+        )
+        # trim now and then rather than counting rows on every write
+        self.writes += 1
+        if self.writes % 100 == 0:
+            conn.execute("DELETE FROM entries WHERE expires < ?", (now,))
+            conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                "ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, keys):
+        conn = self._connection()
+        conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+
+    def acquire(self, key, timeout):
+        """Take the cross-process lease on computing `key`, if it's free."""
+
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM leases WHERE key = ? AND expires < ?", (key, now))
+            taken = conn.execute(
+                "INSERT OR IGNORE INTO leases (key, expires) VALUES (?, ?)",
+                (key, now + timeout),
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return bool(taken)
+
+    def release(self, key):
+        self._connection().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+
+def make_backend(uri, max_entries):
+    if uri == "memory://":
+        return MemoryBackend(max_entries)
+    return SQLiteBackend(uri, max_entries)
+
+
+class Cache:
+    """Read-through cache over a backend, with request coalescing."""
+
+    def __init__(self, backend, ttl, lock_timeout):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.locks_lock = threading.Lock()
+        self.locks = {}
+
+    def _key_lock(self, key):
+        with self.locks_lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = self.locks[key] = [threading.Lock(), 0]
+            lock[1] += 1
+            return lock
+
+    def _drop_key_lock(self, key, lock):
+        with self.locks_lock:
+            lock[1] -= 1
+            if not lock[1]:
+                del self.locks[key]
+
+    def get_or_compute(self, key, compute, ttl=None):
+        value = self.backend.get(key)
+        if value is not MISS:
+            metrics.incr("cache.hit")
+            return value
+
+        lock = self._key_lock(key)
+        try:
+            with lock[0]:
+                # another thread may have filled it while we waited
+                value = self.backend.get(key)
+                if value is not MISS:
+                    metrics.incr("cache.coalesced")
+                    return value
+
+                value, leased = self._wait_for_lease(key)
+                if value is not MISS:
+                    return value
+
+                metrics.incr("cache.miss")
+                try:
+                    value = compute()
+                    self.backend.set(key, value, ttl or self.ttl)
+                finally:
+                    if leased:
+                        self.backend.release(key)
+                return value
+        finally:
+            self._drop_key_lock(key, lock)
+
+    def _wait_for_lease(self, key):
+        """Wait while another process holds the lease on computing `key`.
+
+        Returns (its result, False) if it finished in time, else (MISS,
+        whether this process now holds the lease) and the caller computes.
+        """
+
+        deadline = time.time() + self.lock_timeout
+        while not self.backend.acquire(key, self.lock_timeout):
+            value = self.backend.get(key)
+            if value is not MISS:
+                metrics.incr("cache.coalesced")
+                return value, False
+            if time.time() > deadline:
+                return MISS, False
+            time.sleep(0.01)
+        return MISS, True
+
+    def invalidate(self, *keys):
+        self.backend.delete(keys)
+
+
+def as_namespace(row, *fields):
+    """A cacheable copy of `fields` of a model instance or result row."""
+
+    return SimpleNamespace(**{field: getattr(row, field) for field in fields})
+
+
+def cached(key, compute, ttl=None):
+    """The value for `key`, computing and storing it on a miss."""
+
+    if not current_app.config["CACHE_ENABLED"]:
+        return compute()
+    return current_app.extensions["cache"].get_or_compute(key, compute, ttl)
+
+
+def invalidate(*keys):
+    """Drop `keys`; the next read recomputes them."""
+
+    if current_app.config["CACHE_ENABLED"]:
+        current_app.extensions["cache"].invalidate(*keys)
+
+
+def init_app(app):
+    app.config.setdefault("CACHE_ENABLED", True)
+    app.config.setdefault("CACHE_TTL", 30)
+    app.config.setdefault("CACHE_MAX_ENTRIES", 10000)
+    app.config.setdefault("CACHE_LOCK_TIMEOUT", 5)
+    app.config.setdefault("CACHE_STORAGE", runtime_path(app, "cache.sqlite3"))
+    app.extensions["cache"] = Cache(
+        make_backend(app.config["CACHE_STORAGE"], app.config["CACHE_MAX_ENTRIES"]),
+        app.config["CACHE_TTL"],
+        app.config["CACHE_LOCK_TIMEOUT"],
+    )
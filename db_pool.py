@@ -0,0 +1,129 @@
+"""Connection pool configuration and instrumentation.
+
+Engine options come from app config (which reads them from the environment),
+so pool sizing can be tuned per deployment without code changes.
+"""
+
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+import metrics
+
+
+class _TimedCheckoutMixin:
+    """Time how long callers wait for a connection from the pool."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe("db.pool.checkout_wait", time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(_TimedCheckoutMixin, QueuePool):
+    """QueuePool that reports checkout wait time."""
+
+
+class InstrumentedNullPool(_TimedCheckoutMixin, NullPool):
+    """NullPool (used behind PgBouncer) that reports connect wait time."""
+
+
+def engine_options(config):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from app config.
+
+    Recognised keys:
+    - DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+    - DB_POOL_PRE_PING
+    - DB_STATEMENT_TIMEOUT_MS: default statement timeout (0 = none)
+    - DB_PGBOUNCER: running behind PgBouncer in transaction mode; PgBouncer
+      does the pooling, so we hold no idle connections and can't pass
+      startup options (statement_timeout is set per transaction instead)
+    """
+
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "postgresql":
+        return {}
+
+    if config["DB_PGBOUNCER"]:
+        return {"poolclass": InstrumentedNullPool}
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+    if config["DB_STATEMENT_TIMEOUT_MS"]:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"
+        }
+
+    return options
+
+
+def init_pool_metrics(app):
+    """Hook pool events and per-route statement timeouts into `app`."""
+
+    @app.before_request
+    def set_route_statement_timeout():
+        """Pick up a @statement_timeout override for the matched view."""
+
+        view = app.view_functions.get(request.endpoint)
+        timeout = getattr(view, "statement_timeout_ms", None)
+        if timeout is None and app.config["DB_PGBOUNCER"]:
+            timeout = app.config["DB_STATEMENT_TIMEOUT_MS"] or None
+        g.statement_timeout_ms = timeout
+
+
+@event.listens_for(SignallingSession, "after_begin")
+def apply_statement_timeout(session, transaction, connection):
+    """SET LOCAL the request's statement timeout on each new transaction.
+
+    SET LOCAL only lasts until commit/rollback, so it is safe under PgBouncer
+    transaction pooling and never leaks to the next user of the connection.
+    """
+
+    if not has_request_context() or connection.dialect.name != "postgresql":
+        return
+    timeout = g.get("statement_timeout_ms")
+    if timeout:
+        connection.execute(text(f"SET LOCAL statement_timeout = {int(timeout)}"))
+
+
+@event.listens_for(Pool, "connect")
+def count_connect(dbapi_connection, connection_record):
+    metrics.incr("db.pool.connects")
+
+
+@event.listens_for(Pool, "close")
+def count_close(dbapi_connection, connection_record):
+    metrics.incr("db.pool.closes")
+
+
+@event.listens_for(Pool, "invalidate")
+def count_invalidate(dbapi_connection, connection_record, exception):
+    metrics.incr("db.pool.invalidations")
+
+
+@event.listens_for(Pool, "checkout")
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.incr("db.pool.checkouts")
+
+
+def sample_pool(engine):
+    """Set the pool gauges from the pool's own counts; call before reporting."""
+
+    pool = engine.pool
+    # NullPool (PgBouncer) keeps no counts
+    if isinstance(pool, QueuePool):
+        metrics.set_gauge("db.pool.checked_out_now", pool.checkedout())
+        metrics.set_gauge("db.pool.overflow", pool.overflow())
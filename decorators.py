@@ -7,9 +7,20 @@ def login_required(context):
                 return func(*args, **kwargs)
             elif context == 'logout':
                 flash("You aren't currently logged in")
-                return redirect(url_for('login'))
+                return redirect(url_for('warbler.login'))
             elif context == 'user_details':
                 flash("Access unauthorized.", "danger")
-                return redirect(url_for('login'))
+                return redirect(url_for('warbler.login'))
         return wrap
-    return login_wrapper
\ No newline at end of file
+    return login_wrapper
+
+def statement_timeout(ms):
+    """Override the database statement_timeout (in ms) for one route.
+
+    Must sit directly under @bp.route so the attribute lands on the
+    registered view function.
+    """
+    def timeout_wrapper(func):
+        func.statement_timeout_ms = ms
+        return func
+    return timeout_wrapper
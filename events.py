@@ -0,0 +1,295 @@
+"""Live updates over Server-Sent Events.
+
+Routes publish small events after they commit:
+
+- "message" on feed:<author id> when a warble is posted
+- "likes" on feed:<author id> when one of the author's messages is liked
+  or unliked
+- "direct_message" on dm:<recipient id> when a DM is sent
+
+Events carry ids and counts, never message text or markup: the page
+fetches what it shows from the app (views.feed_item,
+views.direct_message_json), which checks who's asking.
+
+GET /events streams them to a logged-in user for the channels their home
+feed and inbox are built from (see views.events_stream), and static/app.js
+merges them into the page.
+
+Each process has a `Bus`: an in-process pub/sub of bounded per-connection
+queues. Events published in another worker reach it through the broker:
+
+- "memory://": in-process only (a single worker, or tests)
+- a SQLite file path (the default is in RUNTIME_DIR, see runtime.py):
+  publishers append to an `events` table, and each process that has
+  subscribers runs one relay thread that polls it every
+  EVENTS_POLL_INTERVAL seconds. Publishers prune events older than
+  EVENTS_RETENTION as they go. This is a local stand-in for a real broker:
+  it only fans out across the workers of one host.
+
+Slow clients never hold up publishers. A connection whose queue
+(EVENTS_QUEUE_SIZE) fills up is dropped from the bus and sent a "resync"
+event, so the page reloads once. Each process streams at most
+EVENTS_MAX_CONNECTIONS connections, because every stream holds a server
+thread; keep it well below ASGI_THREADS (asgi.py).
+
+EVENTS_ENABLED is off by default: under sync workers (plain gunicorn) each
+open stream holds a whole worker, so a few open home pages would take the
+site down. Turn it on only when serving through asgi.py or another threaded
+server.
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from itertools import count
+
+from flask import current_app
+
+import metrics
+from runtime import check_private_file, runtime_path
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyConnections(Exception):
+    """This process is already streaming EVENTS_MAX_CONNECTIONS connections."""
+
+
+class Subscription:
+    """One connection's queue of (id, name, data) events."""
+
+    def __init__(self, bus, channels, queue_size):
+        self.bus = bus
+        self.channels = channels
+        self.queue = queue.Queue(queue_size)
+        self.overflowed = False
+
+    def get(self, timeout):
+        """The next event, or None if there wasn't one within `timeout`."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class Bus:
+    """In-process fan-out from channels to subscriptions."""
+
+    def __init__(self, max_connections, queue_size):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.channels = defaultdict(set)
+        self.subscriptions = set()
+
+    def subscribe(self, channels):
+        with self.lock:
+            if len(self.subscriptions) >= self.max_connections:
+                raise TooManyConnections()
+            subscription = Subscription(self, list(channels), self.queue_size)
+            self.subscriptions.add(subscription)
+            for channel in subscription.channels:
+                self.channels[channel].add(subscription)
+            metrics.set_gauge("events.connections", len(self.subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            for channel in subscription.channels:
+                subscribers = self.channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.channels[channel]
+            metrics.set_gauge("events.connections", len(self.subscriptions))
+
+    def deliver(self, channel, event):
+        """Queue `event` for the channel's subscribers, dropping any that are full."""
+
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+                metrics.incr("events.overflowed")
+
+    def has_subscribers(self):
+        return bool(self.subscriptions)
+
+
+class MemoryBroker:
+    """Publishes straight to this process's bus."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.ids = count(1)
+
+    def publish(self, channel, name, data):
+        self.bus.deliver(channel, (next(self.ids), name, data))
+
+    def subscribe(self, channels):
+        return self.bus.subscribe(channels)
+
+
+class SQLiteBroker:
+    """Publishes through a SQLite table that every process on the host polls."""
+
+    # prune expired events every this many publishes
+    PRUNE_EVERY = 100
+
+    def __init__(self, bus, path, poll_interval, retention):
+        self.bus = bus
+        self.path = check_private_file(path)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.local = threading.local()
+        self.relay_lock = threading.Lock()
+        self.relay_pid = None
+        self.publishes = count(1)
+
+    def _connection(self):
+        # connections can't cross a fork, so key them by pid as well
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, channel TEXT NOT NULL, name TEXT NOT NULL, "
+                "data TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def publish(self, channel, name, data):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO events (channel, name, data, created) VALUES (?, ?, ?, ?)",
+            (channel, name, json.dumps(data), now),
+        )
+        # the relay only runs where someone is subscribed, so the table is
+        # kept small here
+        if next(self.publishes) % self.PRUNE_EVERY == 0:
+            conn.execute(
+                "DELETE FROM events WHERE created < ?", (now - self.retention,)
+            )
+
+    def subscribe(self, channels):
+        subscription = self.bus.subscribe(channels)
+        self._start_relay()
+        return subscription
+
+    def _start_relay(self):
+        with self.relay_lock:
+            if self.relay_pid == os.getpid():
+                return
+            self.relay_pid = os.getpid()
+            threading.Thread(target=self._relay, name="events-relay", daemon=True).start()
+
+    def _latest_id(self):
+        row = self._connection().execute("SELECT MAX(id) FROM events").fetchone()
+        return row[0] or 0
+
+    def _relay(self):
+        # only events published from now on
+        last_id = self._latest_id()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                last_id = self.relay_once(last_id)
+            except sqlite3.Error:
+                logger.exception("events relay failed")
+
+    def relay_once(self, last_id):
+        """Deliver events after `last_id` to the bus; returns the new last id."""
+
+        if not self.bus.has_subscribers():
+            return self._latest_id()
+        rows = self._connection().execute(
+            "SELECT id, channel, name, data FROM events WHERE id > ? ORDER BY id",
+            (last_id,),
+        )
+        for event_id, channel, name, data in rows.fetchall():
+            self.bus.deliver(channel, (event_id, name, json.loads(data)))
+            last_id = event_id
+        return last_id
+
+
+def make_broker(uri, bus, poll_interval=0.5, retention=60):
+    if uri == "memory://":
+        return MemoryBroker(bus)
+    return SQLiteBroker(bus, uri, poll_interval, retention)
+
+
+def publish(channel, name, data):
+    """Send an event to `channel`'s subscribers in every worker.
+
+    Call after the change is committed. A broker failure is logged, never
+    raised: live updates are best effort, and a reload always catches up.
+    """
+
+    if not current_app.config["EVENTS_ENABLED"]:
+        return
+    try:
+        current_app.extensions["events"].publish(channel, name, data)
+        metrics.incr("events.published")
+    except Exception:
+        logger.exception("could not publish %s event on %s", name, channel)
+
+
+def format_event(event_id, name, data):
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(subscription, heartbeat):
+    """SSE text for a subscription, until the client goes away or overflows."""
+
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            if subscription.overflowed:
+                yield format_event(0, "resync", {})
+                return
+            event = subscription.get(heartbeat)
+            if event is None:
+                # keeps proxies from timing out the connection, and finds
+                # clients that have gone away
+                yield ": keepalive\n\n"
+            else:
+                yield format_event(*event)
+    finally:
+        subscription.close()
+
+
+def init_app(app):
+    app.config.setdefault("EVENTS_ENABLED", False)
+    app.config.setdefault("EVENTS_STORAGE", runtime_path(app, "events.sqlite3"))
+    app.config.setdefault("EVENTS_MAX_CONNECTIONS", 8)
+    app.config.setdefault("EVENTS_QUEUE_SIZE", 100)
+    app.config.setdefault("EVENTS_HEARTBEAT", 15)
+    app.config.setdefault("EVENTS_POLL_INTERVAL", 0.5)
+    app.config.setdefault("EVENTS_RETENTION", 60)
+
+    bus = Bus(app.config["EVENTS_MAX_CONNECTIONS"], app.config["EVENTS_QUEUE_SIZE"])
+    app.extensions["events"] = make_broker(
+        app.config["EVENTS_STORAGE"],
+        bus,
+        app.config["EVENTS_POLL_INTERVAL"],
+        app.config["EVENTS_RETENTION"],
+    )
@@ -0,0 +1,335 @@
+"""Memory-mapped CSR snapshot of the follow graph.
+
+The snapshot is two compressed-sparse-row adjacency structures, "following"
+(follower -> followed) and "followers" (followed -> follower), indexed
+directly by user id:
+
+    <dir>/<version>/following_indptr.npy   int64, max user id + 2
+    <dir>/<version>/following_indices.npy  int32, sorted within each row
+    <dir>/<version>/followers_indptr.npy
+    <dir>/<version>/followers_indices.npy
+    <dir>/<version>/meta.json              highest follow_changes id applied
+    <dir>/CURRENT                          name of the live version
+
+Readers np.load(..., mmap_mode="r") the arrays, so every worker on a host
+shares one copy through the page cache and opening a snapshot copies
+nothing. A user's neighbours are a slice of `indices`, degree is a
+subtraction on `indptr`, and membership and intersections work on sorted
+int32 arrays.
+
+The periodic "follow_graph_rebuild" job applies the follow_changes log to
+the live snapshot. Only a full rebuild (the first one, or `flask
+build-follow-graph --full`) reads the whole `follows` table. It writes a
+new version and then swaps CURRENT. Readers pick up the new version within
+FOLLOW_GRAPH_RELOAD seconds, and old mappings stay valid until they're
+dropped.
+
+The snapshot trails the database by up to FOLLOW_GRAPH_INTERVAL seconds.
+Use it for stats, batch jobs and read-mostly views, not to confirm a
+follow that was just made.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from sqlalchemy import text
+
+import metrics
+from jobs import handler, periodic
+from models import db, FollowChange
+from runtime import ensure_private_dir, runtime_path
+
+KEEP_VERSIONS = 2
+FETCH_SIZE = 100000
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+
+class FollowGraph:
+    """A read-only, memory-mapped snapshot version."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in (
+                "following_indptr",
+                "following_indices",
+                "followers_indptr",
+                "followers_indices",
+            )
+        }
+
+    @property
+    def last_change_id(self):
+        return self.meta["last_change_id"]
+
+    @property
+    def edge_count(self):
+        return len(self.arrays["following_indices"])
+
+    def _row(self, direction, user_id):
+        indptr = self.arrays[f"{direction}_indptr"]
+        if not 0 <= user_id < len(indptr) - 1:
+            return EMPTY
+        return self.arrays[f"{direction}_indices"][indptr[user_id] : indptr[user_id + 1]]
+
+    def following(self, user_id):
+        """Ids `user_id` follows, ascending (a zero-copy view)."""
+
+        return self._row("following", user_id)
+
+    def followers(self, user_id):
+        """Ids following `user_id`, ascending (a zero-copy view)."""
+
+        return self._row("followers", user_id)
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def follower_count(self, user_id):
+        return len(self.followers(user_id))
+
+    def is_following(self, follower_id, followed_id):
+        row = self.following(follower_id)
+        i = np.searchsorted(row, followed_id)
+        return bool(i < len(row) and row[i] == followed_id)
+
+    def common_following(self, user_id, other_id):
+        """Ids both users follow, ascending."""
+
+        return np.intersect1d(
+            self.following(user_id), self.following(other_id), assume_unique=True
+        )
+
+    def mutuals(self, user_id):
+        """Ids that `user_id` follows and that follow them back."""
+
+        return np.intersect1d(
+            self.following(user_id), self.followers(user_id), assume_unique=True
+        )
+
+    def edges(self):
+        """(followers, followed) int64 arrays of every edge."""
+
+        indptr = self.arrays["following_indptr"]
+        followers = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+        return followers, np.asarray(self.arrays["following_indices"], dtype=np.int64)
+
+
+##############################################################################
+# Building
+
+
+def _csr(rows, cols, size):
+    """indptr/indices for edges (rows[i] -> cols[i]) over ids 0..size-1."""
+
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32)
+
+
+def _edge_keys(followers, followed):
+    return (followers.astype(np.int64) << 32) | followed.astype(np.int64)
+
+
+def apply_changes(followers, followed, changes):
+    """The edge list after applying (follower, followed, op) changes in order.
+
+    Only each edge's last change counts, so replaying changes the snapshot
+    already contains is harmless.
+    """
+
+    if not len(changes):
+        return followers, followed
+
+    changes = np.asarray(changes, dtype=np.int64).reshape(-1, 3)
+    keys = _edge_keys(changes[:, 0], changes[:, 1])
+    # last occurrence of each key: unique over the reversed array
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    final_keys, final_ops = keys[last], changes[last, 2]
+
+    current = _edge_keys(followers, followed)
+    kept = current[~np.isin(current, final_keys[final_ops == FollowChange.UNFOLLOW])]
+    merged = np.union1d(kept, final_keys[final_ops == FollowChange.FOLLOW])
+    return merged >> 32, merged & 0xFFFFFFFF
+
+
+def write_snapshot(directory, followers, followed, last_change_id):
+    """Write a new version and make it CURRENT; returns its path."""
+
+    size = int(max(followers.max(initial=0), followed.max(initial=0))) + 1
+    version = f"{time.time_ns()}-{last_change_id}"
+    path = os.path.join(directory, version)
+    tmp = tempfile.mkdtemp(dir=directory, prefix=".building-")
+
+    for direction, rows, cols in (
+        ("following", followers, followed),
+        ("followers", followed, followers),
+    ):
+        indptr, indices = _csr(rows, cols, size)
+        np.save(os.path.join(tmp, f"{direction}_indptr.npy"), indptr)
+        np.save(os.path.join(tmp, f"{direction}_indices.npy"), indices)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({"last_change_id": last_change_id, "edges": len(followers)}, f)
+    os.rename(tmp, path)
+
+    pointer = os.path.join(directory, "CURRENT.tmp")
+    with open(pointer, "w") as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(directory, "CURRENT"))
+
+    # readers still mapping an old version keep their (unlinked) files
+    versions = sorted(
+        (name for name in os.listdir(directory) if name[0].isdigit()),
+        key=lambda name: int(name.split("-")[0]),
+    )
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return path
+
+
+def _fetch_arrays(result, columns):
+    chunks = []
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64).reshape(-1, columns))
+    if not chunks:
+        return np.empty((0, columns), dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def rebuild(directory, full=False):
+    """Bring the snapshot up to date; returns the new FollowGraph."""
+
+    start = time.perf_counter()
+    ensure_private_dir(directory)
+    graph = open_current(directory)
+    connection = db.session.connection().execution_options(stream_results=True)
+
+    # Ids aren't committed in order, so a change with a lower id than one
+    # already applied can still turn up. Nothing goes by an id watermark:
+    # every rebuild reads whatever is in the log and deletes exactly the
+    # rows it read.
+    if graph is None or full:
+        # read before `follows`, so all of these are in it; a change that
+        # commits in between is in both and gets replayed, harmlessly
+        change_ids = _fetch_arrays(
+            connection.execute(text("SELECT id FROM follow_changes")), 1
+        )[:, 0]
+        edges = _fetch_arrays(
+            connection.execute(
+                text("SELECT user_following_id, user_being_followed_id FROM follows")
+            ),
+            2,
+        )
+        followers, followed = edges[:, 0], edges[:, 1]
+    else:
+        changes = _fetch_arrays(
+            connection.execute(
+                text(
+                    "SELECT id, follower_id, followed_id, op FROM follow_changes "
+                    "ORDER BY id"
+                )
+            ),
+            4,
+        )
+        if not len(changes):
+            db.session.commit()
+            return graph
+        change_ids = changes[:, 0]
+        followers, followed = apply_changes(*graph.edges(), changes[:, 1:])
+
+    last_change_id = int(change_ids.max(initial=graph.last_change_id if graph else 0))
+    path = write_snapshot(directory, followers, followed, last_change_id)
+
+    # every snapshot from now on includes these
+    for i in range(0, len(change_ids), FETCH_SIZE):
+        db.session.execute(
+            FollowChange.__table__.delete().where(
+                FollowChange.id.in_(change_ids[i : i + FETCH_SIZE].tolist())
+            )
+        )
+    db.session.commit()
+
+    metrics.observe("follow_graph.rebuild", time.perf_counter() - start)
+    metrics.set_gauge("follow_graph.edges", len(followers))
+    return FollowGraph(path)
+
+
+##############################################################################
+# Reading
+
+
+def current_version(directory):
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def open_current(directory):
+    """The FollowGraph that CURRENT points to, or None if there isn't one."""
+
+    version = current_version(directory)
+    return FollowGraph(os.path.join(directory, version)) if version else None
+
+
+_lock = threading.Lock()
+_graph = None
+_checked_at = 0
+
+
+def current():
+    """This process's view of the live snapshot (None before the first build).
+
+    Rechecks CURRENT at most every FOLLOW_GRAPH_RELOAD seconds.
+    """
+
+    global _graph, _checked_at
+
+    directory = current_app.config["FOLLOW_GRAPH_DIR"]
+    if time.time() - _checked_at > current_app.config["FOLLOW_GRAPH_RELOAD"]:
+        with _lock:
+            version = current_version(directory)
+            if version is None:
+                _graph = None
+            elif _graph is None or os.path.basename(_graph.path) != version:
+                _graph = FollowGraph(os.path.join(directory, version))
+            _checked_at = time.time()
+    return _graph
+
+
+@handler("follow_graph_rebuild")
+def rebuild_job(payload):
+    rebuild(current_app.config["FOLLOW_GRAPH_DIR"], full=payload.get("full", False))
+
+
+def init_app(app):
+    app.config.setdefault("FOLLOW_GRAPH_DIR", runtime_path(app, "follow-graph"))
+    app.config.setdefault("FOLLOW_GRAPH_INTERVAL", 60)
+    app.config.setdefault("FOLLOW_GRAPH_RELOAD", 10)
+
+    periodic("follow_graph_rebuild", app.config["FOLLOW_GRAPH_INTERVAL"])
+
+    @app.cli.command("build-follow-graph")
+    @click.option("--full", is_flag=True, help="Reread the whole follows table.")
+    def build_follow_graph_command(full):
+        """Bring the follow graph snapshot up to date."""
+
+        graph = rebuild(app.config["FOLLOW_GRAPH_DIR"], full=full)
+        click.echo(f"follow graph: {graph.edge_count} edges at {graph.path}")
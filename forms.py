@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
@@ -6,7 +7,8 @@ from wtforms.validators import DataRequired, Email, Length
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
-    text = TextAreaField("text", validators=[DataRequired()])
+    # messages.text is a VARCHAR(140)
+    text = TextAreaField("text", validators=[DataRequired(), Length(max=140)])
 
 
 class UserAddForm(FlaskForm):
@@ -59,7 +61,9 @@ class ProfileEditForm(FlaskForm):
     username = StringField("Username")
     email = StringField("E-mail")
     image_url = StringField("Image URL")
+    image = FileField("Upload an image")
     header_image_url = StringField("Header Image URL")
+    header_image = FileField("Upload a header image")
     bio = TextAreaField("Bio")
     password = PasswordField(
         "Password required to confirm changes", validators=[Length(min=6)]
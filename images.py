@@ -0,0 +1,291 @@
+"""Uploaded avatars and header images, served as fixed-size variants.
+
+Uploads are stored on local disk under IMAGES_DIR, named by a hash of
+their content:
+
+    <IMAGES_DIR>/originals/<digest>
+    <IMAGES_DIR>/variants/<digest>-<variant>.<webp|jpg>
+
+and the user's image_url/header_image_url becomes "/images/<digest>". A
+URL never changes meaning, so every image response is cached by browsers
+and proxies for a year ("immutable").
+
+Originals are never served: they keep whatever metadata the camera wrote,
+GPS position included. Only variants are, and they're re-encoded without
+any. The `image_variant` filter maps a local image URL to the variant
+sized for where it's shown (VARIANTS, at 2x for high-DPI screens), as WebP
+when the browser accepts it and JPEG otherwise, so pages that use it are
+sent with "Vary: Accept". External URLs and the default images pass
+through unchanged.
+
+Uploads over IMAGES_MAX_PIXELS are refused before anything decodes them,
+whatever their size in bytes.
+
+Resizing is CPU-bound, so it runs in a process pool (IMAGES_WORKERS per
+web process). The pool's processes are spawned, not forked: web processes
+run threads (job workers, the like flusher), and a fork can copy a lock
+one of them holds. Every variant is rendered as soon as an image is
+uploaded, from one decode of the original, and a variant that's requested
+before it's ready is rendered on demand, once, however many requests are
+waiting on it.
+"""
+
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import g, has_request_context, request
+from PIL import Image, ImageOps
+
+# name: (width, height, crop). Cropped variants fill the box exactly;
+# the others fit inside it and keep their aspect ratio.
+VARIANTS = {
+    # .timeline-image (48px), DM and navbar avatars
+    "thumb": (96, 96, True),
+    # .card-image (70px)
+    "card": (140, 140, True),
+    # #profile-avatar (200px)
+    "profile": (400, 400, True),
+    # .card-hero, the width of a user card
+    "header": (600, 600, False),
+}
+
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+
+ALLOWED_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+
+QUALITY = 82
+
+LOCAL_URL = re.compile(r"^/images/([0-9a-f]{32})$")
+DIGEST = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ImageError(ValueError):
+    """An upload that isn't an image we accept."""
+
+
+def original_path(directory, digest):
+    return os.path.join(directory, "originals", digest)
+
+
+def variant_path(directory, digest, variant, fmt):
+    return os.path.join(directory, "variants", f"{digest}-{variant}.{fmt}")
+
+
+def _write_atomic(path, write):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _decode(directory, digest):
+    """The original, upright and in RGB."""
+
+    with Image.open(original_path(directory, digest)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG has no alpha: put transparent areas on white
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+    return image
+
+
+def _write_variant(image, path, variant, fmt):
+    width, height, crop = VARIANTS[variant]
+    if crop:
+        resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        # thumbnail() works in place, and `image` is shared by the variants
+        resized = image.copy()
+        resized.thumbnail((width, height), Image.LANCZOS)
+
+    pil_format, _ = FORMATS[fmt]
+    # no exif= or icc_profile=, so none of the original's metadata is kept
+    _write_atomic(
+        path, lambda f: resized.save(f, pil_format, quality=QUALITY, optimize=True)
+    )
+    return path
+
+
+def render_variant(directory, digest, variant, fmt):
+    """Write one variant of an original (runs in the pool); returns its path."""
+
+    path = variant_path(directory, digest, variant, fmt)
+    if os.path.exists(path):
+        return path
+    return _write_variant(_decode(directory, digest), path, variant, fmt)
+
+
+def render_all(directory, digest):
+    """Write every missing variant, decoding the original once."""
+
+    image = None
+    paths = []
+    for variant in VARIANTS:
+        for fmt in FORMATS:
+            path = variant_path(directory, digest, variant, fmt)
+            if not os.path.exists(path):
+                if image is None:
+                    image = _decode(directory, digest)
+                _write_variant(image, path, variant, fmt)
+            paths.append(path)
+    return paths
+
+
+class ImageStore:
+    """Uploads on disk, plus the pool that renders their variants."""
+
+    def __init__(self, directory, workers, max_bytes, max_pixels):
+        self.directory = directory
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.rendering = {}
+        for sub in ("originals", "variants"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    def _submit(self, func, *args):
+        """Run func(*args) in the pool; inline when IMAGES_WORKERS is 0."""
+
+        if not self.workers:
+            return _Done(func(*args))
+        # pools don't survive a fork, so make one per process
+        with self.pool_lock:
+            if self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                self.pool_pid = os.getpid()
+        return self.pool.submit(func, *args)
+
+    def save(self, stream):
+        """Store an uploaded file; returns its "/images/<digest>" URL.
+
+        Raises ImageError if it's too big (in bytes or pixels) or not a
+        JPEG, PNG, GIF or WebP.
+        """
+
+        data = stream.read(self.max_bytes + 1)
+        if len(data) > self.max_bytes:
+            raise ImageError(f"Images must be at most {self.max_bytes // 2**20} MB.")
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.format not in ALLOWED_FORMATS:
+                    raise ImageError("Upload a JPEG, PNG, GIF or WebP image.")
+                # from the header: nothing has been decoded yet
+                if image.width * image.height > self.max_pixels:
+                    raise ImageError(
+                        f"Images must be at most {self.max_pixels // 10**6} megapixels."
+                    )
+                image.verify()
+        except (OSError, SyntaxError, Image.DecompressionBombError):
+            raise ImageError("That file isn't an image we can read.")
+
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        path = original_path(self.directory, digest)
+        if not os.path.exists(path):
+            _write_atomic(path, lambda f: f.write(data))
+            self._submit(render_all, self.directory, digest)
+        return f"/images/{digest}"
+
+    def variant(self, digest, variant, fmt, timeout=30):
+        """Path to a variant, rendering it first if needed.
+
+        Returns None if there's no such original.
+        """
+
+        path = variant_path(self.directory, digest, variant, fmt)
+        if os.path.exists(path):
+            return path
+        if not os.path.exists(original_path(self.directory, digest)):
+            return None
+
+        key = (digest, variant, fmt)
+        with self.lock:
+            future = self.rendering.get(key)
+            if future is None:
+                future = self._submit(
+                    render_variant, self.directory, digest, variant, fmt
+                )
+                self.rendering[key] = future
+        try:
+            return future.result(timeout)
+        finally:
+            with self.lock:
+                if self.rendering.get(key) is future:
+                    del self.rendering[key]
+
+
+class _Done:
+    """A finished future, for rendering without a pool."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self, timeout=None):
+        return self.value
+
+
+def image_variant(url, variant):
+    """Template filter: the URL of `url`'s `variant`, if it's a local image."""
+
+    match = LOCAL_URL.match(url or "")
+    if match is None:
+        return url
+    webp = False
+    if has_request_context():
+        g.images_vary_accept = True
+        # named explicitly: every browser sends */*, not all of them take WebP
+        webp = any(
+            value == "image/webp" and quality > 0
+            for value, quality in request.accept_mimetypes
+        )
+    return f"/images/{match.group(1)}/{variant}.{'webp' if webp else 'jpg'}"
+
+
+def init_app(app):
+    app.config.setdefault("IMAGES_DIR", os.path.join(app.root_path, "uploads"))
+    app.config.setdefault("IMAGES_WORKERS", 2)
+    app.config.setdefault("IMAGES_MAX_BYTES", 8 * 2**20)
+    # 6000x4000; well under Pillow's own decompression bomb limit
+    app.config.setdefault("IMAGES_MAX_PIXELS", 24 * 10**6)
+    # one year; image URLs never change meaning
+    app.config.setdefault("IMAGES_MAX_AGE", 365 * 24 * 3600)
+    # the profile form carries up to two images
+    app.config.setdefault("MAX_CONTENT_LENGTH", 2 * app.config["IMAGES_MAX_BYTES"] + 2**20)
+
+    app.extensions["images"] = ImageStore(
+        app.config["IMAGES_DIR"],
+        app.config["IMAGES_WORKERS"],
+        app.config["IMAGES_MAX_BYTES"],
+        app.config["IMAGES_MAX_PIXELS"],
+    )
+    app.add_template_filter(image_variant)
+
+    @app.after_request
+    def vary_on_accept(response):
+        # the page's image URLs depend on whether the browser takes WebP
+        if g.get("images_vary_accept"):
+            response.vary.add("Accept")
+        return response
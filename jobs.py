@@ -0,0 +1,336 @@
+"""In-process background jobs for Warbler.
+
+Routes call `enqueue()` inside their own transaction, so a job is stored if
+and only if the write that caused it commits. Worker threads (or the
+`flask run-jobs` command) claim due jobs with SELECT ... FOR UPDATE SKIP
+LOCKED, so any number of workers across processes can share the table
+without an external broker.
+
+Handlers are registered per job name with `@handler("name")`. A name may
+have several handlers, so new side effects of an event can be added without
+touching the route; a name with none isn't stored at all.
+Long-running handlers can call `report_progress()` between batches.
+`periodic("name", seconds)` has worker threads enqueue a job every
+`seconds`, at most once per interval across all workers.
+
+Production needs at least one worker: JOBS_WORKERS threads in the web
+processes, or a separate `flask run-jobs`. JOBS_WORKERS=0 (the default, and
+what tests use) only runs jobs whose handlers were all registered with
+`inline=True`, and only at the end of the request that enqueued them.
+Those are short ones; a long job like "purge_user" would hold the response
+for as long as it runs, so it waits for a worker like every other due job.
+
+Finished jobs are kept for JOBS_RETENTION seconds, then deleted by
+`prune()`, which workers and requests run at most every JOBS_PRUNE_INTERVAL.
+"""
+
+import logging
+import random
+import threading
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+
+import metrics
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = defaultdict(list)
+# names with a handler that mustn't run inside a request
+_background = set()
+_periodic = {}
+_current = threading.local()
+
+
+def handler(name, inline=False):
+    """Register the decorated function to run for jobs called `name`.
+
+    The function is called with the job's payload dict inside an app context.
+    `inline=True` marks it cheap enough to run at the end of the enqueuing
+    request when there are no workers.
+    """
+
+    def register(func):
+        _handlers[name].append(func)
+        if not inline:
+            _background.add(name)
+        return func
+
+    return register
+
+
+def periodic(name, seconds):
+    """Run jobs called `name` every `seconds` while workers are running.
+
+    Each interval's job has an idempotency key, so however many workers
+    enqueue it, it runs once. Needs JOBS_WORKERS (or `flask run-jobs`).
+    """
+
+    _periodic[name] = seconds
+
+
+def enqueue_periodic(last_slots):
+    """Enqueue the periodic jobs whose interval has rolled over.
+
+    `last_slots` remembers, per caller, the last interval enqueued per name,
+    so each worker only hits the database once per interval.
+    """
+
+    now = time.time()
+    due = False
+    for name, seconds in _periodic.items():
+        slot = int(now // seconds)
+        if last_slots.get(name) != slot:
+            enqueue(name, {"slot": slot}, idempotency_key=f"{name}:{slot}")
+            last_slots[name] = slot
+            due = True
+    if due:
+        db.session.commit()
+
+
+def enqueue(name, payload=None, idempotency_key=None, delay=0, max_attempts=5):
+    """Add a job to the current session's transaction.
+
+    The caller commits. Returns the job's id, or None if nothing was added:
+    `idempotency_key` matched an existing job, or no handler runs `name`.
+    """
+
+    if not _handlers.get(name):
+        metrics.incr(f"jobs.unhandled.{name}")
+        return None
+
+    stmt = (
+        insert(Job.__table__)
+        .values(
+            name=name,
+            payload=payload or {},
+            status="pending",
+            attempts=0,
+            max_attempts=max_attempts,
+            run_at=datetime.utcnow() + timedelta(seconds=delay),
+            idempotency_key=idempotency_key,
+            created_at=datetime.utcnow(),
+        )
+        .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        .returning(Job.__table__.c.id)
+    )
+    job_id = db.session.execute(stmt).scalar()
+    if job_id is None:
+        return None
+    metrics.incr(f"jobs.enqueued.{name}")
+
+    if has_request_context() and name not in _background:
+        g.setdefault("jobs_enqueued", []).append(job_id)
+    return job_id
+
+
+def report_progress(progress):
+    """Record `progress` (JSON-able) on the running job.
+
+    Written in the handler's current transaction, so it is saved when the
+    handler commits the batch it describes. Also renews the job's lock, so
+    a long job that keeps reporting isn't reclaimed after JOBS_LOCK_TIMEOUT.
+    """
+
+    job = getattr(_current, "job", None)
+    if job is not None:
+        db.session.execute(
+            Job.__table__.update()
+            .where(Job.id == job.id)
+            .values(progress=progress, locked_at=datetime.utcnow())
+        )
+
+
+def claim_next(app, ids=None):
+    """Lock and return the next due job (among `ids`, if given), or None.
+
+    Jobs left "running" longer than JOBS_LOCK_TIMEOUT (a worker died mid-job)
+    are claimed again.
+    """
+
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=app.config["JOBS_LOCK_TIMEOUT"])
+
+    query = Job.query.filter(
+        or_(
+            (Job.status == "pending") & (Job.run_at <= now),
+            (Job.status == "running") & (Job.locked_at < stale),
+        )
+    )
+    if ids is not None:
+        query = query.filter(Job.id.in_(ids))
+    job = (
+        query.order_by(Job.run_at)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = "running"
+    job.locked_at = now
+    job.attempts += 1
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """Run every handler for `job`; on failure, retry with backoff."""
+
+    start = time.perf_counter()
+    _current.job = job
+    try:
+        for func in _handlers[job.name]:
+            func(job.payload)
+    except Exception:
+        db.session.rollback()
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = "failed"
+            metrics.incr(f"jobs.failed.{job.name}")
+            logger.error("job %s (%s) failed permanently", job.id, job.name)
+        else:
+            job.status = "pending"
+            job.run_at = datetime.utcnow() + backoff(job.attempts)
+            metrics.incr(f"jobs.retried.{job.name}")
+    else:
+        job.status = "done"
+        metrics.incr(f"jobs.done.{job.name}")
+    finally:
+        _current.job = None
+        metrics.observe(f"jobs.runtime.{job.name}", time.perf_counter() - start)
+
+    job.locked_at = None
+    db.session.commit()
+
+
+def backoff(attempts):
+    """Exponential backoff with jitter: ~2s, 4s, 8s ... capped at 10 min."""
+
+    seconds = min(2 ** attempts, 600)
+    return timedelta(seconds=seconds * random.uniform(0.5, 1.5))
+
+
+def run_pending(app, limit=None, ids=None):
+    """Run due jobs (among `ids`) until there are none left or `limit` have run."""
+
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim_next(app, ids)
+        if job is None:
+            break
+        run_job(job)
+        ran += 1
+    return ran
+
+
+_last_prune = 0
+
+
+def prune(app):
+    """Delete a batch of jobs that finished over JOBS_RETENTION seconds ago.
+
+    Does nothing if this process pruned within JOBS_PRUNE_INTERVAL. Failed
+    jobs are kept for inspection. Commits.
+    """
+
+    global _last_prune
+
+    now = time.time()
+    if now - _last_prune < app.config["JOBS_PRUNE_INTERVAL"]:
+        return 0
+    _last_prune = now
+
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config["JOBS_RETENTION"])
+    # a bounded batch off ix_jobs_status_run_at, so no call holds locks long
+    batch = (
+        db.session.query(Job.id)
+        .filter(Job.status == "done", Job.run_at < cutoff)
+        .limit(app.config["JOBS_PRUNE_BATCH"])
+        .subquery()
+    )
+    deleted = Job.query.filter(Job.id.in_(batch)).delete(synchronize_session=False)
+    db.session.commit()
+    metrics.incr("jobs.pruned", deleted)
+    return deleted
+
+
+def _worker_loop(app, stop):
+    last_slots = {}
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                enqueue_periodic(last_slots)
+                prune(app)
+                ran = run_pending(app, limit=100)
+            except Exception:
+                logger.exception("job worker crashed; restarting loop")
+                db.session.rollback()
+                ran = 0
+            finally:
+                db.session.remove()
+        if not ran:
+            stop.wait(app.config["JOBS_POLL_INTERVAL"])
+
+
+def start_workers(app, count):
+    """Start `count` daemon worker threads; returns an Event that stops them."""
+
+    stop = threading.Event()
+    for n in range(count):
+        thread = threading.Thread(
+            target=_worker_loop, args=(app, stop), name=f"jobs-{n}", daemon=True
+        )
+        thread.start()
+    return stop
+
+
+def init_app(app):
+    """Configure job processing for `app`."""
+
+    app.config.setdefault("JOBS_WORKERS", 0)
+    app.config.setdefault("JOBS_POLL_INTERVAL", 1.0)
+    app.config.setdefault("JOBS_LOCK_TIMEOUT", 300)
+    app.config.setdefault("JOBS_RETENTION", 7 * 24 * 3600)
+    app.config.setdefault("JOBS_PRUNE_INTERVAL", 600)
+    app.config.setdefault("JOBS_PRUNE_BATCH", 10000)
+
+    if app.config["JOBS_WORKERS"]:
+
+        @app.before_first_request
+        def start_job_workers():
+            # in the serving process, not at app creation, so a server that
+            # preloads the app and forks doesn't leave the threads behind
+            app.extensions["jobs"] = start_workers(app, app.config["JOBS_WORKERS"])
+
+    @app.after_request
+    def run_request_jobs(response):
+        """Without worker threads, run this request's inline jobs before returning.
+
+        Only the inline jobs this request enqueued: a backlog of due jobs (periodic
+        ones, retries) is left for `flask run-jobs` rather than landing on
+        whichever request happens to come next.
+        """
+
+        if not app.config["JOBS_WORKERS"] and g.get("jobs_enqueued"):
+            run_pending(app, ids=g.jobs_enqueued)
+            prune(app)
+        return response
+
+    @app.cli.command("run-jobs")
+    def run_jobs_command():
+        """Run a dedicated job worker in the foreground."""
+
+        stop = start_workers(app, max(app.config["JOBS_WORKERS"], 1))
+        try:
+            while not stop.is_set():
+                stop.wait(1)
+        except KeyboardInterrupt:
+            stop.set()
@@ -0,0 +1,241 @@
+"""Write-coalescing buffer for like toggles.
+
+`toggle_like()` doesn't write to `likes` itself. It records the state the
+user wants for (user, message) in this process's `LikeBuffer`. A burst of
+toggles on one pair collapses to its final state, and a background thread
+writes everything pending every LIKES_FLUSH_INTERVAL seconds (sooner once
+LIKES_FLUSH_MAX pairs are pending) in two statements: one multi-row INSERT
+for likes and one multi-row DELETE for unlikes.
+
+Pending states form a read overlay: `state()` and `overlay()` give the
+user's own view of their likes before the flush lands, so the home feed
+shows a like as soon as it's clicked. States a flush has taken stay in the
+overlay ("in flight") until its transaction commits, so a read during the
+flush never falls back to the old rows. Everyone else's counts are eventually
+consistent, at most a flush interval behind.
+
+Each flush then does the follow-up work once for the batch: the trending
+counts (one upsert, in the flush's own transaction; see
+trending.record_likes), profile cache invalidation, and live like counts
+(events.py). The buffer is also flushed when the process exits
+cleanly (atexit), so a graceful restart loses nothing. A crash loses at
+most one interval of toggles.
+
+Buffers are per process. If a user's toggles on one message land on two
+workers within one interval, the last flush wins.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import text
+
+import events
+import metrics
+import trending
+from cache import invalidate
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Likes on messages deleted since the toggle are skipped
+INSERT_LIKES = """
+    INSERT INTO likes (user_id, message_id)
+    SELECT v.user_id, v.message_id
+    FROM unnest(CAST(:user_ids AS integer[]), CAST(:message_ids AS bigint[]))
+        AS v(user_id, message_id)
+    WHERE EXISTS (SELECT 1 FROM messages WHERE id = v.message_id)
+    ON CONFLICT (user_id, message_id) DO NOTHING
+    RETURNING user_id, message_id
+"""
+
+DELETE_LIKES = """
+    DELETE FROM likes AS l
+    USING unnest(CAST(:user_ids AS integer[]), CAST(:message_ids AS bigint[]))
+        AS v(user_id, message_id)
+    WHERE l.user_id = v.user_id AND l.message_id = v.message_id
+    RETURNING l.user_id, l.message_id
+"""
+
+LIKE_COUNTS = """
+    SELECT m.id, m.user_id, COUNT(l.id)
+    FROM messages AS m LEFT JOIN likes AS l ON l.message_id = m.id
+    WHERE m.id = ANY(:message_ids)
+    GROUP BY m.id
+"""
+
+
+class LikeBuffer:
+    """Pending like states, {user_id: {message_id: liked}}."""
+
+    def __init__(self, app, max_pending):
+        self.app = app
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = defaultdict(dict)
+        # taken by the running flush, not yet committed
+        self.in_flight = {}
+        self.flush_lock = threading.Lock()
+        self.size = 0
+        self.wake = threading.Event()
+        self.flusher_pid = None
+
+    def state(self, user_id, message_id):
+        """The pending state for a pair: True, False, or None if nothing's pending."""
+
+        with self.lock:
+            for states in (self.pending, self.in_flight):
+                liked = states.get(user_id, {}).get(message_id)
+                if liked is not None:
+                    return liked
+        return None
+
+    def overlay(self, user_id):
+        """A copy of a user's pending states, {message_id: liked}."""
+
+        with self.lock:
+            states = dict(self.in_flight.get(user_id, {}))
+            states.update(self.pending.get(user_id, {}))
+        return states
+
+    def set(self, user_id, message_id, liked):
+        """Record that the user wants `message_id` liked (or not)."""
+
+        self._start_flusher()
+        with self.lock:
+            states = self.pending[user_id]
+            if message_id not in states:
+                self.size += 1
+            else:
+                metrics.incr("likes.coalesced")
+            states[message_id] = liked
+            full = self.size >= self.max_pending
+        if full:
+            self.wake.set()
+
+    def _take(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(dict)
+            self.in_flight = pending
+            self.size = 0
+        return [
+            (user_id, message_id, liked)
+            for user_id, states in pending.items()
+            for message_id, liked in states.items()
+        ]
+
+    def _landed(self):
+        with self.lock:
+            self.in_flight = {}
+
+    def _restore(self, items):
+        # toggles made since the failed flush are newer, so they win
+        with self.lock:
+            for user_id, message_id, liked in items:
+                states = self.pending[user_id]
+                if message_id not in states:
+                    states[message_id] = liked
+                    self.size += 1
+            self.in_flight = {}
+
+    def flush(self):
+        """Write every pending state; returns how many rows changed.
+
+        Needs an app context. Commits its own transaction. One flush runs
+        at a time, so there's only ever one batch in flight.
+        """
+
+        with self.flush_lock:
+            items = self._take()
+            if not items:
+                return 0
+
+            try:
+                changed = self._write(items)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self._restore(items)
+                raise
+            self._landed()
+
+        metrics.incr("likes.flushed", len(items))
+        if changed:
+            self._after_flush(changed)
+        return len(changed)
+
+    def _write(self, items):
+        changed = []
+        for sql, wanted, delta in ((INSERT_LIKES, True, 1), (DELETE_LIKES, False, -1)):
+            pairs = [(u, m) for u, m, liked in items if liked is wanted]
+            if not pairs:
+                continue
+            rows = db.session.execute(
+                text(sql),
+                {
+                    "user_ids": [user_id for user_id, _ in pairs],
+                    "message_ids": [message_id for _, message_id in pairs],
+                },
+            )
+            changed.extend((user_id, message_id, delta) for user_id, message_id in rows)
+
+        if changed:
+            deltas = defaultdict(int)
+            for _, message_id, delta in changed:
+                deltas[message_id] += delta
+            # not a job: the flusher thread has no request to run jobs at
+            # the end of when JOBS_WORKERS is 0
+            trending.record_likes(deltas.items())
+        return changed
+
+    def _after_flush(self, changed):
+        invalidate(*{f"profile:{user_id}" for user_id, _, _ in changed})
+
+        if self.app.config["EVENTS_ENABLED"]:
+            message_ids = list({message_id for _, message_id, _ in changed})
+            rows = db.session.execute(text(LIKE_COUNTS), {"message_ids": message_ids})
+            for message_id, author_id, likes in rows:
+                events.publish(
+                    f"feed:{author_id}",
+                    "likes",
+                    {"message_id": str(message_id), "likes": likes},
+                )
+            db.session.commit()
+
+    def _start_flusher(self):
+        # threads don't survive a fork, so start one per process
+        if self.flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+        threading.Thread(target=self._run, name="like-flusher", daemon=True).start()
+        atexit.register(self.flush_on_exit)
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.app.config["LIKES_FLUSH_INTERVAL"])
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception("like flush failed; will retry")
+
+    def flush_on_exit(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+        except Exception:
+            logger.exception("could not flush likes at exit")
+
+
+def init_app(app):
+    app.config.setdefault("LIKES_FLUSH_INTERVAL", 1.0)
+    app.config.setdefault("LIKES_FLUSH_MAX", 500)
+
+    app.extensions["likes"] = LikeBuffer(app, app.config["LIKES_FLUSH_MAX"])
@@ -0,0 +1,48 @@
+"""Process-local counters for Warbler.
+
+Each gunicorn worker keeps its own numbers; dashboards scrape `/metrics` on
+every worker and sum them.
+"""
+
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    """Add `value` to counter `name`."""
+
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    """Record the current value of gauge `name`."""
+
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    """Record one timing sample (count, total and max) under `name`."""
+
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+
+def snapshot():
+    """Return a copy of every counter, gauge and timing."""
+
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "timings": {name: dict(timing) for name, timing in _timings.items()},
+        }
@@ -0,0 +1,24 @@
+-- Switch messages.id to in-process snowflake ids (see snowflake.py).
+--
+-- Existing rows keep their serial ids. Every snowflake id is far larger
+-- than any serial id, so ORDER BY id stays newest-last across the
+-- boundary, and old rows keep their stored timestamp. Only new rows get
+-- ids that encode their creation time.
+--
+-- Run once, before deploying code that generates snowflake ids:
+--
+--     psql warbler -f migrations/001_snowflake_message_ids.sql
+
+BEGIN;
+
+ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT;
+ALTER TABLE messages ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE messages ALTER COLUMN id DROP DEFAULT;
+DROP SEQUENCE IF EXISTS messages_id_seq;
+
+-- the timestamp column used to default to the app's import time
+ALTER TABLE messages ALTER COLUMN timestamp DROP DEFAULT;
+
+CREATE INDEX IF NOT EXISTS ix_messages_user_id_id ON messages (user_id, id);
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Cold-tier tables for archive.py (messages, likes and DMs older than
+-- ARCHIVE_AFTER_DAYS are moved here in batches).
+--
+-- `db.create_all()` creates the new tables; this adds the index the
+-- archiver needs on the existing direct_messages table. CONCURRENTLY can't
+-- run in a transaction, so there's no BEGIN/COMMIT:
+--
+--     psql warbler -f migrations/002_archive_tables.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_direct_messages_timestamp
+    ON direct_messages (timestamp);
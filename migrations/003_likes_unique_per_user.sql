@@ -0,0 +1,20 @@
+-- likes.message_id was UNIQUE, so each message could only ever be liked by
+-- one user. Likes are now unique per (user_id, message_id), which
+-- like_buffer.py relies on for ON CONFLICT, and message_id gets a plain
+-- index for like counts.
+--
+-- The new indexes are built before the old constraint is dropped, and
+-- CONCURRENTLY can't run in a transaction, so there's no BEGIN/COMMIT:
+--
+--     psql warbler -f migrations/003_likes_unique_per_user.sql
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_likes_user_id_message_id
+    ON likes (user_id, message_id);
+
+ALTER TABLE likes ADD CONSTRAINT uq_likes_user_id_message_id
+    UNIQUE USING INDEX uq_likes_user_id_message_id;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_message_id
+    ON likes (message_id);
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
@@ -1,13 +1,17 @@
 """SQLAlchemy models for Warbler."""
 
+import hashlib
+import secrets
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert
+
+import snowflake
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
-import pdb
 
 
 class Follows(db.Model):
@@ -27,6 +31,122 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index(
+            "ix_follows_follower_followed",
+            "user_following_id",
+            "user_being_followed_id",
+        ),
+    )
+
+    @classmethod
+    def follow(cls, follower_id, followed_ids):
+        """Make `follower_id` follow each of `followed_ids`.
+
+        One multi-row INSERT ... ON CONFLICT DO NOTHING: nothing is loaded,
+        and ids already followed (or the follower's own id) are skipped.
+        New follows are added to the follow_changes log. Returns the number
+        of new follows.
+        """
+
+        rows = [
+            {"user_following_id": follower_id, "user_being_followed_id": followed_id}
+            for followed_id in set(followed_ids)
+            if followed_id != follower_id
+        ]
+        if not rows:
+            return 0
+
+        stmt = (
+            insert(cls.__table__)
+            .values(rows)
+            .on_conflict_do_nothing()
+            .returning(cls.user_being_followed_id)
+        )
+        added = [followed_id for (followed_id,) in db.session.execute(stmt)]
+        FollowChange.log(follower_id, added, FollowChange.FOLLOW)
+        return len(added)
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_ids):
+        """Stop `follower_id` following each of `followed_ids`.
+
+        One DELETE; ids not followed are ignored. Removals are added to the
+        follow_changes log. Returns the number removed.
+        """
+
+        if not followed_ids:
+            return 0
+
+        stmt = (
+            cls.__table__.delete()
+            .where(
+                (cls.user_following_id == follower_id)
+                & cls.user_being_followed_id.in_(set(followed_ids))
+            )
+            .returning(cls.user_being_followed_id)
+        )
+        removed = [followed_id for (followed_id,) in db.session.execute(stmt)]
+        FollowChange.log(follower_id, removed, FollowChange.UNFOLLOW)
+        return len(removed)
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (one indexed lookup)"""
+
+        return db.session.query(
+            cls.query.filter_by(
+                user_following_id=follower_id, user_being_followed_id=followed_id
+            ).exists()
+        ).scalar()
+
+
+class FollowChange(db.Model):
+    """One follow or unfollow, in order (see follow_graph.py).
+
+    Follows.follow/unfollow and the account purge write here in the same
+    transaction as the change, so the follow graph snapshot can be brought
+    up to date without rereading `follows`.
+    """
+
+    __tablename__ = "follow_changes"
+
+    FOLLOW = 1
+    UNFOLLOW = -1
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # FOLLOW or UNFOLLOW
+    op = db.Column(
+        db.SmallInteger,
+        nullable=False,
+    )
+
+    @classmethod
+    def log(cls, follower_id, followed_ids, op):
+        if followed_ids:
+            db.session.execute(
+                cls.__table__.insert(),
+                [
+                    {"follower_id": follower_id, "followed_id": followed_id, "op": op}
+                    for followed_id in followed_ids
+                ],
+            )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -38,7 +158,12 @@ class Likes(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="cascade"))
 
     message_id = db.Column(
-        db.Integer, db.ForeignKey("messages.id", ondelete="cascade"), unique=True
+        db.BigInteger, db.ForeignKey("messages.id", ondelete="cascade"), index=True
+    )
+
+    # one like per user per message (like_buffer.py upserts on it)
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "message_id", name="uq_likes_user_id_message_id"),
     )
 
 
@@ -84,6 +209,12 @@ class User(db.Model):
         nullable=False,
     )
 
+    # set when the user deletes their account; rows are purged in the
+    # background (see tasks.purge_user)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship("Message")
 
     followers = db.relationship(
@@ -105,17 +236,126 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def active(cls):
+        """Query for users who haven't deleted their account."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def active_ids(cls, user_ids):
+        """Which of `user_ids` belong to active users, as a set (one query)."""
+
+        if not user_ids:
+            return set()
+
+        rows = db.session.query(cls.id).filter(
+            cls.id.in_(set(user_ids)), cls.deleted_at.is_(None)
+        )
+        return {user_id for (user_id,) in rows}
+
+    def counts(self):
+        """Message, following, follower and like counts in one query.
+
+        Use this instead of `len(user.messages)` etc., which load every row.
+        """
+
+        return User.counts_for(self.id)
+
+    @classmethod
+    def counts_for(cls, user_id):
+        """`counts()` for a user id, without loading the user."""
+
+        def count(column, where):
+            return db.session.query(db.func.count(column)).filter(where).as_scalar()
+
+        return db.session.query(
+            count(Message.id, Message.user_id == user_id).label("messages"),
+            count(
+                Follows.user_being_followed_id, Follows.user_following_id == user_id
+            ).label("following"),
+            count(
+                Follows.user_following_id, Follows.user_being_followed_id == user_id
+            ).label("followers"),
+            count(Likes.id, Likes.user_id == user_id).label("likes"),
+        ).one()
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` this user follows, as a set (one query)."""
+
+        if not user_ids:
+            return set()
+
+        rows = db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == self.id,
+            Follows.user_being_followed_id.in_(user_ids),
+        )
+        return {followed_id for (followed_id,) in rows}
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
+
+    def follow_page(self, direction, viewer_id, after=None, limit=30):
+        """One page of this user's "following" or "followers", by user id.
+
+        Each row has the card columns plus `follows_you` (the row's user
+        follows `viewer_id`) and `you_follow` (`viewer_id` follows them),
+        all computed in a single query. `after` is the last id of the
+        previous page.
+        """
+
+        if direction == "following":
+            on = (Follows.user_being_followed_id == User.id) & (
+                Follows.user_following_id == self.id
+            )
+        else:
+            on = (Follows.user_following_id == User.id) & (
+                Follows.user_being_followed_id == self.id
+            )
+
+        theirs = db.aliased(Follows)
+        follows_you = (
+            db.session.query(theirs)
+            .filter(
+                theirs.user_following_id == User.id,
+                theirs.user_being_followed_id == viewer_id,
+            )
+            .exists()
+        )
+        yours = db.aliased(Follows)
+        you_follow = (
+            db.session.query(yours)
+            .filter(
+                yours.user_following_id == viewer_id,
+                yours.user_being_followed_id == User.id,
+            )
+            .exists()
+        )
+
+        query = (
+            db.session.query(
+                User.id,
+                User.username,
+                User.image_url,
+                User.header_image_url,
+                User.bio,
+                follows_you.label("follows_you"),
+                you_follow.label("you_follow"),
+            )
+            .join(Follows, on)
+            .filter(User.deleted_at.is_(None))
+        )
+        if after is not None:
+            query = query.filter(User.id > after)
+
+        return query.order_by(User.id).limit(limit).all()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -147,7 +387,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
@@ -174,14 +414,23 @@ class User(db.Model):
         return False
 
 
+def _timestamp_from_id(context):
+    """Default Message.timestamp: the time encoded in the message's id."""
+
+    return snowflake.timestamp_of(context.get_current_parameters()["id"])
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = "messages"
 
+    # time-ordered, so feeds and pagination can sort/filter on id alone
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -192,7 +441,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=_timestamp_from_id,
     )
 
     user_id = db.Column(
@@ -203,6 +452,76 @@ class Message(db.Model):
 
     user = db.relationship("User")
 
+    archived = False
+
+    # a user's messages, newest first, straight off the index
+    __table_args__ = (db.Index("ix_messages_user_id_id", "user_id", "id"),)
+
+    @classmethod
+    def create_many(cls, user_id, texts):
+        """Post each of `texts` as `user_id` in one multi-row INSERT.
+
+        Nothing is loaded into the session. Returns the new ids, in order.
+        """
+
+        if not texts:
+            return []
+
+        ids = [snowflake.next_id() for _ in texts]
+        rows = [
+            {
+                "id": message_id,
+                "text": text,
+                "timestamp": snowflake.timestamp_of(message_id),
+                "user_id": user_id,
+            }
+            for message_id, text in zip(ids, texts)
+        ]
+        db.session.execute(insert(cls.__table__).values(rows))
+        return ids
+
+
+class Hashtag(db.Model):
+    """A #tag in a message's text (see tags.py).
+
+    The primary key is the tag's feed, newest first when scanned backward.
+    Not tied to `messages`, so tags of archived messages still count.
+    """
+
+    __tablename__ = "hashtags"
+
+    # lowercase, without the "#"
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # for removing a message's tags
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message's text (see tags.py)."""
+
+    __tablename__ = "mentions"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # for removing a message's mentions
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        index=True,
+    )
+
 
 class DirectMessage(db.Model):
     """DM feature"""
@@ -222,7 +541,8 @@ class DirectMessage(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        index=True,
     )
 
     direct_message_thread = db.Column(
@@ -279,6 +599,393 @@ class DirectMessageThread(db.Model):
     )
 
 
+##############################################################################
+# Cold tier: rows moved out of the hot tables by archive.py once they're older
+# than ARCHIVE_AFTER_DAYS. Same columns as the hot tables; read-only apart
+# from deletes.
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` by the archiver."""
+
+    __tablename__ = "messages_archive"
+
+    archived = True
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+
+    user = db.relationship("User")
+
+    __table_args__ = (db.Index("ix_messages_archive_user_id_id", "user_id", "id"),)
+
+
+class ArchivedLike(db.Model):
+    """A like on an archived message."""
+
+    __tablename__ = "likes_archive"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="cascade"), index=True
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey("messages_archive.id", ondelete="cascade"),
+        index=True,
+    )
+
+
+class ArchivedDirectMessage(db.Model):
+    """A direct message moved out of `direct_messages` by the archiver."""
+
+    __tablename__ = "direct_messages_archive"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    direct_message_thread = db.Column(
+        db.Integer,
+        db.ForeignKey("direct_message_threads.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+
+    sender_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+
+    sent_id = db.Column(
+        db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+
+    sender = db.relationship("User", primaryjoin=(sender_id == User.id))
+
+    sent_to = db.relationship("User", primaryjoin=(sent_id == User.id))
+
+
+class FollowSuggestion(db.Model):
+    """A "who to follow" suggestion, computed offline by suggestions.py."""
+
+    __tablename__ = "follow_suggestions"
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # 0 is the best suggestion
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+    )
+
+    # how many of the people user_id follows follow suggested_id
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit=5):
+        """Top suggestions for a user (one lookup on the primary key).
+
+        Skips accounts the user has followed since the suggestions were
+        computed, and deleted accounts.
+        """
+
+        return (
+            db.session.query(User.id, User.username, User.image_url, cls.score)
+            .join(cls, cls.suggested_id == User.id)
+            .filter(
+                cls.user_id == user_id,
+                User.deleted_at.is_(None),
+                ~db.exists().where(
+                    (Follows.user_following_id == user_id)
+                    & (Follows.user_being_followed_id == cls.suggested_id)
+                ),
+            )
+            .order_by(cls.rank)
+            .limit(limit)
+            .all()
+        )
+
+
+class ApiToken(db.Model):
+    """A bearer token for the JSON API (see api.py).
+
+    Only a SHA-256 of the token is stored; the token itself is shown once,
+    when it's issued. Delete the row to revoke it.
+    """
+
+    __tablename__ = "api_tokens"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id", ondelete="cascade"),
+        nullable=False,
+        index=True,
+    )
+
+    # what the token is for, e.g. the partner's name
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    token_hash = db.Column(
+        db.String(64),
+        nullable=False,
+        unique=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user_id, name):
+        """Create a token for `user_id`; returns the token string.
+
+        The caller commits.
+        """
+
+        token = secrets.token_urlsafe(32)
+        db.session.add(cls(user_id=user_id, name=name, token_hash=cls.hash(token)))
+        return token
+
+    @classmethod
+    def user_for(cls, token):
+        """The active user a token belongs to, or None."""
+
+        return (
+            User.active()
+            .join(cls, cls.user_id == User.id)
+            .filter(cls.token_hash == cls.hash(token))
+            .first()
+        )
+
+
+##############################################################################
+# Trending (see trending.py)
+
+
+class TrendingBucket(db.Model):
+    """Net likes a message got in one time bucket.
+
+    Kept up to date as likes are toggled; buckets older than the trending
+    window are pruned by the snapshot job.
+    """
+
+    __tablename__ = "trending_buckets"
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey("messages.id", ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # seconds since the unix epoch // TRENDING_BUCKET_SECONDS
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        index=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class TrendingScore(db.Model):
+    """The top trending messages as of the last snapshot job."""
+
+    __tablename__ = "trending_scores"
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    # decayed like count as of computed_at
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work (see jobs.py).
+
+    Jobs live in the database so they survive restarts and can be picked up
+    by any worker.
+    """
+
+    __tablename__ = "jobs"
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # pending -> running -> done | failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="pending",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # whatever the handler last passed to jobs.report_progress()
+    progress = db.Column(
+        db.JSON,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (db.Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+
+# Indexes backing admin search (admin_views.py). Postgres-only expression
+# indexes, so they're added as DDL after the tables are created.
+db.event.listen(
+    User.__table__,
+    "after_create",
+    db.DDL(
+        "CREATE INDEX ix_users_username_prefix "
+        "ON users (lower(username) text_pattern_ops)"
+    ).execute_if(dialect="postgresql"),
+)
+db.event.listen(
+    User.__table__,
+    "after_create",
+    db.DDL(
+        "CREATE INDEX ix_users_email_prefix ON users (lower(email) text_pattern_ops)"
+    ).execute_if(dialect="postgresql"),
+)
+db.event.listen(
+    Message.__table__,
+    "after_create",
+    db.DDL(
+        "CREATE INDEX ix_messages_text_fts "
+        "ON messages USING gin (to_tsvector('english', text))"
+    ).execute_if(dialect="postgresql"),
+)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,235 @@
+"""Token-bucket rate limiting for expensive endpoints.
+
+Login, signup, profile edits and password changes all run bcrypt, and
+posting writes to the database, so a burst of requests to any of them can
+pin every CPU. Limits are checked in a before_request hook that runs before
+the current user is loaded, so a rejected request costs no bcrypt and no
+database work.
+
+Buckets live in a small SQLite file in RUNTIME_DIR by default (see
+runtime.py), so every gunicorn worker on the host shares the same limits.
+"memory://" keeps them in-process instead. A bucket that has refilled is
+the same as no bucket, so both stores drop full buckets every
+PRUNE_EVERY takes.
+
+A request takes a token from each of its endpoint's buckets, or from none
+of them: a request one rule rejects doesn't use up another rule's tokens.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from flask import make_response, request, session
+
+import metrics
+from runtime import check_private_file, runtime_path
+
+PRUNE_EVERY = 1000
+
+# endpoint -> list of (key, per_minute, burst); key is one of
+#   "ip": the client address
+#   "user": the logged-in user id from the session (skipped if logged out)
+#   "username": the username submitted in the form
+#   "token": the API bearer token (skipped if there isn't one)
+DEFAULT_POLICIES = {
+    "warbler.login": [("ip", 20, 10), ("username", 10, 5)],
+    "warbler.signup": [("ip", 5, 5)],
+    "warbler.profile": [("ip", 20, 10), ("user", 5, 5)],
+    "warbler.change_password": [("ip", 20, 10), ("user", 5, 5)],
+    "warbler.messages_add": [("ip", 60, 30), ("user", 30, 10)],
+    "warbler.bulk_follow": [("user", 10, 5)],
+    "warbler.messages_batch": [("ip", 60, 30), ("token", 20, 10)],
+    "warbler.username_available": [("ip", 60, 20)],
+}
+
+# Only POSTs are limited, except on these endpoints, which do their work on GET
+LIMITED_READS = {"warbler.username_available"}
+
+
+class MemoryStore:
+    """Buckets in a dict; limits are per process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (tokens, updated, when it's full again)
+        self.buckets = {}
+        self.takes = 0
+
+    def take(self, buckets):
+        """Take a token from every (key, rate, capacity) bucket, or from none.
+
+        Returns (allowed, seconds until the request would be).
+        """
+
+        with self.lock:
+            now = time.time()
+            levels = []
+            for key, rate, capacity in buckets:
+                tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+                levels.append(_refill(tokens, updated, now, rate, capacity))
+            allowed, levels, retry_after = _take_all(buckets, levels)
+            for (key, rate, capacity), tokens in zip(buckets, levels):
+                self.buckets[key] = (tokens, now, _full_at(tokens, now, rate, capacity))
+
+            self.takes += 1
+            if self.takes % PRUNE_EVERY == 0:
+                self.buckets = {
+                    key: bucket
+                    for key, bucket in self.buckets.items()
+                    if bucket[2] > now
+                }
+        return allowed, retry_after
+
+
+class SQLiteStore:
+    """Buckets in a SQLite file shared by every process on the host."""
+
+    def __init__(self, path):
+        self.path = check_private_file(path)
+        self.local = threading.local()
+        self.takes = 0
+
+    def _connection(self):
+        # connections can't cross a fork, so key them by pid as well
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, "
+                "tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_token_buckets_full_at "
+                "ON token_buckets (full_at)"
+            )
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def take(self, buckets):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            levels = []
+            for key, rate, capacity in buckets:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM token_buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                levels.append(_refill(tokens, updated, now, rate, capacity))
+            allowed, levels, retry_after = _take_all(buckets, levels)
+            conn.executemany(
+                "INSERT OR REPLACE INTO token_buckets (key, tokens, updated, full_at) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (key, tokens, now, _full_at(tokens, now, rate, capacity))
+                    for (key, rate, capacity), tokens in zip(buckets, levels)
+                ],
+            )
+            # now and then, rather than on every take
+            self.takes += 1
+            if self.takes % PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM token_buckets WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+
+def _refill(tokens, updated, now, rate, capacity):
+    """A bucket's tokens after refilling for the time elapsed."""
+
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+def _take_all(buckets, levels):
+    """Take one token from every bucket, or none if any of them is empty.
+
+    `buckets` are (key, rate, capacity) and `levels` their refilled tokens.
+    Returns (allowed, tokens left in each, seconds until all have a token).
+    """
+
+    waits = [
+        (1 - tokens) / rate
+        for (_, rate, _), tokens in zip(buckets, levels)
+        if tokens < 1
+    ]
+    if waits:
+        return False, levels, max(waits)
+    return True, [tokens - 1 for tokens in levels], 0
+
+
+def _full_at(tokens, now, rate, capacity):
+    """When a bucket left with `tokens` at `now` will have refilled."""
+
+    return now + (capacity - tokens) / rate
+
+
+def make_store(uri):
+    if uri == "memory://":
+        return MemoryStore()
+    return SQLiteStore(uri)
+
+
+def _bucket_key(kind, user_session_key):
+    if kind == "ip":
+        return request.remote_addr
+    if kind == "user":
+        return session.get(user_session_key)
+    if kind == "username":
+        return request.form.get("username")
+    if kind == "token":
+        # checked before the token is, so never keyed on the raw secret
+        _, _, token = request.headers.get("Authorization", "").partition(" ")
+        return hashlib.sha256(token.encode()).hexdigest() if token else None
+    raise ValueError(f"unknown rate limit key {kind!r}")
+
+
+def init_app(app, user_session_key):
+    """Enforce RATELIMIT_POLICIES on `app`.
+
+    `user_session_key` is the session key holding the logged-in user's id.
+    Call this before registering any before_request hook that touches the
+    database, so rejected requests never reach it.
+    """
+
+    app.config.setdefault("RATELIMIT_ENABLED", True)
+    app.config.setdefault("RATELIMIT_POLICIES", DEFAULT_POLICIES)
+    app.config.setdefault("RATELIMIT_STORAGE", runtime_path(app, "ratelimit.sqlite3"))
+    store = make_store(app.config["RATELIMIT_STORAGE"])
+
+    @app.before_request
+    def check_rate_limit():
+        """Reject the request with 429 if any of its buckets is empty."""
+
+        if not app.config["RATELIMIT_ENABLED"]:
+            return None
+        if request.method != "POST" and request.endpoint not in LIMITED_READS:
+            return None
+
+        buckets = []
+        for kind, per_minute, burst in app.config["RATELIMIT_POLICIES"].get(
+            request.endpoint, ()
+        ):
+            key = _bucket_key(kind, user_session_key)
+            if key is not None:
+                buckets.append(
+                    (f"{request.endpoint}:{kind}:{key}", per_minute / 60, burst)
+                )
+        if not buckets:
+            return None
+
+        allowed, retry_after = store.take(buckets)
+        if allowed:
+            return None
+        metrics.incr(f"ratelimit.rejected.{request.endpoint}")
+        response = make_response("Too many requests, please try again later.", 429)
+        response.headers["Retry-After"] = str(int(retry_after) + 1)
+        return response
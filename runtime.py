@@ -0,0 +1,65 @@
+"""Private on-disk state shared by the workers on a host.
+
+The cache, rate limits, live events, the follow graph snapshot and Jinja
+bytecode live in files that every worker reads, and bytecode is executed,
+so another local user must never be able to create, replace or read them. By default they go in RUNTIME_DIR, a
+directory of our own created with mode 0700. Every path is checked before
+it's used, and `UnsafePathError` is raised if:
+
+- a directory isn't ours, is a symlink, or grants any group/other access
+- a file isn't a regular file of ours, or is group/world writable
+"""
+
+import os
+import stat
+import tempfile
+
+
+class UnsafePathError(RuntimeError):
+    """A runtime file or directory another local user could tamper with."""
+
+
+def ensure_private_dir(path):
+    """Create `path` (0700) if it's missing, and check it's private to us."""
+
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise UnsafePathError(f"{path} is not a directory")
+    if info.st_uid != os.getuid():
+        raise UnsafePathError(f"{path} is owned by uid {info.st_uid}, not us")
+    if info.st_mode & 0o077:
+        raise UnsafePathError(
+            f"{path} has mode {stat.S_IMODE(info.st_mode):o}; it must be 0700"
+        )
+    return path
+
+
+def check_private_file(path):
+    """Check a file (and its directory) before opening it; returns `path`."""
+
+    ensure_private_dir(os.path.dirname(os.path.abspath(path)))
+    try:
+        info = os.lstat(path)
+    except FileNotFoundError:
+        return path
+    if not stat.S_ISREG(info.st_mode):
+        raise UnsafePathError(f"{path} is not a regular file")
+    if info.st_uid != os.getuid():
+        raise UnsafePathError(f"{path} is owned by uid {info.st_uid}, not us")
+    if info.st_mode & 0o022:
+        raise UnsafePathError(f"{path} is writable by other users")
+    return path
+
+
+def runtime_path(app, name):
+    """`name` inside the app's RUNTIME_DIR, creating the directory."""
+
+    app.config.setdefault(
+        "RUNTIME_DIR", os.path.join(tempfile.gettempdir(), f"warbler-{os.getuid()}")
+    )
+    return os.path.join(ensure_private_dir(app.config["RUNTIME_DIR"]), name)
@@ -1,8 +1,19 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
+from datetime import datetime
+from app import app, db
 from models import User, Message, Follows
+import snowflake
+
+
+def with_snowflake_ids(rows):
+    """Give sample messages ids matching their timestamps, so they sort right."""
+    for n, row in enumerate(rows):
+        created = datetime.fromisoformat(row['timestamp'])
+        row['id'] = snowflake.id_at(created, sequence=n)
+        yield row
+
 
 db.drop_all()
 db.create_all()
@@ -11,7 +22,7 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, with_snowflake_ids(DictReader(messages)))
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,145 @@
+"""Time-ordered 64-bit ids ("snowflakes") for messages.
+
+An id packs, from the high bits down:
+
+    41 bits  milliseconds since EPOCH
+    10 bits  worker id (SNOWFLAKE_WORKER_ID, 0-1023)
+    12 bits  per-millisecond sequence
+
+so ids sort by creation time, can be generated in-process without a round
+trip to a sequence, and carry their own timestamp. Ids from different
+processes never collide as long as each has its own worker id, so each
+process leases one from Postgres the first time it needs an id (see
+lease_worker_id). SNOWFLAKE_WORKER_ID overrides the lease; it has to be
+unique per process, not per host, since forked workers share it.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+EPOCH = datetime(2010, 1, 1)
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+# first key of the advisory locks that lease worker ids ("snow")
+LEASE_LOCK_KEY = 0x736E6F77
+
+
+class SnowflakeGenerator:
+    """Thread-safe id generator for one worker id."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            ms = _now_ms()
+            if ms < self.last_ms:
+                # clock went backwards; don't reuse ids from the "future"
+                ms = self.last_ms
+            if ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # 4096 ids this millisecond; wait for the next one
+                    while ms <= self.last_ms:
+                        ms = _now_ms()
+            else:
+                self.sequence = 0
+            self.last_ms = ms
+            return _pack(ms, self.worker_id, self.sequence)
+
+
+def _now_ms():
+    return int(time.time() * 1000) - _EPOCH_MS
+
+
+def _pack(ms, worker_id, sequence):
+    return (ms << TIMESTAMP_SHIFT) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def id_at(when, worker_id=0, sequence=0):
+    """The id a message created at datetime `when` would get.
+
+    With the defaults this is the smallest id at `when`, so it can be used
+    as a bound: `Message.id >= id_at(since)`.
+    """
+
+    ms = int((when - EPOCH).total_seconds() * 1000)
+    return _pack(ms, worker_id, sequence & MAX_SEQUENCE)
+
+
+def timestamp_of(snowflake_id):
+    """The (UTC, naive) datetime an id was generated at."""
+
+    return EPOCH + timedelta(milliseconds=snowflake_id >> TIMESTAMP_SHIFT)
+
+
+def lease_worker_id(engine):
+    """Claim a worker id no other live process holds; returns it.
+
+    Each id is a Postgres advisory lock, held by a connection this process
+    keeps open (outside the pool) for the rest of its life, so the id is
+    freed however the process exits.
+    """
+
+    connection = engine.connect()
+    connection.detach()
+    start = os.getpid() & MAX_WORKER_ID
+    for n in range(MAX_WORKER_ID + 1):
+        worker_id = (start + n) & MAX_WORKER_ID
+        # session-level: the lock outlives the transaction
+        with connection.begin():
+            leased = connection.execute(
+                text("SELECT pg_try_advisory_lock(:key, :worker_id)"),
+                key=LEASE_LOCK_KEY,
+                worker_id=worker_id,
+            ).scalar()
+        if leased:
+            # never dropped: a forked child closing its parent's connection
+            # would end the parent's session, and its lease
+            _leases.append(connection)
+            return worker_id
+    connection.close()
+    raise RuntimeError(f"all {MAX_WORKER_ID + 1} snowflake worker ids are leased")
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = threading.Lock()
+_leases = []
+
+
+def next_id():
+    """A new id from this process's generator (needs an app context)."""
+
+    global _generator, _generator_pid
+
+    # a forked worker must not keep generating from its parent's state
+    if _generator is None or _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator is None or _generator_pid != os.getpid():
+                worker_id = os.environ.get("SNOWFLAKE_WORKER_ID")
+                if worker_id is None:
+                    worker_id = lease_worker_id(
+                        current_app.extensions["sqlalchemy"].db.engine
+                    )
+                _generator = SnowflakeGenerator(int(worker_id))
+                _generator_pid = os.getpid()
+
+    return _generator.next_id()
@@ -3,34 +3,123 @@ window.addEventListener('DOMContentLoaded', function () {
 
 	//prettier-ignore
 	for (let message of allMessages) {
-		message.addEventListener('click', async function (e) {
-			e.preventDefault();
-            console.dir(e)
-            if(e.target.nodeName==='BUTTON' || e.target.nodeName==='I'){
-            console.log(e.target.nodeName)
-            console.log(e.target)
-            const route = e.target.dataset.likePostRoute;
+		bindMessage(message);
+	}
+
+	listenForEvents();
+	checkUsernameAvailability();
+});
+
+// click handling for one feed item (also used for items added live)
+function bindMessage(message) {
+	message.addEventListener('click', async function (e) {
+		e.preventDefault();
+		if (e.target.nodeName === 'BUTTON' || e.target.nodeName === 'I') {
+			const route = e.target.dataset.likePostRoute;
 			await fetch(`${route}`, {
 				method: 'POST'
 			});
-            document.querySelector(`[data-like-post-route="${route}"]`).classList.toggle('thumbs-up-on')
-            document.querySelector(`[data-like-post-route="${route}"]`).classList.toggle('btn-secondary')
-        }
-        else if(e.target.classList.contains('timeline-image') || e.target.classList.contains('at-sign')){
-            const href = e.target.parentElement.href
-            if(href === undefined){
-                window.location.href = e.target.href;
-            }
-            else {
-                window.location.href = href;
-            }
-        }
-        else if(e.target.nodeName !== 'LI'){
-            window.location.href = e.target.parentElement.dataset.messageRoute
-        }
-        else {
-            window.location.href = e.target.dataset.messageRoute;
-        }
-		});
+			document.querySelector(`[data-like-post-route="${route}"]`).classList.toggle('thumbs-up-on');
+			document.querySelector(`[data-like-post-route="${route}"]`).classList.toggle('btn-secondary');
+		} else if (e.target.classList.contains('timeline-image') || e.target.classList.contains('at-sign') || e.target.classList.contains('tag-link')) {
+			const href = e.target.parentElement.href;
+			if (href === undefined) {
+				window.location.href = e.target.href;
+			} else {
+				window.location.href = href;
+			}
+		} else if (e.target.nodeName !== 'LI') {
+			window.location.href = e.target.parentElement.dataset.messageRoute;
+		} else {
+			window.location.href = e.target.dataset.messageRoute;
+		}
+	});
+}
+
+// Merge live updates from /events (see events.py) into the page
+function listenForEvents() {
+	const feed = document.querySelector('[data-live-feed]');
+	const thread = document.querySelector('[data-live-dm-with]');
+	if ((!feed && !thread) || !window.EventSource) {
+		return;
 	}
-});
+
+	const source = new EventSource('/events');
+
+	// events carry ids only; the markup comes from our own server
+	source.addEventListener('message', async function (e) {
+		const data = JSON.parse(e.data);
+		if (!feed || feed.querySelector(`[data-message-id="${data.id}"]`)) {
+			return;
+		}
+		const resp = await fetch(`/messages/${data.id}/feed-item`);
+		if (!resp.ok || feed.querySelector(`[data-message-id="${data.id}"]`)) {
+			return;
+		}
+		feed.insertAdjacentHTML('afterbegin', await resp.text());
+		bindMessage(feed.firstElementChild);
+	});
+
+	source.addEventListener('likes', function (e) {
+		const data = JSON.parse(e.data);
+		const count = document.querySelector(`[data-like-count-for="${data.message_id}"]`);
+		if (count) {
+			count.textContent = data.likes === 1 ? '1 like' : `${data.likes} likes`;
+		}
+	});
+
+	source.addEventListener('direct_message', async function (e) {
+		const event = JSON.parse(e.data);
+		if (!thread || thread.dataset.liveDmWith !== String(event.sender_id)) {
+			return;
+		}
+		const resp = await fetch(`/direct-messages/${event.id}`);
+		if (!resp.ok) {
+			return;
+		}
+		const data = await resp.json();
+		const item = document.createElement('div');
+		const text = document.createElement('p');
+		const when = document.createElement('p');
+		text.textContent = `from ${data.sender}: ${data.text}`;
+		when.className = 'text-left';
+		when.textContent = data.timestamp;
+		item.append(text, when, document.createElement('hr'));
+		thread.append(item);
+	});
+
+	// this connection fell behind and missed events; start over
+	source.addEventListener('resync', function () {
+		source.close();
+		window.location.reload();
+	});
+}
+
+// Say whether the username typed on the signup form is free
+function checkUsernameAvailability() {
+	const input = document.querySelector('[data-check-username] [name="username"]');
+	if (!input) {
+		return;
+	}
+
+	const hint = document.createElement('small');
+	input.after(hint);
+	let timer;
+
+	input.addEventListener('input', function () {
+		clearTimeout(timer);
+		hint.textContent = '';
+		const username = input.value.trim();
+		if (!username) {
+			return;
+		}
+		timer = setTimeout(async function () {
+			const resp = await fetch(`/users/available?username=${encodeURIComponent(username)}`);
+			const data = await resp.json();
+			if (data.username === input.value.trim()) {
+				hint.className = data.available ? 'text-success' : 'text-danger';
+				hint.textContent = data.available ? 'Available' : 'Username already taken';
+			}
+		}, 300);
+	});
+}
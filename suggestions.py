@@ -0,0 +1,172 @@
+"""Offline "who to follow" suggestions from friends-of-friends.
+
+For each user, every account followed by someone they follow is a
+candidate, scored by how many of the people they follow follow it. With A
+the follower -> followed adjacency matrix, that's A @ A minus the accounts
+they already follow and themselves.
+
+The job loads `follows` once into a scipy CSR matrix, multiplies it in
+chunks of SUGGESTIONS_CHUNK_SIZE users (so the product never has more
+than a chunk of rows in memory), and replaces each chunk's rows in
+`follow_suggestions` with its top SUGGESTIONS_PER_USER, one commit per
+chunk. Memory is roughly the edge list plus one chunk's product.
+
+Runs every SUGGESTIONS_INTERVAL seconds on job workers, or on demand with
+`flask build-suggestions`.
+"""
+
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+from flask import current_app
+from scipy import sparse
+from sqlalchemy import text
+
+import metrics
+from jobs import handler, periodic, report_progress
+from models import db, FollowSuggestion
+
+# Only follows of active accounts can be suggested
+EDGES_SQL = """
+    SELECT f.user_following_id, f.user_being_followed_id
+    FROM follows AS f
+    JOIN users AS u ON u.id = f.user_being_followed_id
+    WHERE u.deleted_at IS NULL
+"""
+
+FETCH_SIZE = 100000
+
+
+def load_edges(connection):
+    """(followers, followed) as int64 arrays, streamed in FETCH_SIZE rows."""
+
+    result = connection.execution_options(stream_results=True).execute(
+        text(EDGES_SQL)
+    )
+    chunks = []
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int64).reshape(-1, 2))
+    if not chunks:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    edges = np.concatenate(chunks)
+    return edges[:, 0], edges[:, 1]
+
+
+def adjacency(followers, followed):
+    """(user ids, CSR matrix over their dense indexes) for the edge list."""
+
+    ids, inverse = np.unique(np.concatenate([followers, followed]), return_inverse=True)
+    rows, cols = inverse[: len(followers)], inverse[len(followers) :]
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(len(ids), len(ids))
+    )
+    # the follows primary key makes duplicates impossible, but be safe
+    matrix.data[:] = 1
+    return ids, matrix
+
+
+def chunk_scores(matrix, start, stop):
+    """Friends-of-friends scores for rows start:stop, as CSR."""
+
+    follows = matrix[start:stop]
+    scores = follows @ matrix
+    count = stop - start
+    themselves = sparse.csr_matrix(
+        (np.ones(count, dtype=np.int32), (np.arange(count), np.arange(start, stop))),
+        shape=scores.shape,
+    )
+    # drop self-suggestions and accounts they already follow
+    scores = scores - scores.multiply(themselves) - scores.multiply(follows)
+    scores.eliminate_zeros()
+    return scores.tocsr()
+
+
+def top_n(scores, row, n):
+    """(column indexes, scores) of a CSR row's n best, best first.
+
+    Ties go to the lower column, i.e. the older account.
+    """
+
+    lo, hi = scores.indptr[row], scores.indptr[row + 1]
+    cols, data = scores.indices[lo:hi], scores.data[lo:hi]
+    order = np.lexsort((cols, -data))[:n]
+    return cols[order], data[order]
+
+
+def build_suggestions(per_user, chunk_size):
+    """Recompute every user's suggestions; return how many users got some."""
+
+    started = datetime.utcnow()
+    start_time = time.perf_counter()
+
+    followers, followed = load_edges(db.session.connection())
+    db.session.commit()
+    ids, matrix = adjacency(followers, followed)
+    del followers, followed
+
+    table = FollowSuggestion.__table__
+    suggested_users = 0
+    for start in range(0, len(ids), chunk_size):
+        stop = min(start + chunk_size, len(ids))
+        scores = chunk_scores(matrix, start, stop)
+
+        rows = []
+        for row in range(stop - start):
+            cols, data = top_n(scores, row, per_user)
+            user_id = int(ids[start + row])
+            rows.extend(
+                {
+                    "user_id": user_id,
+                    "rank": rank,
+                    "suggested_id": int(ids[col]),
+                    "score": int(score),
+                    "computed_at": started,
+                }
+                for rank, (col, score) in enumerate(zip(cols, data))
+            )
+            suggested_users += bool(len(cols))
+
+        chunk_ids = [int(user_id) for user_id in ids[start:stop]]
+        db.session.execute(table.delete().where(table.c.user_id.in_(chunk_ids)))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        report_progress({"users": stop, "of": len(ids)})
+        db.session.commit()
+
+    # users who no longer follow anyone weren't in any chunk
+    db.session.execute(table.delete().where(table.c.computed_at < started))
+    db.session.commit()
+
+    metrics.observe("suggestions.build", time.perf_counter() - start_time)
+    metrics.set_gauge("suggestions.edges", matrix.nnz)
+    return suggested_users
+
+
+@handler("build_follow_suggestions")
+def build_follow_suggestions(payload):
+    build_suggestions(
+        current_app.config["SUGGESTIONS_PER_USER"],
+        current_app.config["SUGGESTIONS_CHUNK_SIZE"],
+    )
+
+
+def init_app(app):
+    app.config.setdefault("SUGGESTIONS_PER_USER", 20)
+    app.config.setdefault("SUGGESTIONS_CHUNK_SIZE", 2000)
+    app.config.setdefault("SUGGESTIONS_INTERVAL", 6 * 3600)
+
+    periodic("build_follow_suggestions", app.config["SUGGESTIONS_INTERVAL"])
+
+    @app.cli.command("build-suggestions")
+    def build_suggestions_command():
+        """Recompute "who to follow" suggestions for every user."""
+
+        users = build_suggestions(
+            app.config["SUGGESTIONS_PER_USER"], app.config["SUGGESTIONS_CHUNK_SIZE"]
+        )
+        click.echo(f"suggestions written for {users} users")
@@ -0,0 +1,208 @@
+"""Hashtag and @mention index.
+
+Finding messages by "#tag" or "@username" in `messages.text` would take a
+LIKE scan of every message. Instead routes that post messages call
+`index_messages()` in the same transaction, which parses the text and
+writes one row per tag to `hashtags` and one per mentioned user to
+`mentions` (see models.py). Both are keyed (tag or user, message id), so
+a feed page is one index range scan, newest first, paginated by message
+id ('before' = the last id on the previous page).
+
+Deleting a message deletes its rows (`unindex_message`, by message id),
+and purging an account deletes the rows of its messages (tasks.py).
+Mentions of a purged account go with it. Archiving keeps a message's rows,
+and pages are joined back to both `messages` and `messages_archive`.
+
+Messages posted before the index existed are added by `flask backfill-tags`,
+which splits both message tables into id ranges of TAGS_BACKFILL_CHUNK and
+enqueues one "index_tags_chunk" job per range, so every job worker indexes
+a range at once. Chunks can be rerun safely.
+"""
+
+import re
+
+import click
+from markupsafe import Markup, escape
+from sqlalchemy import text as sql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload
+
+import jobs
+import metrics
+from jobs import handler, report_progress
+from models import db, ArchivedMessage, Hashtag, Mention, Message, User
+
+# not in the middle of a word, an email address or a URL fragment
+HASHTAG = re.compile(r"(?<![\w#&/])#(\w{1,64})")
+MENTION = re.compile(r"(?<![\w@/])@(\w{1,64})")
+
+# the tables `flask backfill-tags` reads from
+MESSAGE_TABLES = ("messages", "messages_archive")
+
+
+def parse(text):
+    """The (lowercased) hashtags and the usernames mentioned in `text`."""
+
+    tags = {tag.lower() for tag in HASHTAG.findall(text)}
+    usernames = set(MENTION.findall(text))
+    return tags, usernames
+
+
+def index_messages(messages):
+    """Index (id, text) pairs: one INSERT per table. Doesn't commit."""
+
+    tag_rows, mentioned = [], []
+    for message_id, text in messages:
+        tags, usernames = parse(text)
+        tag_rows.extend({"tag": tag, "message_id": message_id} for tag in tags)
+        mentioned.extend((username, message_id) for username in usernames)
+
+    mention_rows = []
+    if mentioned:
+        user_ids = dict(
+            db.session.query(User.username, User.id).filter(
+                User.username.in_({username for username, _ in mentioned})
+            )
+        )
+        mention_rows = [
+            {"user_id": user_ids[username], "message_id": message_id}
+            for username, message_id in mentioned
+            if username in user_ids
+        ]
+
+    # rerunning a backfill chunk finds rows that are already there
+    for model, rows in ((Hashtag, tag_rows), (Mention, mention_rows)):
+        if rows:
+            db.session.execute(
+                insert(model.__table__).values(rows).on_conflict_do_nothing()
+            )
+    return len(tag_rows), len(mention_rows)
+
+
+def unindex_message(message_id):
+    """Remove a message's rows. Doesn't commit.
+
+    By message id, not by reparsing the text: a mentioned user may have
+    been renamed since.
+    """
+
+    for model in (Hashtag, Mention):
+        model.query.filter(model.message_id == message_id).delete(
+            synchronize_session=False
+        )
+
+
+def feed_page(key_column, key, before, limit):
+    """One page of the messages indexed under `key`, newest first.
+
+    Returns (messages, the 'before' for the next page or None).
+    """
+
+    model = key_column.class_
+    query = db.session.query(model.message_id).filter(key_column == key)
+    if before is not None:
+        query = query.filter(model.message_id < before)
+    ids = [
+        message_id
+        for (message_id,) in query.order_by(model.message_id.desc()).limit(limit + 1)
+    ]
+
+    next_before = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_before = ids[-1]
+
+    by_id = {}
+    for message_model in (Message, ArchivedMessage):
+        missing = [message_id for message_id in ids if message_id not in by_id]
+        if not missing:
+            break
+        for msg in (
+            message_model.query.options(joinedload(message_model.user))
+            .filter(message_model.id.in_(missing))
+            .all()
+        ):
+            by_id[msg.id] = msg
+
+    return [by_id[message_id] for message_id in ids if message_id in by_id], next_before
+
+
+def link_tags(text):
+    """Template filter: `text`, escaped, with its hashtags linked to their feeds."""
+
+    def link(match):
+        tag = match.group(1)
+        return f'<a href="/tags/{tag.lower()}" class="tag-link">#{tag}</a>'
+
+    return Markup(HASHTAG.sub(link, str(escape(text))))
+
+
+def plan_backfill(chunk_size):
+    """Enqueue an "index_tags_chunk" job per id range; returns how many."""
+
+    chunks = 0
+    for table in MESSAGE_TABLES:
+        after = None
+        while True:
+            # the id chunk_size rows on, straight off the primary key
+            through = db.session.execute(
+                sql(
+                    f"SELECT id FROM {table} "
+                    "WHERE :after IS NULL OR id > :after "
+                    "ORDER BY id LIMIT 1 OFFSET :offset"
+                ),
+                {"after": after, "offset": chunk_size - 1},
+            ).scalar()
+            jobs.enqueue(
+                "index_tags_chunk",
+                {"table": table, "after": after, "through": through},
+                idempotency_key=f"index_tags_chunk:{table}:{after}:{through}",
+            )
+            chunks += 1
+            if through is None:
+                break
+            after = through
+    db.session.commit()
+    return chunks
+
+
+@handler("index_tags_chunk")
+def index_tags_chunk(payload):
+    """Index the messages of one table with after < id <= through.
+
+    None for `after` or `through` leaves that end open.
+    """
+
+    table = payload["table"]
+    if table not in MESSAGE_TABLES:
+        raise ValueError(f"not a message table: {table!r}")
+
+    rows = db.session.execute(
+        sql(
+            f"SELECT id, text FROM {table} "
+            "WHERE (:after IS NULL OR id > :after) "
+            "AND (:through IS NULL OR id <= :through)"
+        ),
+        {"after": payload["after"], "through": payload["through"]},
+    ).fetchall()
+    tags, mentions = index_messages(rows)
+    report_progress({"messages": len(rows), "hashtags": tags, "mentions": mentions})
+    db.session.commit()
+    metrics.incr("tags.backfilled_messages", len(rows))
+
+
+def init_app(app):
+    app.config.setdefault("TAGS_PAGE_SIZE", 50)
+    app.config.setdefault("TAGS_BACKFILL_CHUNK", 5000)
+
+    app.add_template_filter(link_tags)
+
+    @app.cli.command("backfill-tags")
+    @click.option("--chunk-size", type=int, default=None)
+    def backfill_tags_command(chunk_size):
+        """Queue jobs that index the hashtags and mentions of existing messages."""
+
+        chunks = plan_backfill(chunk_size or app.config["TAGS_BACKFILL_CHUNK"])
+        click.echo(
+            f"queued {chunks} index_tags_chunk jobs; job workers run them in parallel"
+        )
@@ -0,0 +1,127 @@
+"""Background job handlers (see jobs.py).
+
+Importing this module registers the handlers.
+"""
+
+from sqlalchemy import text
+
+from jobs import handler, report_progress
+from models import db
+
+# Rows removed per statement (and per transaction) when purging a user
+PURGE_BATCH_SIZE = 1000
+
+# (label, DELETE for one batch of the user's rows); each must delete at most
+# :batch rows. Likes on the user's messages, and DMs in the user's threads,
+# go with them through the ondelete="cascade" foreign keys.
+PURGE_STEPS = [
+    # before the messages they index (see tags.py)
+    (
+        "hashtags",
+        "DELETE FROM hashtags WHERE ctid IN "
+        "(SELECT ctid FROM hashtags WHERE message_id IN "
+        "(SELECT id FROM messages WHERE user_id = :user_id "
+        "UNION ALL SELECT id FROM messages_archive WHERE user_id = :user_id) "
+        "LIMIT :batch)",
+    ),
+    (
+        "mentions",
+        "DELETE FROM mentions WHERE ctid IN "
+        "(SELECT ctid FROM mentions WHERE message_id IN "
+        "(SELECT id FROM messages WHERE user_id = :user_id "
+        "UNION ALL SELECT id FROM messages_archive WHERE user_id = :user_id) "
+        "LIMIT :batch)",
+    ),
+    (
+        "likes_archive",
+        "DELETE FROM likes_archive WHERE id IN "
+        "(SELECT id FROM likes_archive WHERE user_id = :user_id LIMIT :batch)",
+    ),
+    (
+        "messages_archive",
+        "DELETE FROM messages_archive WHERE id IN "
+        "(SELECT id FROM messages_archive WHERE user_id = :user_id LIMIT :batch)",
+    ),
+    (
+        "direct_messages_archive",
+        "DELETE FROM direct_messages_archive WHERE id IN "
+        "(SELECT id FROM direct_messages_archive "
+        "WHERE sender_id = :user_id OR sent_id = :user_id LIMIT :batch)",
+    ),
+    (
+        "likes",
+        "DELETE FROM likes WHERE id IN "
+        "(SELECT id FROM likes WHERE user_id = :user_id LIMIT :batch)",
+    ),
+    (
+        "messages",
+        "DELETE FROM messages WHERE id IN "
+        "(SELECT id FROM messages WHERE user_id = :user_id LIMIT :batch)",
+    ),
+    # follows also go in the follow_changes log (see follow_graph.py)
+    (
+        "following",
+        "WITH gone AS (DELETE FROM follows WHERE ctid IN "
+        "(SELECT ctid FROM follows WHERE user_following_id = :user_id LIMIT :batch) "
+        "RETURNING user_following_id, user_being_followed_id) "
+        "INSERT INTO follow_changes (follower_id, followed_id, op) "
+        "SELECT user_following_id, user_being_followed_id, -1 FROM gone",
+    ),
+    (
+        "followers",
+        "WITH gone AS (DELETE FROM follows WHERE ctid IN "
+        "(SELECT ctid FROM follows WHERE user_being_followed_id = :user_id "
+        "LIMIT :batch) "
+        "RETURNING user_following_id, user_being_followed_id) "
+        "INSERT INTO follow_changes (follower_id, followed_id, op) "
+        "SELECT user_following_id, user_being_followed_id, -1 FROM gone",
+    ),
+    (
+        "direct_messages",
+        "DELETE FROM direct_messages WHERE id IN "
+        "(SELECT id FROM direct_messages "
+        "WHERE sender_id = :user_id OR sent_id = :user_id LIMIT :batch)",
+    ),
+    (
+        "direct_message_threads",
+        "DELETE FROM direct_message_threads WHERE id IN "
+        "(SELECT id FROM direct_message_threads "
+        "WHERE user_1 = :user_id OR user_2 = :user_id LIMIT :batch)",
+    ),
+]
+
+
+@handler("purge_user")
+def purge_user(payload):
+    """Delete a deleted account's rows in bounded, separately committed batches.
+
+    The ORM cascade would load every message, like and follow into memory
+    and delete them in one long transaction. Here each batch is a set-based
+    DELETE of at most PURGE_BATCH_SIZE rows, committed on its own, so locks
+    are short. If the job dies part way, the retry just carries on with
+    whatever rows are left.
+    """
+
+    user_id = payload["user_id"]
+    progress = {"deleted": {}, "done": False}
+
+    for label, sql in PURGE_STEPS:
+        deleted = 0
+        while True:
+            result = db.session.execute(
+                text(sql), {"user_id": user_id, "batch": PURGE_BATCH_SIZE}
+            )
+            deleted += result.rowcount
+            progress["deleted"][label] = deleted
+            report_progress(progress)
+            db.session.commit()
+            if result.rowcount < PURGE_BATCH_SIZE:
+                break
+
+    db.session.execute(
+        text("DELETE FROM users WHERE id = :user_id AND deleted_at IS NOT NULL"),
+        {"user_id": user_id},
+    )
+    progress["done"] = True
+    report_progress(progress)
+    db.session.commit()
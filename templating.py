@@ -0,0 +1,71 @@
+"""Jinja bytecode cache and template warmup.
+
+Compiled templates are kept in TEMPLATE_CACHE_DIR, so a new worker loads
+bytecode instead of parsing and compiling every template again. The
+bytecode is executed, so the directory must be private to us: by default
+it's inside RUNTIME_DIR, and any directory that's someone else's or that
+others can access is refused (see runtime.py). At startup
+every template under templates/ is loaded once, so the first requests after
+a deploy don't pay for compilation either. The warmup time is recorded as
+the "templates.warmup" metric.
+"""
+
+import logging
+import os
+import tempfile
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+import metrics
+from runtime import ensure_private_dir, runtime_path
+
+logger = logging.getLogger(__name__)
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache that never exposes a half-written file.
+
+    Workers booting at the same time share the directory; Jinja 2.10 writes
+    cache files in place, so one worker could read another's partial write.
+    """
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def warm_templates(app):
+    """Compile every template in the app's templates/ folder; return the count."""
+
+    start = time.perf_counter()
+    names = app.jinja_loader.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    elapsed = time.perf_counter() - start
+
+    metrics.observe("templates.warmup", elapsed)
+    metrics.set_gauge("templates.warmed", len(names))
+    logger.info("warmed %d templates in %.1f ms", len(names), elapsed * 1000)
+    return len(names)
+
+
+def init_app(app):
+    """Give `app` a bytecode cache. Call before anything touches jinja_env."""
+
+    app.config.setdefault("TEMPLATE_WARMUP", True)
+    app.config.setdefault("TEMPLATE_CACHE_DIR", runtime_path(app, "jinja"))
+
+    directory = app.config["TEMPLATE_CACHE_DIR"]
+    if directory:
+        ensure_private_dir(directory)
+        app.jinja_options = dict(
+            app.jinja_options, bytecode_cache=AtomicBytecodeCache(directory)
+        )
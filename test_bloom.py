@@ -0,0 +1,32 @@
+"""Names filter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bloom.py
+
+
+from unittest import TestCase
+
+from bloom import BloomFilter
+
+
+class BloomFilterTestCase(TestCase):
+    """Test membership and the false positive rate."""
+
+    def test_no_false_negatives(self):
+        """Is everything added found again?"""
+        bloom = BloomFilter(1000, 0.01)
+        names = [f"u:user{n}" for n in range(1000)]
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        """Are false positives near the configured rate at capacity?"""
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add(f"u:user{n}")
+
+        false_positives = sum(f"u:other{n}" in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
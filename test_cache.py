@@ -0,0 +1,111 @@
+"""Read-through cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import TestCase
+
+import cache
+from runtime import UnsafePathError
+
+
+class CacheTestCase(TestCase):
+    """Test LRU/TTL expiry and request coalescing."""
+
+    def test_memory_lru(self):
+        """Are the least recently used entries evicted first?"""
+        backend = cache.MemoryBackend(max_entries=2)
+        backend.set("a", 1, ttl=60)
+        backend.set("b", 2, ttl=60)
+        backend.get("a")
+        backend.set("c", 3, ttl=60)
+
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIs(backend.get("b"), cache.MISS)
+        self.assertEqual(backend.get("c"), 3)
+
+    def test_ttl(self):
+        """Do entries expire after their ttl?"""
+        backend = cache.MemoryBackend(max_entries=10)
+        backend.set("a", 1, ttl=-1)
+        self.assertIs(backend.get("a"), cache.MISS)
+
+    def test_read_through_and_invalidate(self):
+        """Is compute only called on a miss, and again after invalidate?"""
+        calls = []
+        store = cache.Cache(cache.MemoryBackend(10), ttl=60, lock_timeout=1)
+
+        def compute():
+            calls.append(1)
+            return {"n": len(calls)}
+
+        self.assertEqual(store.get_or_compute("k", compute), {"n": 1})
+        self.assertEqual(store.get_or_compute("k", compute), {"n": 1})
+        store.invalidate("k")
+        self.assertEqual(store.get_or_compute("k", compute), {"n": 2})
+
+    def test_coalescing(self):
+        """Does only one of many concurrent callers compute a cold key?"""
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+        store = cache.Cache(cache.SQLiteBackend(path, 10), ttl=60, lock_timeout=5)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return "value"
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(store.get_or_compute("k", compute))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["value"] * 8)
+
+    def test_lease(self):
+        """Is the SQLite lease exclusive until released?"""
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+        backend = cache.SQLiteBackend(path, 10)
+
+        self.assertTrue(backend.acquire("k", timeout=60))
+        self.assertFalse(backend.acquire("k", timeout=60))
+        backend.release("k")
+        self.assertTrue(backend.acquire("k", timeout=60))
+
+    def test_json_round_trip(self):
+        """Do namespaces and datetimes come back as they were stored?"""
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite3")
+        backend = cache.SQLiteBackend(path, 10)
+        value = {
+            "messages": [
+                cache.SimpleNamespace(id=1, timestamp=datetime(2020, 1, 2, 3, 4))
+            ]
+        }
+        backend.set("k", value, ttl=60)
+
+        self.assertEqual(backend.get("k"), value)
+        with self.assertRaises(TypeError):
+            backend.set("bad", object(), ttl=60)
+
+    def test_refuses_shared_directory(self):
+        """Is a storage file in a directory others can write refused?"""
+        directory = tempfile.mkdtemp()
+        os.chmod(directory, 0o777)
+
+        with self.assertRaises(UnsafePathError):
+            cache.SQLiteBackend(os.path.join(directory, "cache.sqlite3"), 10)
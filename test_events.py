@@ -0,0 +1,78 @@
+"""Live event bus tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from events import Bus, SQLiteBroker, TooManyConnections, make_broker, stream
+
+
+class EventBusTestCase(TestCase):
+    """Test fan-out, backpressure and the connection cap."""
+
+    def test_fan_out(self):
+        """Does an event reach only the subscribers of its channel?"""
+        bus = Bus(max_connections=10, queue_size=10)
+        broker = make_broker("memory://", bus)
+        feed = broker.subscribe(["feed:1", "dm:2"])
+        other = broker.subscribe(["feed:3"])
+
+        broker.publish("feed:1", "message", {"id": 5})
+
+        self.assertEqual(feed.get(0), (1, "message", {"id": 5}))
+        self.assertIsNone(other.get(0))
+
+    def test_connection_cap(self):
+        """Are connections past the cap refused until one closes?"""
+        bus = Bus(max_connections=1, queue_size=10)
+        first = bus.subscribe(["feed:1"])
+
+        with self.assertRaises(TooManyConnections):
+            bus.subscribe(["feed:1"])
+        first.close()
+        bus.subscribe(["feed:1"])
+
+    def test_slow_subscriber_is_dropped(self):
+        """Does a full queue drop the connection with a resync event?"""
+        bus = Bus(max_connections=10, queue_size=2)
+        subscription = bus.subscribe(["feed:1"])
+        for n in range(3):
+            bus.deliver("feed:1", (n, "message", {}))
+
+        self.assertTrue(subscription.overflowed)
+        self.assertFalse(bus.has_subscribers())
+        output = list(stream(subscription, heartbeat=0))
+        self.assertEqual(output[-1], 'id: 0\nevent: resync\ndata: {}\n\n')
+
+    def test_sqlite_relay(self):
+        """Do events published by one process's broker reach another's bus?"""
+        path = os.path.join(tempfile.mkdtemp(), "events.sqlite3")
+        publisher = SQLiteBroker(Bus(10, 10), path, poll_interval=0, retention=60)
+        bus = Bus(10, 10)
+        relay = SQLiteBroker(bus, path, poll_interval=0, retention=60)
+        subscription = bus.subscribe(["dm:7"])
+        last_id = relay.relay_once(0)
+
+        publisher.publish("dm:7", "direct_message", {"text": "hi"})
+        publisher.publish("dm:8", "direct_message", {"text": "not you"})
+        relay.relay_once(last_id)
+
+        event_id, name, data = subscription.get(0)
+        self.assertEqual((name, data), ("direct_message", {"text": "hi"}))
+        self.assertIsNone(subscription.get(0))
+
+    def test_publish_prunes_expired_events(self):
+        """Are old events pruned with no relay running?"""
+        path = os.path.join(tempfile.mkdtemp(), "events.sqlite3")
+        publisher = SQLiteBroker(Bus(10, 10), path, poll_interval=0, retention=0)
+
+        for n in range(SQLiteBroker.PRUNE_EVERY):
+            publisher.publish("feed:1", "message", {"id": n})
+
+        count = publisher._connection().execute("SELECT COUNT(*) FROM events")
+        self.assertLess(count.fetchone()[0], SQLiteBroker.PRUNE_EVERY)
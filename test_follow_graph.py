@@ -0,0 +1,81 @@
+"""Follow graph snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from follow_graph import apply_changes, open_current, write_snapshot, KEEP_VERSIONS
+from models import FollowChange
+
+FOLLOW, UNFOLLOW = FollowChange.FOLLOW, FollowChange.UNFOLLOW
+
+
+def edge_list(graph):
+    followers, followed = graph.edges()
+    return sorted(zip(followers.tolist(), followed.tolist()))
+
+
+class FollowGraphTestCase(TestCase):
+    """Test writing, reading and patching CSR snapshots."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # 1 -> 2, 1 -> 3, 2 -> 3, 3 -> 1
+        self.followers = np.array([1, 1, 2, 3], dtype=np.int64)
+        self.followed = np.array([3, 2, 3, 1], dtype=np.int64)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_queries(self):
+        """Do neighbour, degree and intersection lookups match the edges?"""
+        write_snapshot(self.directory, self.followers, self.followed, 0)
+        graph = open_current(self.directory)
+
+        self.assertIsInstance(graph.arrays["following_indices"], np.memmap)
+        self.assertEqual(graph.following(1).tolist(), [2, 3])
+        self.assertEqual(graph.followers(3).tolist(), [1, 2])
+        self.assertEqual(graph.follower_count(1), 1)
+        self.assertTrue(graph.is_following(2, 3))
+        self.assertFalse(graph.is_following(3, 2))
+        self.assertEqual(graph.common_following(1, 2).tolist(), [3])
+        self.assertEqual(graph.mutuals(1).tolist(), [3])
+        # ids past the end of the snapshot have no edges
+        self.assertEqual(graph.following(99).tolist(), [])
+
+    def test_apply_changes(self):
+        """Does only each edge's last change count?"""
+        changes = [
+            (2, 1, FOLLOW),
+            (1, 2, UNFOLLOW),
+            (4, 1, FOLLOW),
+            (4, 1, UNFOLLOW),
+            (3, 2, UNFOLLOW),
+            (1, 3, FOLLOW),
+        ]
+
+        followers, followed = apply_changes(self.followers, self.followed, changes)
+
+        self.assertEqual(
+            sorted(zip(followers.tolist(), followed.tolist())),
+            [(1, 3), (2, 1), (2, 3), (3, 1)],
+        )
+
+    def test_versions(self):
+        """Does CURRENT move to the newest version and old ones get pruned?"""
+        for change_id in range(KEEP_VERSIONS + 2):
+            write_snapshot(self.directory, self.followers, self.followed, change_id)
+
+        graph = open_current(self.directory)
+        self.assertEqual(graph.last_change_id, KEEP_VERSIONS + 1)
+        self.assertEqual(edge_list(graph), [(1, 2), (1, 3), (2, 3), (3, 1)])
+        versions = [name for name in os.listdir(self.directory) if name[0].isdigit()]
+        self.assertEqual(len(versions), KEEP_VERSIONS)
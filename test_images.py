@@ -0,0 +1,105 @@
+"""Image upload tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from PIL import Image
+
+from images import ImageError, ImageStore, image_variant
+
+
+def png(width, height):
+    data = io.BytesIO()
+    Image.new("RGBA", (width, height), (200, 40, 40, 128)).save(data, "PNG")
+    data.seek(0)
+    return data
+
+
+def jpeg_with_exif():
+    exif = Image.Exif()
+    # Make and Model
+    exif[0x010F] = "Phone"
+    exif[0x0110] = "Camera 1"
+    data = io.BytesIO()
+    Image.new("RGB", (200, 200), "red").save(data, "JPEG", exif=exif.tobytes())
+    data.seek(0)
+    return data
+
+
+class ImageStoreTestCase(TestCase):
+    """Test storing uploads and rendering their variants."""
+
+    def setUp(self):
+        # render inline rather than in a process pool
+        self.store = ImageStore(
+            tempfile.mkdtemp(), workers=0, max_bytes=2**20, max_pixels=10**6
+        )
+
+    def test_save_and_variants(self):
+        """Is an upload stored by digest with every variant sized to fit?"""
+        url = self.store.save(png(800, 300))
+        digest = url.rsplit("/", 1)[1]
+        self.assertRegex(url, r"^/images/[0-9a-f]{32}$")
+        self.assertEqual(self.store.save(png(800, 300)), url)
+
+        with Image.open(self.store.variant(digest, "thumb", "webp")) as thumb:
+            self.assertEqual((thumb.format, thumb.size), ("WEBP", (96, 96)))
+        with Image.open(self.store.variant(digest, "header", "jpg")) as header:
+            self.assertEqual((header.format, header.size), ("JPEG", (600, 225)))
+
+    def test_variants_drop_metadata(self):
+        """Is the original's EXIF left out of every variant?"""
+        digest = self.store.save(jpeg_with_exif()).rsplit("/", 1)[1]
+
+        for fmt in ("jpg", "webp"):
+            with Image.open(self.store.variant(digest, "card", fmt)) as card:
+                self.assertNotIn("exif", card.info)
+                self.assertEqual(len(card.getexif()), 0)
+
+    def test_missing_original(self):
+        """Is a variant of an unknown digest None?"""
+        self.assertIsNone(self.store.variant("0" * 32, "thumb", "jpg"))
+
+    def test_rejects_non_images(self):
+        """Are files that aren't images, or are too big, refused?"""
+        with self.assertRaises(ImageError):
+            self.store.save(io.BytesIO(b"<script>alert(1)</script>"))
+        with self.assertRaises(ImageError):
+            self.store.save(io.BytesIO(b"\x89PNG" + os.urandom(2**20)))
+        # a few KB, but 4 megapixels decoded
+        with self.assertRaises(ImageError):
+            self.store.save(png(2000, 2000))
+
+    def test_filter(self):
+        """Does the filter rewrite local images only?"""
+        self.assertEqual(
+            image_variant("/images/" + "a" * 32, "card"),
+            "/images/" + "a" * 32 + "/card.jpg",
+        )
+        self.assertEqual(
+            image_variant("/static/images/default-pic.png", "card"),
+            "/static/images/default-pic.png",
+        )
+        self.assertEqual(
+            image_variant("https://example.com/a.png", "thumb"),
+            "https://example.com/a.png",
+        )
+
+    def test_filter_webp(self):
+        """Is WebP used only when the browser names it?"""
+        url = "/images/" + "a" * 32
+        app = Flask(__name__)
+
+        with app.test_request_context(headers={"Accept": "image/webp,*/*"}):
+            self.assertEqual(image_variant(url, "thumb"), url + "/thumb.webp")
+        for accept in ("*/*", "image/*", "image/webp;q=0,*/*"):
+            with app.test_request_context(headers={"Accept": accept}):
+                self.assertEqual(image_variant(url, "thumb"), url + "/thumb.jpg")
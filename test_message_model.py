@@ -5,12 +5,19 @@ from unittest import TestCase
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows, Likes
+from like_buffer import LikeBuffer
+import snowflake
+import trending
 
 os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
 
 app.config["WTF_CSRF_ENABLED"] = False
+app.config["RATELIMIT_ENABLED"] = False
+app.config["CACHE_ENABLED"] = False
+# the tests flush the like buffer themselves
+app.config["LIKES_FLUSH_INTERVAL"] = 3600
 
 import pdb
 
@@ -91,6 +98,7 @@ class MessageTestCase(TestCase):
             )
             db.session.add(test_message)
             db.session.commit()
+            message_id = test_message.id
             # next, need to logout then login as testuser2
 
             c.get("/logout", follow_redirects=True)
@@ -106,17 +114,93 @@ class MessageTestCase(TestCase):
                 sess[CURR_USER_KEY] = self.testuser2.id
 
             # like the post from testuser while logged in as testuser2
-            resp = c.post("/users/toggle_like/1")
+            resp = c.post(f"/users/toggle_like/{message_id}")
+            app.extensions["likes"].flush()
             check_for_like = Likes.query.filter_by(
-                user_id=self.testuser2.id, message_id=1
+                user_id=self.testuser2.id, message_id=message_id
             ).first()
             self.assertIsNotNone(check_for_like)
 
             # try post request to same link to unlike message
 
-            resp = c.post("/users/toggle_like/1")
+            resp = c.post(f"/users/toggle_like/{message_id}")
+            app.extensions["likes"].flush()
             # now we should get None if we check DB for the same like
             check_for_like = Likes.query.filter_by(
-                user_id=self.testuser2.id, message_id=1
+                user_id=self.testuser2.id, message_id=message_id
             ).first()
-            self.assertIsNone(check_for_like)
\ No newline at end of file
+            self.assertIsNone(check_for_like)
+
+    def testLikeTogglesCoalesce(self):
+        """Test repeated toggles are buffered, visible to the user, and flushed once"""
+        message = Message(text="popular", user_id=self.testuser.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id, user_id = message.id, self.testuser2.id
+        buffer = app.extensions["likes"]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            for _ in range(3):
+                c.post(f"/users/toggle_like/{message_id}")
+
+            # liked in the user's own view, not written yet
+            self.assertIs(buffer.state(user_id, message_id), True)
+            self.assertEqual(Likes.query.count(), 0)
+
+            self.assertEqual(buffer.flush(), 1)
+            self.assertIsNone(buffer.state(user_id, message_id))
+            self.assertEqual(
+                Likes.query.filter_by(user_id=user_id, message_id=message_id).count(), 1
+            )
+
+    def testLikesInFlightStayVisible(self):
+        """Test a flush's pairs stay in the user's view until it commits"""
+        buffer = LikeBuffer(app, max_pending=500)
+        # no flusher thread; the flush is stepped through by hand
+        buffer.flusher_pid = os.getpid()
+        buffer.set(1, 10, True)
+
+        items = buffer._take()
+        buffer.set(1, 11, False)
+        self.assertIs(buffer.state(1, 10), True)
+        self.assertEqual(buffer.overlay(1), {10: True, 11: False})
+
+        buffer._landed()
+        self.assertIsNone(buffer.state(1, 10))
+        self.assertEqual(buffer.overlay(1), {11: False})
+
+        # a failed flush puts its pairs back as pending
+        buffer._restore(items)
+        self.assertIs(buffer.state(1, 10), True)
+
+    def testTrendingSnapshot(self):
+        """Do snapshot scores mix with live likes after a reload?"""
+        msg = Message(text="popular", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        message_id = msg.id
+
+        with app.app_context():
+            trending.record_likes([(message_id, 2)])
+            db.session.commit()
+            trending.snapshot({})
+
+            tracker = app.extensions["trending"]
+            tracker.loaded_at = None
+            self.assertEqual([m for m, _ in trending.top_messages()], [message_id])
+            self.assertIsInstance(tracker.scores[message_id], float)
+
+            trending.record_likes([(message_id, 1)])
+            db.session.commit()
+            [(top_id, score)] = trending.top_messages()
+            self.assertEqual(top_id, message_id)
+            self.assertAlmostEqual(score, 3, places=1)
+
+    def testSnowflakeLeases(self):
+        """Does each lease get a worker id no other process holds?"""
+        with app.app_context():
+            first = snowflake.lease_worker_id(db.engine)
+            second = snowflake.lease_worker_id(db.engine)
+        self.assertNotEqual(first, second)
@@ -6,9 +6,13 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+
+from models import (db, connect_db, ApiToken, ArchivedMessage, DirectMessage, Hashtag,
+                    Mention, Message, User, Follows)
 import pdb
 
 # BEFORE we import our app, let's set an environmental variable
@@ -32,6 +36,8 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+app.config['CACHE_ENABLED'] = False
 
 
 class MessageViewTestCase(TestCase):
@@ -153,4 +159,170 @@ class MessageViewTestCase(TestCase):
         with self.client as c, app.app_context():
             c.get('/logout')
             resp = c.post("/messages/new", data={"text": "uh oh this shouldn't work"}, follow_redirects=True)
-            self.assertIn(b'Access unauthorized', resp.data)
\ No newline at end of file
+            self.assertIn(b'Access unauthorized', resp.data)
+
+    def test_archived_messages_fall_back(self):
+        """Archived messages still show on profiles and their own page"""
+
+        user_id = self.testuser.id
+        db.session.add(Message(text="hot", user_id=user_id))
+        db.session.add(ArchivedMessage(id=1, text="cold", user_id=user_id,
+                                       timestamp=datetime(2012, 1, 1)))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{user_id}")
+            self.assertIn(b"hot", resp.data)
+            self.assertIn(b"cold", resp.data)
+            self.assertLess(resp.data.index(b"hot"), resp.data.index(b"cold"))
+
+            resp = c.get("/messages/1")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"cold", resp.data)
+
+            self.assertEqual(c.get("/messages/2").status_code, 404)
+
+    def test_batch_messages(self):
+        """Test posting a batch through the API with per-item results"""
+
+        user_id = self.testuser.id
+        token = ApiToken.issue(user_id, "partner")
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.post("/api/messages/batch", json={"messages": [{"text": "a"}]})
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.post(
+                "/api/messages/batch",
+                headers={"Authorization": f"Bearer {token}"},
+                json={"messages": [{"text": "one"}, {"text": "  "},
+                                   {"text": "x" * 141}, {"text": "two"}]},
+            )
+
+        self.assertEqual(resp.status_code, 200)
+        results = resp.get_json()["results"]
+        self.assertEqual(resp.get_json()["created"], 2)
+        self.assertEqual([sorted(r) for r in results],
+                         [["id"], ["errors"], ["errors"], ["id"]])
+        texts = [m.text for m in Message.query.filter_by(user_id=user_id)
+                 .order_by(Message.id)]
+        self.assertEqual(texts, ["one", "two"])
+        self.assertEqual([int(r["id"]) for r in results if "id" in r],
+                         [m.id for m in Message.query.filter_by(user_id=user_id)
+                          .order_by(Message.id)])
+
+        for body in ([{"text": "a"}], "messages", {"messages": "a"}):
+            resp = self.client.post(
+                "/api/messages/batch",
+                headers={"Authorization": f"Bearer {token}"},
+                json=body,
+            )
+            self.assertEqual(resp.status_code, 400)
+
+    def test_tag_and_mention_feeds(self):
+        """Are posted hashtags and mentions indexed and paginated newest first?"""
+
+        mentioned_id = self.testuser2.id
+        app.config["TAGS_PAGE_SIZE"] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+                c.post("/messages/new", data={"text": "first #Flask"})
+                c.post("/messages/new", data={"text": "second #flask @testuser2"})
+                c.post("/messages/new", data={"text": "untagged"})
+
+                resp = c.get("/tags/flask")
+                self.assertIn(b"second", resp.data)
+                self.assertNotIn(b"first", resp.data)
+                second = Message.query.filter(Message.text.like("second%")).one()
+                resp = c.get(f"/tags/flask?before={second.id}")
+                self.assertIn(b"first", resp.data)
+
+                resp = c.get(f"/users/{mentioned_id}/mentions")
+                self.assertIn(b"second", resp.data)
+                self.assertEqual(Mention.query.count(), 1)
+
+                # deleting still finds the mention after a rename
+                User.query.get(mentioned_id).username = "renamed"
+                db.session.commit()
+                c.post(f"/messages/{second.id}/delete")
+                self.assertEqual(Hashtag.query.count(), 1)
+                self.assertEqual(Mention.query.count(), 0)
+        finally:
+            app.config["TAGS_PAGE_SIZE"] = 50
+
+    def test_direct_message_json_is_private(self):
+        """Is a DM fetched for a live event visible only to its two users?"""
+
+        sender_id, recipient_id = self.testuser.id, self.testuser2.id
+        outsider = User.signup(username="outsider", email="out@test.com",
+                               password="outsider", image_url=None)
+        db.session.commit()
+        outsider_id = outsider.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = sender_id
+            c.post("/users/message", data={"text": "psst", "send-to": recipient_id})
+            dm_id = DirectMessage.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = recipient_id
+            resp = c.get(f"/direct-messages/{dm_id}")
+            self.assertEqual(resp.get_json()["text"], "psst")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = outsider_id
+            self.assertEqual(c.get(f"/direct-messages/{dm_id}").status_code, 404)
+
+    def test_homepage_feed_statements_are_constant(self):
+        """Feed query count and size don't grow with follows or messages"""
+
+        def render_feed():
+            statements = []
+
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(parameters)
+
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = c.get("/")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertEqual(resp.status_code, 200)
+            return len(statements), sum(len(params) for params in statements)
+
+        user_id = self.testuser.id
+        user2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            db.session.add(Message(text="mine", user_id=user_id))
+            db.session.add(Follows(user_being_followed_id=user2_id,
+                                   user_following_id=user_id))
+            db.session.commit()
+            small = render_feed()
+
+            for n in range(30):
+                other = User(username=f"other{n}", email=f"other{n}@test.com",
+                             password="HASHED_PASSWORD")
+                db.session.add(other)
+                db.session.flush()
+                db.session.add(Follows(user_being_followed_id=other.id,
+                                       user_following_id=user_id))
+                db.session.add(Message(text=f"theirs {n}", user_id=other.id))
+                db.session.add(Message(text=f"mine {n}", user_id=user_id))
+            db.session.commit()
+            large = render_feed()
+
+        self.assertEqual(small, large)
+        statement_count, parameter_count = large
+        # load g.user, feed (with like flags), the archive top-up (the hot
+        # tier has fewer than 100 rows), sidebar counts, and at most one SET
+        # LOCAL statement_timeout
+        self.assertLessEqual(statement_count, 5)
+        self.assertLessEqual(parameter_count, 16)
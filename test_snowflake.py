@@ -0,0 +1,54 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import snowflake
+
+
+class SnowflakeTestCase(TestCase):
+    """Test time-ordered id generation."""
+
+    def test_ids_increase(self):
+        """Are ids from one generator strictly increasing?"""
+        generator = snowflake.SnowflakeGenerator(worker_id=1)
+        ids = [generator.next_id() for _ in range(10000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_ids_unique_across_threads(self):
+        """Do concurrent threads get distinct ids?"""
+        generator = snowflake.SnowflakeGenerator(worker_id=2)
+        ids = []
+
+        def take():
+            ids.extend(generator.next_id() for _ in range(2000))
+
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(ids)), 8000)
+
+    def test_timestamp_round_trip(self):
+        """Does timestamp_of recover the time an id was made at?"""
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        new_id = snowflake.SnowflakeGenerator(worker_id=3).next_id()
+        after = datetime.utcnow() + timedelta(milliseconds=1)
+
+        self.assertTrue(before <= snowflake.timestamp_of(new_id) <= after)
+
+        when = datetime(2021, 5, 4, 12, 30, 1, 250000)
+        self.assertEqual(snowflake.timestamp_of(snowflake.id_at(when)), when)
+
+    def test_worker_id_in_range(self):
+        """Are out-of-range worker ids rejected?"""
+        with self.assertRaises(ValueError):
+            snowflake.SnowflakeGenerator(worker_id=snowflake.MAX_WORKER_ID + 1)
@@ -0,0 +1,33 @@
+"""Hashtag and mention parsing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+from unittest import TestCase
+
+from tags import link_tags, parse
+
+
+class TagParsingTestCase(TestCase):
+    """Test finding tags and mentions in message text."""
+
+    def test_parse(self):
+        """Are tags lowercased and mentions kept, outside words and URLs?"""
+        tags, usernames = parse(
+            "#Flask and #flask with @alice, not a@b.com or example.com/#top #1"
+        )
+
+        self.assertEqual(tags, {"flask", "1"})
+        self.assertEqual(usernames, {"alice"})
+
+    def test_link_tags(self):
+        """Are tags linked and everything else escaped?"""
+        html = link_tags("<b>hi</b> it's #Python")
+
+        self.assertEqual(
+            html,
+            "&lt;b&gt;hi&lt;/b&gt; it&#39;s "
+            '<a href="/tags/python" class="tag-link">#Python</a>',
+        )
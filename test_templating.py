@@ -0,0 +1,64 @@
+"""Template bytecode cache and warmup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+
+import images
+import tags
+import templating
+from runtime import UnsafePathError
+
+
+class TemplatingTestCase(TestCase):
+    """Test precompiling templates into the bytecode cache."""
+
+    def test_warm_templates(self):
+        """Does warmup compile every template into the cache directory?"""
+        cache_dir = tempfile.mkdtemp()
+        app = Flask(__name__)
+        app.config["TEMPLATE_CACHE_DIR"] = cache_dir
+        templating.init_app(app)
+        # templates use these, so they only compile where they're registered
+        app.add_template_filter(images.image_variant)
+        app.add_template_filter(tags.link_tags)
+
+        warmed = templating.warm_templates(app)
+
+        self.assertEqual(warmed, len(app.jinja_loader.list_templates()))
+        self.assertIn("home.html", app.jinja_loader.list_templates())
+        cached = [name for name in os.listdir(cache_dir) if name.endswith(".cache")]
+        self.assertEqual(len(cached), warmed)
+
+    def test_cache_is_reused(self):
+        """Does a second app load bytecode instead of compiling?"""
+        cache_dir = tempfile.mkdtemp()
+        for _ in range(2):
+            app = Flask(__name__)
+            app.config["TEMPLATE_CACHE_DIR"] = cache_dir
+            templating.init_app(app)
+            app.add_template_filter(images.image_variant)
+            app.add_template_filter(tags.link_tags)
+            templating.warm_templates(app)
+
+        # same templates, same cache keys: no new files the second time
+        self.assertEqual(
+            len(os.listdir(cache_dir)), len(app.jinja_loader.list_templates())
+        )
+
+    def test_refuses_shared_directory(self):
+        """Is a bytecode directory other users can write refused?"""
+        cache_dir = tempfile.mkdtemp()
+        os.chmod(cache_dir, 0o777)
+        app = Flask(__name__)
+        app.config["TEMPLATE_CACHE_DIR"] = cache_dir
+
+        with self.assertRaises(UnsafePathError):
+            templating.init_app(app)
@@ -0,0 +1,70 @@
+"""Trending tracker tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+from unittest import TestCase
+
+from trending import Trending
+
+
+class TrendingTestCase(TestCase):
+    """Test the in-memory decayed top-K."""
+
+    def test_ranks_by_likes(self):
+        """Are messages ranked by like count, and capped at k?"""
+        tracker = Trending(half_life=3600, k=2)
+        for message_id, likes in [(1, 1), (2, 3), (3, 2)]:
+            for _ in range(likes):
+                tracker.add(message_id, 1, when=tracker.landmark)
+
+        self.assertEqual([m for m, _ in tracker.top()], [2, 3])
+
+    def test_decay(self):
+        """Is a like worth half as much after one half-life?"""
+        tracker = Trending(half_life=3600, k=10)
+        start = tracker.landmark
+        tracker.add(1, 1, when=start)
+        tracker.add(1, 1, when=start)
+        tracker.add(2, 1, when=start + 3600 * 2)
+
+        scores = dict(tracker.top())
+        self.assertAlmostEqual(scores[1] / scores[2], 0.5, places=2)
+
+    def test_unlike_reranks(self):
+        """Does an unlike let a message outside the heap back in?"""
+        tracker = Trending(half_life=3600, k=1)
+        start = tracker.landmark
+        tracker.add(1, 1, when=start)
+        tracker.add(1, 1, when=start)
+        tracker.add(2, 1, when=start)
+        tracker.add(1, -1, when=start)
+        tracker.add(1, -1, when=start)
+
+        self.assertEqual([m for m, _ in tracker.top()], [2])
+
+    def test_load_keeps_newer_likes(self):
+        """Are likes newer than a snapshot kept when it's loaded?"""
+        tracker = Trending(half_life=3600, k=10)
+        start = tracker.landmark
+        tracker.add(1, 1, when=start - 10)
+        tracker.add(2, 1, when=start + 10)
+
+        tracker.load([(1, 1.0), (3, 5.0)], computed_at=start)
+
+        self.assertEqual([m for m, _ in tracker.top()], [3, 2, 1])
+
+    def test_load_without_snapshot(self):
+        """Does loading before any snapshot exists keep the likes seen so far?"""
+        tracker = Trending(half_life=3600, k=10)
+        start = tracker.landmark
+        tracker.add(1, 1, when=start)
+        tracker.add(2, 1, when=start)
+        tracker.add(2, 1, when=start)
+
+        tracker.load([], computed_at=None)
+
+        self.assertEqual(tracker.landmark, start)
+        self.assertEqual([m for m, _ in tracker.top()], [2, 1])
@@ -9,7 +9,7 @@ import os
 from unittest import TestCase
 from psycopg2 import errors
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, FollowSuggestion
 import pdb
 
 # BEFORE we import our app, let's set an environmental variable
@@ -23,6 +23,7 @@ os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+import suggestions
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -88,6 +89,64 @@ class UserModelTestCase(TestCase):
         self.assertTrue(user_2.is_following(user_1))
         self.assertFalse(user_1.is_following(user_2))
 
+    def test_follow_page(self):
+        """Does follow_page page by id and flag mutual follows?"""
+        users = [
+            User(email=f"test{n}@test.com", username=f"testuser{n}", password="HASHED")
+            for n in range(4)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        me, friend, fan, stranger = users
+
+        # friend and fan follow me; I follow friend and stranger
+        db.session.add_all(
+            [
+                Follows(user_being_followed_id=me.id, user_following_id=friend.id),
+                Follows(user_being_followed_id=me.id, user_following_id=fan.id),
+                Follows(user_being_followed_id=friend.id, user_following_id=me.id),
+                Follows(user_being_followed_id=stranger.id, user_following_id=me.id),
+            ]
+        )
+        db.session.commit()
+
+        followers = me.follow_page("followers", viewer_id=me.id)
+        self.assertEqual(
+            [(row.id, row.follows_you, row.you_follow) for row in followers],
+            [(friend.id, True, True), (fan.id, True, False)],
+        )
+
+        following = me.follow_page("following", viewer_id=me.id, limit=1)
+        self.assertEqual([row.id for row in following], [friend.id])
+        following = me.follow_page("following", viewer_id=me.id, after=friend.id)
+        self.assertEqual(
+            [(row.id, row.follows_you, row.you_follow) for row in following],
+            [(stranger.id, False, True)],
+        )
+
+    def test_follow_suggestions(self):
+        """Are friends-of-friends suggested, best first, minus existing follows?"""
+        users = [
+            User(email=f"test{n}@test.com", username=f"testuser{n}", password="HASHED")
+            for n in range(5)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        me, a, b, popular, followed = users
+
+        edges = [(me, a), (me, b), (me, followed), (a, popular), (b, popular),
+                 (a, followed), (b, me)]
+        db.session.add_all(
+            Follows(user_following_id=src.id, user_being_followed_id=dst.id)
+            for src, dst in edges
+        )
+        db.session.commit()
+
+        suggestions.build_suggestions(per_user=20, chunk_size=2)
+
+        rows = FollowSuggestion.for_user(me.id)
+        self.assertEqual([(row.id, row.score) for row in rows], [(popular.id, 2)])
+
     def test_user_creation(self):
         """Test user creation class method"""
         User.signup("bobs_burgers", "test@test.com", "testing1!", "")
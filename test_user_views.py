@@ -1,17 +1,24 @@
 """User views tests."""
 
+import json
 import os
+import uuid
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy import exc
 import pdb
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Job
 
 os.environ["DATABASE_URL"] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY, captured_templates
+from views import BULK_FOLLOW_MAX
+import jobs
 
 app.config["WTF_CSRF_ENABLED"] = False
+app.config["RATELIMIT_ENABLED"] = False
+app.config["CACHE_ENABLED"] = False
 app.config["PRESERVE_CONTEXT_ON_EXCEPTION"] = False
 
 db.create_all()
@@ -140,6 +147,201 @@ class UserViewTestCase(TestCase):
 
         self.assertEqual(response.status_code, 200)
 
+    def testDeleteUser(self):
+        """Test deleting an account removes the user via the job queue"""
+        user_id = self.testuser.id
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        response = self.client.post("/users/delete")
+
+        self.assertEqual(response.status_code, 302)
+        # too long to run inside the request; left for a worker
+        job = Job.query.filter_by(name="purge_user").one()
+        self.assertEqual(job.status, "pending")
+
+        with app.app_context():
+            jobs.run_pending(app)
+        self.assertIsNone(User.query.get(user_id))
+        db.session.refresh(job)
+        self.assertEqual(job.status, "done")
+        self.assertTrue(job.progress["done"])
+
+    def testExportData(self):
+        """Test the data export streams every record and can resume"""
+        user_id = self.testuser.id
+        for n in range(3):
+            db.session.add(Message(text=f"warble {n}", user_id=user_id))
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        response = self.client.get("/users/export?format=ndjson")
+        records = [json.loads(line) for line in response.data.splitlines()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["type"] for r in records], ["message"] * 3)
+        self.assertEqual(
+            response.headers["Content-Disposition"],
+            f'attachment; filename="warbler-export-{user_id}.ndjson"',
+        )
+        self.assertEqual([r["text"] for r in records], [f"warble {n}" for n in range(3)])
+
+        # resume after the first record
+        response = self.client.get(f"/users/export?after=message:{records[0]['id']}")
+        resumed = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(resumed, records[1:])
+
+        response = self.client.get("/users/export?format=csv")
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0].split(",")[:2], ["type", "id"])
+        self.assertEqual(len(lines), 4)
+
+    def testLoginRateLimited(self):
+        """Test repeated logins for one username are rejected with a 429"""
+        username = f"limited-{uuid.uuid4().hex}"
+        policies = app.config["RATELIMIT_POLICIES"]
+        app.config["RATELIMIT_ENABLED"] = True
+        app.config["RATELIMIT_POLICIES"] = {"warbler.login": [("username", 1, 2)]}
+        try:
+            statuses = [
+                self.client.post(
+                    "/login", data={"username": username, "password": "wrongpassword"}
+                ).status_code
+                for _ in range(3)
+            ]
+        finally:
+            app.config["RATELIMIT_ENABLED"] = False
+            app.config["RATELIMIT_POLICIES"] = policies
+
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def testRateLimitRejectionTakesNoTokens(self):
+        """Test a request one rule rejects doesn't use up another rule's tokens"""
+        username = f"limited-{uuid.uuid4().hex}"
+        # an address of its own, so earlier runs' buckets don't count
+        ip = "10.%d.%d.%d" % tuple(uuid.uuid4().bytes[:3])
+        policies = app.config["RATELIMIT_POLICIES"]
+        app.config["RATELIMIT_ENABLED"] = True
+        app.config["RATELIMIT_POLICIES"] = {
+            "warbler.login": [("ip", 1, 2), ("username", 1, 1)]
+        }
+        try:
+            statuses = [
+                self.client.post(
+                    "/login",
+                    data={"username": name, "password": "wrongpassword"},
+                    environ_base={"REMOTE_ADDR": ip},
+                ).status_code
+                for name in (username, username, username, username + "-other")
+            ]
+        finally:
+            app.config["RATELIMIT_ENABLED"] = False
+            app.config["RATELIMIT_POLICIES"] = policies
+
+        self.assertEqual(statuses, [200, 429, 429, 200])
+
+    def testSignUpTakenUsername(self):
+        """Test signing up with a taken username is refused before hashing"""
+        data = {
+            "username": self.testuser.username,
+            "password": "some_password",
+            "email": "other@test.com",
+        }
+        with patch("models.bcrypt.generate_password_hash") as generate_password_hash:
+            response = self.client.post("/signup", data=data, follow_redirects=True)
+
+        self.assertIn(b"Username already taken", response.data)
+        generate_password_hash.assert_not_called()
+        self.assertEqual(User.query.count(), 1)
+
+    def testUsernameAvailable(self):
+        """Test the username availability check"""
+        taken = self.client.get("/users/available?username=testuser").get_json()
+        free = self.client.get("/users/available?username=someone_new").get_json()
+
+        self.assertFalse(taken["available"])
+        self.assertTrue(free["available"])
+        self.assertEqual(self.client.get("/users/available").status_code, 400)
+
+    def testProfileChecksPasswordBeforeNames(self):
+        """Test a wrong password gives nothing away about taken emails"""
+        User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        user_id = self.testuser.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        response = self.client.post(
+            "/users/profile",
+            data={
+                "username": "testuser",
+                "email": "other@test.com",
+                "password": "wrongpassword",
+            },
+            follow_redirects=True,
+        )
+
+        self.assertIn(b"Incorrect password", response.data)
+        self.assertNotIn(b"Email already registered", response.data)
+
+    def testBulkFollow(self):
+        """Test following and unfollowing many users in one request"""
+        others = [User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+                  for n in range(3)]
+        db.session.commit()
+        user_id = self.testuser.id
+        other_ids = [other.id for other in others]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        response = self.client.post("/api/follows", json={"follow": other_ids})
+        self.assertEqual(response.get_json(), {"followed": 3, "unfollowed": 0})
+
+        response = self.client.post(
+            "/api/follows",
+            json={"follow": [other_ids[0], 999999], "unfollow": other_ids[1:]},
+        )
+        self.assertEqual(response.get_json(), {"followed": 0, "unfollowed": 2})
+        self.assertEqual(
+            [f.user_being_followed_id
+             for f in Follows.query.filter_by(user_following_id=user_id)],
+            other_ids[:1],
+        )
+
+    def testBulkFollowRejectsBadInput(self):
+        """Test malformed or oversized bulk follow requests get a 400"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+
+        for body in (
+            [1, 2],
+            "follow",
+            {"follow": "12"},
+            {"follow": {"1": 2}},
+            {"unfollow": ["1"]},
+            {"follow": [True]},
+            {"follow": list(range(1, BULK_FOLLOW_MAX + 2))},
+        ):
+            response = self.client.post("/api/follows", json=body)
+            self.assertEqual(response.status_code, 400, body)
+
+    def testMetricsInternalOnly(self):
+        """Test /metrics answers only direct requests from loopback"""
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+        self.assertEqual(
+            self.client.get(
+                "/metrics", headers={"X-Forwarded-For": "203.0.113.9"}
+            ).status_code,
+            404,
+        )
+        self.assertEqual(
+            self.client.get(
+                "/metrics", environ_base={"REMOTE_ADDR": "203.0.113.9"}
+            ).status_code,
+            404,
+        )
+
     def signUpAndLogin(self):
         data = {
             "username": "new_user",
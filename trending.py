@@ -0,0 +1,297 @@
+"""Trending messages, ranked by recent like velocity.
+
+A message's score is its likes with exponential decay: a like counts 1 now,
+1/2 after TRENDING_HALF_LIFE seconds, 1/4 after two half-lives, and so on.
+
+- Every flushed batch of likes (like_buffer.py) adds its net +/- per message
+  to the rows for the current time bucket in `trending_buckets` (one
+  multi-row upsert; see record_likes). This table is the shared, durable
+  state.
+- The "trending_snapshot" job decays the buckets still in the window,
+  writes the top TRENDING_TOP_K to `trending_scores` and prunes buckets
+  that have aged out. Job workers enqueue it every
+  TRENDING_SNAPSHOT_INTERVAL; without workers, the first read that finds
+  the snapshot overdue enqueues it and so runs it at the end of its
+  request (see jobs.py). Either way the interval's idempotency key means
+  it runs once.
+- Each process keeps a `Trending` tracker: the latest snapshot plus the
+  likes it has seen since, in a bounded top-K heap. It reloads the snapshot
+  every TRENDING_REFRESH seconds, so a fresh worker starts warm and a page
+  view never scans `likes`.
+"""
+
+import heapq
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+import jobs
+import metrics
+from jobs import handler, periodic
+from models import db, TrendingBucket, TrendingScore
+
+# Cast to double precision: psycopg2 sends :now and the literals as untyped
+# numerics, so Postgres would sum in numeric and hand back Decimals, which
+# don't mix with the tracker's floats
+SNAPSHOT_SQL = """
+    SELECT message_id, score FROM (
+        SELECT message_id,
+               SUM(likes * power(0.5, (:now - (bucket + 0.5) * :bucket_seconds)
+                                      / :half_life))::double precision AS score
+        FROM trending_buckets
+        WHERE bucket > :oldest
+        GROUP BY message_id
+    ) AS scored
+    WHERE score > 0
+    ORDER BY score DESC
+    LIMIT :k
+"""
+
+
+class Trending:
+    """A process's view of the top-K messages by decayed like count.
+
+    Scores are stored as "forward decayed" values relative to `landmark`
+    (a like at time t is worth 2 ** ((t - landmark) / half_life)), so adding
+    a like never requires decaying every other score, and ordering never
+    changes just because time passes.
+    """
+
+    def __init__(self, half_life, k):
+        self.half_life = half_life
+        self.k = k
+        self.lock = threading.Lock()
+        self.landmark = time.time()
+        self.loaded_at = None
+        self.scores = {}
+        self.heap = []
+        self.members = set()
+        self.dirty = False
+        # likes seen since the snapshot was computed: (time, message_id, delta)
+        self.recent = deque(maxlen=100000)
+
+    def _weight(self, when):
+        return 2 ** ((when - self.landmark) / self.half_life)
+
+    def add(self, message_id, delta, when=None):
+        """Count a like (delta=1) or unlike (delta=-1) on a message."""
+
+        when = when or time.time()
+        with self.lock:
+            self.recent.append((when, message_id, delta))
+            self._add(message_id, delta * self._weight(when))
+
+    def _add(self, message_id, value):
+        # O(log K), except when a message already in the heap gains: its
+        # entry is replaced and the heap re-heapified, O(K)
+        score = self.scores.get(message_id, 0) + value
+        self.scores[message_id] = score
+
+        if message_id in self.members:
+            if value < 0:
+                # it may have dropped below a message outside the heap
+                self.dirty = True
+            else:
+                self.heap = [(s if m != message_id else score, m) for s, m in self.heap]
+                heapq.heapify(self.heap)
+        elif score <= 0:
+            return
+        elif len(self.heap) < self.k:
+            heapq.heappush(self.heap, (score, message_id))
+            self.members.add(message_id)
+        elif score > self.heap[0][0]:
+            _, evicted = heapq.heapreplace(self.heap, (score, message_id))
+            self.members.discard(evicted)
+            self.members.add(message_id)
+
+    def load(self, rows, computed_at):
+        """Replace the state with a snapshot of (message_id, score) rows.
+
+        A `computed_at` of None (there's no snapshot) keeps the landmark
+        and counts every like this process has seen.
+        """
+
+        with self.lock:
+            self.scores = {message_id: float(score) for message_id, score in rows}
+            self.loaded_at = time.time()
+            if computed_at is not None:
+                self.landmark = computed_at
+                # likes the snapshot didn't see yet
+                while self.recent and self.recent[0][0] < computed_at:
+                    self.recent.popleft()
+            for when, message_id, delta in self.recent:
+                self.scores[message_id] = self.scores.get(
+                    message_id, 0
+                ) + delta * self._weight(when)
+            self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [
+            (score, message_id)
+            for message_id, score in heapq.nlargest(
+                self.k, self.scores.items(), key=lambda item: item[1]
+            )
+            if score > 0
+        ]
+        heapq.heapify(self.heap)
+        self.members = {message_id for _, message_id in self.heap}
+        self.dirty = False
+
+    def top(self, n=None):
+        """[(message_id, score now)], highest first."""
+
+        with self.lock:
+            if self.dirty:
+                self._rebuild()
+            decay = self._weight(time.time())
+            ranked = sorted(self.heap, reverse=True)[:n]
+        return [(message_id, score / decay) for score, message_id in ranked]
+
+    def stale(self, refresh):
+        return self.loaded_at is None or time.time() - self.loaded_at > refresh
+
+
+def bucket_of(when, bucket_seconds):
+    return int(when // bucket_seconds)
+
+
+def record_likes(deltas):
+    """Count net like changes, [(message_id, delta)], in the current bucket.
+
+    One upsert, in the caller's transaction.
+    """
+
+    deltas = [(message_id, delta) for message_id, delta in deltas if delta]
+    if not deltas:
+        return
+
+    now = time.time()
+    bucket = bucket_of(now, current_app.config["TRENDING_BUCKET_SECONDS"])
+    stmt = insert(TrendingBucket.__table__).values(
+        [
+            {"message_id": message_id, "bucket": bucket, "likes": delta}
+            for message_id, delta in deltas
+        ]
+    )
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["message_id", "bucket"],
+            set_={"likes": TrendingBucket.likes + stmt.excluded.likes},
+        )
+    )
+    tracker = current_app.extensions["trending"]
+    for message_id, delta in deltas:
+        tracker.add(message_id, delta, now)
+
+
+def top_messages(n=None):
+    """The trending (message_id, score) pairs, reloading the snapshot if old."""
+
+    tracker = current_app.extensions["trending"]
+    if tracker.stale(current_app.config["TRENDING_REFRESH"]):
+        computed_at = load_snapshot(tracker)
+        interval = current_app.config["TRENDING_SNAPSHOT_INTERVAL"]
+        if computed_at is None or time.time() - computed_at > 2 * interval:
+            request_snapshot(interval)
+    return tracker.top(n)
+
+
+def load_snapshot(tracker):
+    """Load `trending_scores` into `tracker`; returns when it was computed."""
+
+    rows = db.session.query(TrendingScore.message_id, TrendingScore.score).all()
+    computed_at = db.session.query(db.func.max(TrendingScore.computed_at)).scalar()
+    if computed_at is not None:
+        computed_at = (computed_at - datetime(1970, 1, 1)).total_seconds()
+    tracker.load(rows, computed_at)
+    return computed_at
+
+
+def request_snapshot(interval):
+    """Enqueue this interval's snapshot, if nothing has yet.
+
+    The same idempotency key the periodic job uses, so however many
+    processes find the snapshot overdue, it's computed once.
+    """
+
+    slot = int(time.time() // interval)
+    jobs.enqueue(
+        "trending_snapshot",
+        {"slot": slot},
+        idempotency_key=f"trending_snapshot:{slot}",
+    )
+    db.session.commit()
+
+
+# jobs enqueued before the like flush counted likes itself
+@handler("likes_changed")
+def count_likes(payload):
+    record_likes(payload["deltas"])
+
+
+# jobs enqueued before likes were buffered
+@handler("like_toggled")
+def count_like(payload):
+    record_likes([(payload["message_id"], 1 if payload["liked"] else -1)])
+
+
+# one aggregate over the window, so fine at the end of a request
+@handler("trending_snapshot", inline=True)
+def snapshot(payload):
+    """Recompute the top K from the buckets and prune expired buckets."""
+
+    config = current_app.config
+    start = time.perf_counter()
+    now = time.time()
+    oldest = bucket_of(now, config["TRENDING_BUCKET_SECONDS"]) - config[
+        "TRENDING_WINDOW_BUCKETS"
+    ]
+
+    rows = db.session.execute(
+        text(SNAPSHOT_SQL),
+        {
+            "now": now,
+            "bucket_seconds": config["TRENDING_BUCKET_SECONDS"],
+            "half_life": config["TRENDING_HALF_LIFE"],
+            "oldest": oldest,
+            "k": config["TRENDING_TOP_K"],
+        },
+    ).fetchall()
+
+    computed_at = datetime.utcfromtimestamp(now)
+    db.session.execute(TrendingScore.__table__.delete())
+    if rows:
+        db.session.execute(
+            TrendingScore.__table__.insert(),
+            [
+                {"message_id": message_id, "score": score, "computed_at": computed_at}
+                for message_id, score in rows
+            ],
+        )
+    db.session.execute(
+        TrendingBucket.__table__.delete().where(TrendingBucket.bucket <= oldest)
+    )
+    db.session.commit()
+
+    current_app.extensions["trending"].load(rows, now)
+    metrics.observe("trending.snapshot", time.perf_counter() - start)
+
+
+def init_app(app):
+    app.config.setdefault("TRENDING_HALF_LIFE", 3 * 3600)
+    app.config.setdefault("TRENDING_BUCKET_SECONDS", 300)
+    # 24 hours of 5-minute buckets; older likes are worth < 1/256
+    app.config.setdefault("TRENDING_WINDOW_BUCKETS", 288)
+    app.config.setdefault("TRENDING_TOP_K", 100)
+    app.config.setdefault("TRENDING_REFRESH", 30)
+    app.config.setdefault("TRENDING_SNAPSHOT_INTERVAL", 60)
+
+    app.extensions["trending"] = Trending(
+        app.config["TRENDING_HALF_LIFE"], app.config["TRENDING_TOP_K"]
+    )
+    periodic("trending_snapshot", app.config["TRENDING_SNAPSHOT_INTERVAL"])
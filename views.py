@@ -0,0 +1,1125 @@
+"""Warbler's routes, registered on the app by `create_app()` (app.py)."""
+
+import hmac
+from datetime import datetime
+from types import SimpleNamespace
+
+from flask import (
+    Blueprint,
+    Response,
+    current_app,
+    stream_with_context,
+    render_template,
+    request,
+    flash,
+    redirect,
+    session,
+    g,
+    url_for,
+    jsonify,
+    abort,
+    send_file,
+)
+from sqlalchemy import exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from decorators import login_required, statement_timeout
+
+from forms import (
+    UserAddForm,
+    LoginForm,
+    MessageForm,
+    ProfileEditForm,
+    ChangePasswordForm,
+)
+from models import (
+    ArchivedDirectMessage,
+    ArchivedLike,
+    ArchivedMessage,
+    DirectMessage,
+    DirectMessageThread,
+    FollowSuggestion,
+    db,
+    User,
+    Message,
+    Follows,
+    Hashtag,
+    Likes,
+    Mention,
+)
+from archive import archive_fallback
+from cache import as_namespace, cached, invalidate
+from db_pool import sample_pool
+import api
+import bloom
+import events
+import export
+import follow_graph
+import images
+import jobs
+import metrics
+import tags
+import trending
+
+CURR_USER_KEY = "curr_user"
+USERS_PAGE_SIZE = 30
+FOLLOWS_PAGE_SIZE = 30
+BULK_FOLLOW_MAX = 500
+MESSAGES_PAGE_SIZE = 100
+
+# flashed when bloom.taken() finds a name in use
+TAKEN_MESSAGES = {
+    "username": "Username already taken",
+    "email": "Email already registered",
+}
+
+# what's cached of a user and a message (see cache.py)
+USER_FIELDS = ("id", "username", "image_url", "header_image_url", "bio", "location")
+MESSAGE_FIELDS = ("id", "text", "timestamp", "user_id", "archived")
+
+bp = Blueprint("warbler", __name__)
+
+##############################################################################
+# User signup/login/logout
+
+
+@bp.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global"""
+
+    if CURR_USER_KEY in session:
+        g.user = User.query.get(session[CURR_USER_KEY])
+        if g.user is not None and g.user.deleted_at is not None:
+            del session[CURR_USER_KEY]
+            g.user = None
+
+    else:
+        g.user = None
+
+
+# @bp.after_app_request
+# def add_current_url_to_session(response):
+#     """Add previous url to session"""
+#     session["previous_url"] = request.endpoint
+#     return response
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.id
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+        flash("You have been logged out", "success")
+
+
+@bp.route("/signup", methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username: flash message
+    and re-present form.
+    """
+
+    form = UserAddForm()
+    if form.validate_on_submit():
+        # before bcrypt, which is most of the cost of a signup
+        taken = bloom.taken(username=form.username.data, email=form.email.data)
+        if taken:
+            flash(TAKEN_MESSAGES[taken], "danger")
+            return render_template("users/signup.html", form=form)
+
+        try:
+            user = User.signup(
+                username=form.username.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+            )
+            db.session.commit()
+            invalidate(f"user:{user.id}")
+
+        except IntegrityError:
+            flash("Username already taken", "danger")
+            return render_template("users/signup.html", form=form)
+
+        do_login(user)
+        flash("Congrats on signing up!")
+        return redirect("/")
+
+    else:
+        return render_template("users/signup.html", form=form)
+
+
+@bp.route("/users/available", endpoint="username_available")
+def username_available():
+    """Whether ?username= is free, for checking it as the signup form is typed.
+
+    Usually answered by the names filter alone (see bloom.py), so the answer
+    is advisory: a name taken through another worker since that worker's
+    filter was last rebuilt (up to NAMES_FILTER_REBUILD seconds ago) reads
+    as available, and signup then refuses it. Rate limited per IP.
+    """
+
+    # as typed: signup stores the username unstripped
+    username = request.args.get("username", "")
+    if not username:
+        abort(400)
+    return jsonify(username=username, available=bloom.taken(username=username) is None)
+
+
+@bp.route("/login", methods=["GET", "POST"])
+def login():
+    """Handle user login."""
+    # redirect if user is already logged in
+    if g.user:
+        return redirect(url_for("warbler.homepage"))
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        user = User.authenticate(form.username.data, form.password.data)
+        if user:
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        flash("Invalid credentials.", "danger")
+
+    return render_template("users/login.html", form=form)
+
+
+@bp.route("/logout", endpoint="logout")
+@login_required(context="logout")
+def logout():
+    """Handle logout of user."""
+
+    do_logout()
+    return redirect(url_for("warbler.homepage"))
+
+
+##############################################################################
+# General user routes:
+
+
+@bp.route("/users")
+@statement_timeout(2000)
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+
+    Paginated by username: 'after' is the last username on the previous page.
+    Only the columns the user cards show are selected.
+    """
+
+    search = request.args.get("q")
+    after = request.args.get("after")
+
+    query = db.session.query(
+        User.id, User.username, User.image_url, User.header_image_url, User.bio
+    ).filter(User.deleted_at.is_(None))
+
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+    if after:
+        query = query.filter(User.username > after)
+
+    users = query.order_by(User.username).limit(USERS_PAGE_SIZE + 1).all()
+
+    next_after = None
+    if len(users) > USERS_PAGE_SIZE:
+        users = users[:USERS_PAGE_SIZE]
+        next_after = users[-1].username
+
+    following_ids = (
+        g.user.following_ids_among([user.id for user in users]) if g.user else set()
+    )
+
+    return render_template(
+        "users/index.html",
+        users=users,
+        following_ids=following_ids,
+        search=search,
+        next_after=next_after,
+    )
+
+
+@bp.route("/users/<int:user_id>")
+def users_show(user_id):
+    """Show user profile."""
+
+    user = cached_user(user_id)
+    if user is None:
+        abort(404)
+
+    profile = cached(f"profile:{user_id}", lambda: load_profile(user_id))
+
+    # per viewer, so not part of the cached profile
+    suggested = []
+    if g.user and g.user.id == user_id:
+        suggested = FollowSuggestion.for_user(user_id)
+
+    return render_template(
+        "users/show.html",
+        user=user,
+        messages=profile["messages"],
+        counts=profile["counts"],
+        suggested=suggested,
+    )
+
+
+def cached_user(user_id):
+    """The USER_FIELDS of an active user (None if there isn't one), cached.
+
+    Invalidated by signup, profile edits and account deletion.
+    """
+
+    def load():
+        user = User.active().filter_by(id=user_id).first()
+        return as_namespace(user, *USER_FIELDS) if user else None
+
+    return cached(f"user:{user_id}", load)
+
+
+def load_profile(user_id):
+    """A profile page's newest messages and counts, as plain data to cache.
+
+    Invalidated by the routes that add or remove the user's messages, likes
+    and follows (see invalidate_profiles).
+    """
+
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default
+    messages = (
+        Message.query.filter(Message.user_id == user_id)
+        .order_by(Message.id.desc())
+        .limit(MESSAGES_PAGE_SIZE)
+        .all()
+    )
+
+    def older(before_id, count):
+        query = ArchivedMessage.query.filter(ArchivedMessage.user_id == user_id)
+        if before_id is not None:
+            query = query.filter(ArchivedMessage.id < before_id)
+        return query.order_by(ArchivedMessage.id.desc()).limit(count).all()
+
+    messages = archive_fallback(messages, MESSAGES_PAGE_SIZE, older)
+
+    return {
+        "messages": [as_namespace(msg, *MESSAGE_FIELDS) for msg in messages],
+        "counts": as_namespace(
+            User.counts_for(user_id), "messages", "following", "followers", "likes"
+        ),
+    }
+
+
+def invalidate_profiles(*user_ids):
+    invalidate(*(f"profile:{user_id}" for user_id in user_ids))
+
+
+@bp.route("/users/<int:user_id>/likes")
+def show_liked_posts(user_id):
+    """Show posts liked by a user"""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    messages = user.likes
+
+    return render_template("users/likes.html", user=user, messages=messages)
+
+
+@bp.route("/users/<int:user_id>/following", endpoint="show_following")
+@login_required(context="user_details")
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    return render_follow_page(user_id, "following", "users/following.html")
+
+
+@bp.route("/users/<int:user_id>/followers", endpoint="users_followers")
+@login_required(context="user_details")
+def users_followers(user_id):
+    """Show list of followers of this user."""
+
+    return render_follow_page(user_id, "followers", "users/followers.html")
+
+
+def render_follow_page(user_id, direction, template):
+    """Render one cursor page ('after' = last user id) of follows for a user."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    rows = user.follow_page(
+        direction,
+        viewer_id=g.user.id,
+        after=request.args.get("after", type=int),
+        limit=FOLLOWS_PAGE_SIZE + 1,
+    )
+
+    next_after = None
+    if len(rows) > FOLLOWS_PAGE_SIZE:
+        rows = rows[:FOLLOWS_PAGE_SIZE]
+        next_after = rows[-1].id
+
+    return render_template(
+        template, user=user, rows=rows, next_after=next_after, counts=user.counts()
+    )
+
+
+@bp.route("/users/follow/<int:follow_id>", methods=["POST"], endpoint="add_follow")
+@login_required(context="user_details")
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    if not User.active_ids([follow_id]):
+        abort(404)
+
+    if Follows.follow(g.user.id, [follow_id]):
+        jobs.enqueue(
+            "follow_added", {"follower_id": g.user.id, "followed_ids": [follow_id]}
+        )
+    db.session.commit()
+    invalidate_profiles(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route(
+    "/users/stop-following/<int:follow_id>", methods=["POST"], endpoint="stop_following"
+)
+@login_required(context="user_details")
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    if Follows.unfollow(g.user.id, [follow_id]):
+        jobs.enqueue(
+            "follow_removed", {"follower_id": g.user.id, "followed_ids": [follow_id]}
+        )
+    db.session.commit()
+    invalidate_profiles(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route("/api/follows", methods=["POST"], endpoint="bulk_follow")
+@login_required(context="user_details")
+def bulk_follow():
+    """Follow and/or unfollow many users at once (e.g. during onboarding).
+
+    Takes JSON {"follow": [user ids], "unfollow": [user ids]}, at most
+    BULK_FOLLOW_MAX ids in total. Unknown or deleted users are skipped.
+    Returns how many follows were added and removed.
+    """
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="expected a JSON object"), 400
+    to_follow = data.get("follow") or []
+    to_unfollow = data.get("unfollow") or []
+    if not isinstance(to_follow, list) or not isinstance(to_unfollow, list):
+        return jsonify(error="follow and unfollow must be lists of user ids"), 400
+
+    ids = to_follow + to_unfollow
+    # bool is an int subclass, but true isn't a user id
+    if not all(
+        isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in ids
+    ):
+        return jsonify(error="user ids must be integers"), 400
+    if len(ids) > BULK_FOLLOW_MAX:
+        return jsonify(error=f"at most {BULK_FOLLOW_MAX} ids per request"), 400
+
+    to_follow = User.active_ids(to_follow)
+    followed = Follows.follow(g.user.id, to_follow)
+    unfollowed = Follows.unfollow(g.user.id, to_unfollow)
+
+    if followed:
+        jobs.enqueue(
+            "follow_added", {"follower_id": g.user.id, "followed_ids": list(to_follow)}
+        )
+    if unfollowed:
+        jobs.enqueue(
+            "follow_removed", {"follower_id": g.user.id, "followed_ids": to_unfollow}
+        )
+    db.session.commit()
+    if followed or unfollowed:
+        invalidate_profiles(g.user.id, *to_follow, *to_unfollow)
+
+    return jsonify(followed=followed, unfollowed=unfollowed)
+
+
+@bp.route("/api/users/<int:user_id>/connections", endpoint="user_connections")
+@login_required(context="user_details")
+def user_connections(user_id):
+    """How the logged-in user and `user_id` are connected.
+
+    Answered from the follow graph snapshot (follow_graph.py) without
+    touching the database, so it can lag a minute behind; 503 before the
+    first snapshot is built.
+    """
+
+    graph = follow_graph.current()
+    if graph is None:
+        return jsonify(error="follow graph not built yet"), 503
+
+    return jsonify(
+        following=graph.following_count(user_id),
+        followers=graph.follower_count(user_id),
+        follows_you=graph.is_following(user_id, g.user.id),
+        you_follow=graph.is_following(g.user.id, user_id),
+        common_following=len(graph.common_following(g.user.id, user_id)),
+        mutuals=len(graph.mutuals(user_id)),
+    )
+
+
+@bp.route("/users/profile", methods=["GET", "POST"], endpoint="profile")
+@login_required(context="user_details")
+def profile():
+    """Update profile for current user."""
+
+    form = ProfileEditForm()
+    if form.validate_on_submit():
+        if User.authenticate(g.user.username, form.password.data) is not False:
+            # only after the password, so this can't be used to probe for
+            # registered emails
+            taken = bloom.taken(
+                username=form.username.data
+                if form.username.data != g.user.username
+                else None,
+                email=form.email.data if form.email.data != g.user.email else None,
+            )
+            if taken:
+                flash(TAKEN_MESSAGES[taken], "danger")
+                return render_template("users/edit.html", form=form)
+
+            store = current_app.extensions["images"]
+            image_url = form.image_url.data
+            header_image_url = form.header_image_url.data
+            try:
+                # an upload replaces the URL typed in the form
+                if form.image.data:
+                    image_url = store.save(form.image.data.stream)
+                if form.header_image.data:
+                    header_image_url = store.save(form.header_image.data.stream)
+            except images.ImageError as error:
+                flash(str(error), "danger")
+                return render_template("users/edit.html", form=form)
+
+            g.user.username = form.username.data
+            g.user.email = form.email.data
+            g.user.image_url = image_url
+            g.user.header_image_url = header_image_url
+            g.user.bio = form.bio.data
+            db.session.add(g.user)
+            db.session.commit()
+            invalidate(f"user:{g.user.id}")
+            flash("Profile successfully updated")
+            return redirect(f"/users/{g.user.id}")
+        else:
+            flash("Incorrect password")
+    return render_template("users/edit.html", form=form)
+
+
+@bp.route("/images/<digest>/<variant>.<fmt>", endpoint="image_variant")
+def serve_image(digest, variant, fmt):
+    """One of an uploaded image's sized variants (see images.py).
+
+    Originals are never served. URLs are content-addressed, so responses
+    are cached as immutable.
+    """
+
+    if (
+        not images.DIGEST.match(digest)
+        or variant not in images.VARIANTS
+        or fmt not in images.FORMATS
+    ):
+        abort(404)
+    path = current_app.extensions["images"].variant(digest, variant, fmt)
+    if path is None:
+        abort(404)
+
+    response = send_file(path, mimetype=images.FORMATS[fmt][1], conditional=True)
+    response.headers["Cache-Control"] = (
+        f"public, max-age={current_app.config['IMAGES_MAX_AGE']}, immutable"
+    )
+    return response
+
+
+@bp.route("/users/delete", methods=["POST"], endpoint="delete_user")
+@login_required(context="user_details")
+def delete_user():
+    """Delete user."""
+
+    # hide the account now; its rows are removed in the background
+    g.user.deleted_at = datetime.utcnow()
+    jobs.enqueue(
+        "purge_user",
+        {"user_id": g.user.id},
+        idempotency_key=f"purge_user:{g.user.id}",
+    )
+    db.session.commit()
+    invalidate(f"user:{g.user.id}")
+    invalidate_profiles(g.user.id)
+
+    do_logout()
+
+    return redirect("/signup")
+
+
+@bp.route("/users/account", endpoint="change_password", methods=["GET", "POST"])
+@login_required(context="user_details")
+def change_password():
+    """View func for logged-in users to change password"""
+
+    form = ChangePasswordForm()
+
+    if form.validate_on_submit():
+        change_password_attempt = User.change_password(
+            username=g.user.username,
+            current_password=form.current_password.data,
+            new_password=form.new_password.data,
+        )
+        if change_password_attempt == g.user:
+            db.session.commit()
+            flash("Your password has been updated")
+        else:
+            flash("Current password is incorrect")
+    return render_template("users/change_password.html", form=form)
+
+
+@bp.route("/users/export", endpoint="export_data")
+@login_required(context="user_details")
+def export_data():
+    """Download all of the logged-in user's data (see export.py).
+
+    ?format=ndjson (default) or csv; ?after=<type>:<id> resumes after the
+    last complete record of an interrupted download.
+    """
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return jsonify(error=f"format must be one of {sorted(export.FORMATS)}"), 400
+    after = request.args.get("after")
+    try:
+        export.parse_cursor(after)
+    except ValueError:
+        return jsonify(error="after must look like <type>:<id>"), 400
+
+    metrics.incr("export.started")
+    chunks = export.export_chunks(
+        g.user.id, fmt, after, current_app.config["EXPORT_FETCH_SIZE"]
+    )
+    response = Response(stream_with_context(chunks), mimetype=export.FORMATS[fmt])
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="warbler-export-{g.user.id}.{fmt}"'
+    )
+    # don't let a proxy buffer the whole export
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+##############################################################################
+# Messages routes:
+
+
+@bp.route("/messages/new", methods=["GET", "POST"], endpoint="messages_add")
+@login_required(context="user_details")
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        msg = Message(text=form.text.data)
+        g.user.messages.append(msg)
+        db.session.flush()
+        tags.index_messages([(msg.id, msg.text)])
+        db.session.commit()
+        invalidate_profiles(g.user.id)
+        publish_new_messages(g.user.id, [msg.id])
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template("messages/new.html", form=form)
+
+
+def publish_new_messages(user_id, message_ids):
+    """Push just-committed messages to the feeds of the author's followers.
+
+    Events carry ids only; pages fetch what they show (see feed_item).
+    """
+
+    for message_id in message_ids:
+        # snowflakes don't fit in a JavaScript number
+        events.publish(f"feed:{user_id}", "message", {"id": str(message_id)})
+
+
+@bp.route("/messages/<int:message_id>/feed-item", endpoint="feed_item")
+@login_required(context="user_details")
+def feed_item(message_id):
+    """One message rendered as a home feed item, for live "message" events."""
+
+    msg = Message.query.options(joinedload(Message.user)).get_or_404(message_id)
+    liked = current_app.extensions["likes"].state(g.user.id, message_id)
+    if liked is None:
+        liked = db.session.query(
+            exists()
+            .where(Likes.user_id == g.user.id)
+            .where(Likes.message_id == message_id)
+        ).scalar()
+    return render_template(
+        "messages/_feed_item.html", msg=msg, likes=[message_id] if liked else []
+    )
+
+
+@bp.route("/api/messages/batch", methods=["POST"], endpoint="messages_batch")
+def messages_batch():
+    """Post up to API_MESSAGE_BATCH_MAX messages at once (see api.py).
+
+    Takes JSON {"messages": [{"text": ...}, ...]}. Each message is checked
+    against MessageForm's rules; the valid ones are inserted in one
+    statement and the follow-up work runs once for the whole batch. Returns
+    one result per message, in order: {"id": "<id>"} or {"errors": {...}}.
+    Ids are strings, since snowflakes don't fit in a JavaScript number.
+    """
+
+    user = api.token_user()
+    if user is None:
+        return jsonify(error="a valid bearer token is required"), 401
+
+    data = request.get_json(silent=True)
+    items = data.get("messages") if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify(error="messages must be a non-empty list"), 400
+    limit = current_app.config["API_MESSAGE_BATCH_MAX"]
+    if len(items) > limit:
+        return jsonify(error=f"at most {limit} messages per request"), 400
+
+    results, texts = [], []
+    for item in items:
+        text, errors = api.validate_message(item)
+        results.append({"errors": errors} if errors else None)
+        if text is not None:
+            texts.append(text)
+
+    created = Message.create_many(user.id, texts)
+    ids = iter(created)
+    results = [result or {"id": str(next(ids))} for result in results]
+
+    if texts:
+        tags.index_messages(zip(created, texts))
+        db.session.commit()
+        invalidate_profiles(user.id)
+        metrics.incr("api.messages_posted", len(texts))
+        publish_new_messages(user.id, created)
+
+    return jsonify(results=results, created=len(texts))
+
+
+@bp.route("/tags/<tag>", endpoint="tag_feed")
+@statement_timeout(2000)
+def tag_feed(tag):
+    """Messages tagged #tag, newest first ('before' = last message id)."""
+
+    tag = tag.lower()
+    if not tags.HASHTAG.fullmatch(f"#{tag}"):
+        abort(404)
+
+    messages, next_before = tags.feed_page(
+        Hashtag.tag,
+        tag,
+        before=request.args.get("before", type=int),
+        limit=current_app.config["TAGS_PAGE_SIZE"],
+    )
+    return render_template(
+        "messages/tagged.html",
+        title=f"#{tag}",
+        messages=messages,
+        next_before=next_before,
+    )
+
+
+@bp.route("/users/<int:user_id>/mentions", endpoint="user_mentions")
+@statement_timeout(2000)
+def user_mentions(user_id):
+    """Messages that mention a user, newest first ('before' = last message id)."""
+
+    user = cached_user(user_id)
+    if user is None:
+        abort(404)
+
+    messages, next_before = tags.feed_page(
+        Mention.user_id,
+        user_id,
+        before=request.args.get("before", type=int),
+        limit=current_app.config["TAGS_PAGE_SIZE"],
+    )
+    return render_template(
+        "messages/tagged.html",
+        title=f"Mentions of @{user.username}",
+        messages=messages,
+        next_before=next_before,
+    )
+
+
+@bp.route("/messages/trending")
+def messages_trending():
+    """Messages with the most recent likes, from the trending tracker."""
+
+    ranked = trending.top_messages()
+    by_id = {
+        msg.id: msg
+        for msg in Message.query.options(joinedload(Message.user))
+        .filter(Message.id.in_([message_id for message_id, _ in ranked]))
+        .all()
+    }
+    # deleted or archived messages drop out at the next snapshot
+    rows = [
+        (by_id[message_id], score) for message_id, score in ranked if message_id in by_id
+    ]
+    return render_template("messages/trending.html", rows=rows)
+
+
+@bp.route("/messages/<int:message_id>", methods=["GET"])
+def messages_show(message_id):
+    """Show a message."""
+
+    def load():
+        msg = get_message_or_404(message_id)
+        return as_namespace(msg, *MESSAGE_FIELDS)
+
+    msg = cached(f"message:{message_id}", load)
+    user = cached_user(msg.user_id)
+    if user is None:
+        abort(404)
+
+    msg = SimpleNamespace(user=user, **vars(msg))
+    return render_template("messages/show.html", message=msg)
+
+
+def get_message_or_404(message_id):
+    """A message from the hot table, else from the archive, else 404."""
+
+    msg = Message.query.get(message_id)
+    if msg is None:
+        msg = ArchivedMessage.query.get_or_404(message_id)
+    return msg
+
+
+@bp.route(
+    "/messages/<int:message_id>/delete", methods=["POST"], endpoint="messages_destroy"
+)
+@login_required(context="user_details")
+def messages_destroy(message_id):
+    """Delete a message."""
+
+    msg = get_message_or_404(message_id)
+
+    # make sure logged-in user posted the message they're trying to delete
+
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized")
+        return redirect("/")
+
+    tags.unindex_message(msg.id)
+    db.session.delete(msg)
+    db.session.commit()
+    invalidate(f"message:{message_id}")
+    invalidate_profiles(g.user.id)
+
+    return redirect(f"/users/{g.user.id}")
+
+
+@bp.route("/users/toggle_like/<int:message_id>", methods=["GET", "POST"])
+def toggle_like(message_id):
+    """Like or unlike a message"""
+
+    # archived messages are read-only
+    message = Message.query.get_or_404(message_id)
+
+    # redirect if user is trying to like their own post
+    if message.user_id == g.user.id:
+        flash("You can't like your own message")
+        return redirect("/")
+
+    # written by the like buffer's next flush (see like_buffer.py)
+    buffer = current_app.extensions["likes"]
+    liked = buffer.state(g.user.id, message_id)
+    if liked is None:
+        liked = db.session.query(
+            exists()
+            .where(Likes.user_id == g.user.id)
+            .where(Likes.message_id == message_id)
+        ).scalar()
+    buffer.set(g.user.id, message_id, not liked)
+
+    return redirect("/")
+
+
+@bp.route("/users/message", methods=["POST", "GET"])
+@login_required(context="user_details")
+def send_direct_message():
+    """Send a direct message to a specific user"""
+
+    # redirect if not accessed via a post request
+    if request.method == "GET":
+        return redirect(session["previous_url"])
+
+    send_to_id = request.form.get("send-to")
+    send_to = User.query.get(send_to_id)
+    form = MessageForm()
+    # check if form completed or if we're just rendering template
+    if form.validate_on_submit():
+        # insert DirectMessageThread and DirectMessage records
+        direct_message = add_direct_message(form.text.data, g.user.id, send_to_id)
+        # no text: the recipient's page fetches it (see direct_message_json)
+        events.publish(
+            f"dm:{send_to_id}",
+            "direct_message",
+            {"id": direct_message.id, "sender_id": g.user.id},
+        )
+        flash("Your message has been sent")
+        return redirect(url_for("warbler.users_show", user_id=send_to_id))
+
+    # check for existing messages between these two users
+    existing_messages = check_for_existing_messages(g.user.id, send_to_id)
+
+    return render_template(
+        "/messages/new_direct_message.html",
+        send_to=send_to,
+        form=form,
+        existing_messages=existing_messages,
+    )
+
+
+@bp.route("/direct-messages/<int:dm_id>", endpoint="direct_message_json")
+@login_required(context="user_details")
+def direct_message_json(dm_id):
+    """One DM as JSON, for live "direct_message" events; only to its two users."""
+
+    direct_message = DirectMessage.query.get_or_404(dm_id)
+    if g.user.id not in (direct_message.sender_id, direct_message.sent_id):
+        abort(404)
+    return jsonify(
+        sender_id=direct_message.sender_id,
+        sender=direct_message.sender.username,
+        text=direct_message.text,
+        timestamp=direct_message.timestamp.strftime("%Y-%m-%d %H:%M"),
+    )
+
+
+##############################################################################
+# Homepage and error pages
+
+
+@bp.route("/")
+@statement_timeout(2000)
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users & of logged-in user
+    """
+
+    if g.user:
+        rows = feed_rows(Message, Likes, None, MESSAGES_PAGE_SIZE)
+
+        # only reaches into the archive when the hot tier runs out
+        def older(before_id, count):
+            return feed_rows(ArchivedMessage, ArchivedLike, before_id, count)
+
+        rows = archive_fallback(
+            rows, MESSAGES_PAGE_SIZE, older, key=lambda row: row[0].id
+        )
+        messages = [msg for msg, _ in rows]
+        # the user's likes that haven't been flushed yet count too
+        pending = current_app.extensions["likes"].overlay(g.user.id)
+        likes = [msg.id for msg, is_liked in rows if pending.get(msg.id, is_liked)]
+        return render_template(
+            "home.html", messages=messages, likes=likes, counts=g.user.counts()
+        )
+
+    else:
+        return render_template("home-anon.html")
+
+
+def feed_rows(message_model, like_model, before_id, limit):
+    """(message, liked) rows of g.user's feed from one tier, newest first."""
+
+    # followed ids and like flags stay in SQL, so the statement is the
+    # same size no matter how many users/messages/likes g.user has
+    followed_ids = db.session.query(Follows.user_being_followed_id).filter(
+        Follows.user_following_id == g.user.id
+    )
+    liked = (
+        exists()
+        .where(like_model.message_id == message_model.id)
+        .where(like_model.user_id == g.user.id)
+    )
+    query = (
+        db.session.query(message_model, liked.label("liked"))
+        .options(joinedload(message_model.user))
+        .filter(
+            message_model.user_id.in_(followed_ids)
+            | (message_model.user_id == g.user.id)
+        )
+    )
+    if before_id is not None:
+        query = query.filter(message_model.id < before_id)
+    return query.order_by(message_model.id.desc()).limit(limit).all()
+
+
+@bp.route("/events", endpoint="events_stream")
+@login_required(context="user_details")
+def events_stream():
+    """Server-Sent Events for the logged-in user's feed and inbox (events.py).
+
+    Subscribes to the users they follow (new messages, like counts) and
+    their own DMs. Follows made while connected count from the next
+    connection, which EventSource makes on its own after any drop.
+    """
+
+    if not current_app.config["EVENTS_ENABLED"]:
+        abort(404)
+
+    followed_ids = [
+        user_id
+        for (user_id,) in db.session.query(Follows.user_being_followed_id).filter(
+            Follows.user_following_id == g.user.id
+        )
+    ]
+    channels = [f"feed:{user_id}" for user_id in followed_ids + [g.user.id]]
+    channels.append(f"dm:{g.user.id}")
+
+    try:
+        subscription = current_app.extensions["events"].subscribe(channels)
+    except events.TooManyConnections:
+        metrics.incr("events.rejected")
+        response = jsonify(error="too many live connections, try again later")
+        response.status_code = 503
+        response.headers["Retry-After"] = "30"
+        return response
+
+    # the stream outlives the request's app context, so it must not need it
+    response = Response(
+        events.stream(subscription, current_app.config["EVENTS_HEARTBEAT"]),
+        mimetype="text/event-stream",
+    )
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@bp.route("/metrics")
+def show_metrics():
+    """Expose this worker's counters as JSON for dashboards.
+
+    Internal only: answered for a bearer METRICS_TOKEN, or for a request
+    straight from an address in METRICS_ALLOWED_IPS (loopback by default)
+    that no proxy forwarded. Anyone else gets a 404.
+    """
+
+    config = current_app.config
+    _, _, token = request.headers.get("Authorization", "").partition(" ")
+    if config["METRICS_TOKEN"] and token:
+        allowed = hmac.compare_digest(token, config["METRICS_TOKEN"])
+    else:
+        allowed = (
+            request.remote_addr in config["METRICS_ALLOWED_IPS"]
+            and "X-Forwarded-For" not in request.headers
+        )
+    if not allowed:
+        abort(404)
+
+    sample_pool(db.engine)
+    return jsonify(metrics.snapshot())
+
+
+##############################################################################
+# Turn off all caching in Flask
+#   (useful for dev; in production, this kind of stuff is typically
+#   handled elsewhere)
+#
+# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+
+
+@bp.after_app_request
+def add_header(req):
+    """Add non-caching headers on every request."""
+
+    # content-addressed responses (e.g. images) cache forever
+    if "immutable" in req.headers.get("Cache-Control", ""):
+        return req
+
+    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    req.headers["Pragma"] = "no-cache"
+    req.headers["Expires"] = "0"
+    req.headers["Cache-Control"] = "public, max-age=0"
+    return req
+
+
+def add_direct_message(text, sender_id, sent_id):
+    """Manage creation of direct messages"""
+    direct_message_thread = check_for_existing_thread(sender_id, sent_id)
+    if direct_message_thread == None:
+        direct_message_thread = DirectMessageThread(user_1=sender_id, user_2=sent_id)
+        db.session.add(direct_message_thread)
+        db.session.commit()
+
+    new_direct_message = DirectMessage(
+        text=text,
+        direct_message_thread=direct_message_thread.id,
+        sender_id=sender_id,
+        sent_id=sent_id,
+    )
+    db.session.add(new_direct_message)
+    db.session.commit()
+    return new_direct_message
+
+
+def check_for_existing_thread(sender_id, sent_id):
+    """Check if new direct message should be added to an existing direct message thread"""
+    return DirectMessageThread.query.filter(
+        (
+            (DirectMessageThread.user_1 == sender_id)
+            | (DirectMessageThread.user_2 == sender_id)
+        ),
+        (
+            (DirectMessageThread.user_1 == sent_id)
+            | (DirectMessageThread.user_2 == sent_id)
+        ),
+    ).first()
+
+
+def check_for_existing_messages(sender_id, sent_id):
+    """Query DB to check for existing messages between two users, and, if found, return them so view function can pass into template"""
+    existing_thread = check_for_existing_thread(sender_id, sent_id)
+    if existing_thread is not None:
+        archived = (
+            ArchivedDirectMessage.query.filter_by(
+                direct_message_thread=existing_thread.id
+            )
+            .order_by(ArchivedDirectMessage.timestamp)
+            .all()
+        )
+        return archived + list(existing_thread.messages)
+    return None
+
+
+@bp.app_template_global()
+def render_message_metadata(message):
+    """Dynamically render info about sender and sent_to when rendering message thread"""
+    if message.sender.id == g.user.id:
+        return f"from you to {message.sent_to.username}:"
+    if message.sent_to.id == g.user.id:
+        return f"from {message.sender.username} to you:"
+    return f"from {message.sender.username} to {message.sent_to.username}:"